@@ -0,0 +1,150 @@
+import argparse
+import datetime
+import json
+import platform
+import sys
+
+from . import scenarios
+
+default_payload_sizes = (64, 1024, 65536)
+default_concurrency = (1, 8)
+default_regression_threshold = 0.1
+
+# Metrics that get worse when they grow. Every other metric gets worse when it drops
+lower_is_better = {"p50_latency_ms", "p99_latency_ms", "p50_added_latency_ms", "p99_added_latency_ms", "loss_ratio"}
+
+
+def parse_int_list(str_: str) -> tuple[int, ...]:
+  return tuple(int(x) for x in str_.split(","))
+
+
+def create_parser():
+  parser = argparse.ArgumentParser(
+    prog="python -m benchmarks", description="Measures throughput, latency and connection rate of localhost-throttle"
+  )
+  parser.add_argument(
+    "--payload-sizes",
+    type=parse_int_list,
+    default=default_payload_sizes,
+    help=f"Comma separated sizes in bytes of chunks and datagrams. (default: {','.join(map(str, default_payload_sizes))})",
+  )
+  parser.add_argument(
+    "--concurrency",
+    type=parse_int_list,
+    default=default_concurrency,
+    help=f"Comma separated numbers of simultaneous clients. (default: {','.join(map(str, default_concurrency))})",
+  )
+  parser.add_argument("--duration", type=float, default=2.0, help="Seconds every measurement lasts. (default: 2.0)")
+  parser.add_argument(
+    "--latency-samples", type=int, default=1000, help="Round trips per latency measurement. (default: 1000)"
+  )
+  parser.add_argument(
+    "--only",
+    type=lambda x: set(x.split(",")),
+    default=None,
+    help="Comma separated names of benchmarks to run: tcp_throughput, udp_packet_rate, tcp_added_latency, tcp_connection_rate",
+  )
+  parser.add_argument(
+    "--proxy-args",
+    default="",
+    help='Extra arguments for localhost-throttle, e.g. "--engine asyncio" or "--bandwidth 1e9"',
+  )
+  parser.add_argument("--output", help="Path of the JSON file to save results to")
+  parser.add_argument("--baseline", help="Path of the JSON file of an earlier run to compare results with")
+  parser.add_argument(
+    "--regression-threshold",
+    type=float,
+    default=default_regression_threshold,
+    help=f"Relative change for the worse that is reported as a regression. (default: {default_regression_threshold})",
+  )
+  return parser
+
+
+def benchmark_cases(args):
+  # Yields (name, parameters, function to run)
+  extra_args = args.proxy_args.split()
+  for payload_size in args.payload_sizes:
+    for concurrency in args.concurrency:
+      parameters = {"payload_size": payload_size, "concurrency": concurrency}
+      yield "tcp_throughput", parameters, lambda p=parameters: scenarios.tcp_throughput(
+        **p, duration=args.duration, extra_args=extra_args
+      )
+      if payload_size <= scenarios.max_udp_payload_size:
+        yield "udp_packet_rate", parameters, lambda p=parameters: scenarios.udp_packet_rate(
+          **p, duration=args.duration, extra_args=extra_args
+        )
+    parameters = {"payload_size": payload_size}
+    yield "tcp_added_latency", parameters, lambda p=parameters: scenarios.tcp_added_latency(
+      **p, samples=args.latency_samples, extra_args=extra_args
+    )
+  for concurrency in args.concurrency:
+    parameters = {"concurrency": concurrency}
+    yield "tcp_connection_rate", parameters, lambda p=parameters: scenarios.tcp_connection_rate(
+      **p, duration=args.duration, extra_args=extra_args
+    )
+
+
+def result_key(result: dict) -> str:
+  return json.dumps([result["benchmark"], result["parameters"]], sort_keys=True)
+
+
+def format_parameters(parameters: dict) -> str:
+  return " ".join(f"{key}={value}" for key, value in parameters.items())
+
+
+def compare(results: list[dict], baseline: dict, threshold: float) -> list[str]:
+  # Returns descriptions of every metric that got worse by more than the threshold
+  baseline_results = {result_key(x): x for x in baseline["results"]}
+  regressions = []
+  for result in results:
+    baseline_result = baseline_results.get(result_key(result))
+    if baseline_result is None:
+      continue
+    for metric, value in result["metrics"].items():
+      baseline_value = baseline_result["metrics"].get(metric)
+      if baseline_value is None or baseline_value == 0:
+        continue
+      change = (value - baseline_value) / abs(baseline_value)
+      print(f"  {result['benchmark']} {format_parameters(result['parameters'])} {metric}: {change:+.1%}")
+      worse_change = change if metric in lower_is_better else -change
+      if worse_change > threshold:
+        name = f"{result['benchmark']} {format_parameters(result['parameters'])} {metric}"
+        regressions.append(f"{name}: {baseline_value:.3f} -> {value:.3f}")
+  return regressions
+
+
+def main():
+  args = create_parser().parse_args()
+  results = []
+  for name, parameters, run in benchmark_cases(args):
+    if args.only is not None and name not in args.only:
+      continue
+    metrics = run()
+    results.append({"benchmark": name, "parameters": parameters, "metrics": metrics})
+    formatted_metrics = ", ".join(f"{key}={value:.3f}" for key, value in metrics.items())
+    print(f"{name} {format_parameters(parameters)}: {formatted_metrics}", flush=True)
+
+  report = {
+    "metadata": {
+      "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+      "python": sys.version,
+      "platform": platform.platform(),
+      "proxy_args": args.proxy_args,
+      "duration": args.duration,
+    },
+    "results": results,
+  }
+  if args.output is not None:
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2)
+
+  if args.baseline is not None:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    print(f"Compared to {args.baseline}:")
+    regressions = compare(results, baseline, args.regression_threshold)
+    if regressions:
+      print("Regressions:")
+      for regression in regressions:
+        print(f"  {regression}")
+      sys.exit(1)
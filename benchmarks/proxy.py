@@ -0,0 +1,73 @@
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# Time localhost-throttle has to start listening and to exit after Ctrl+C
+startup_timeout = 5.0
+shutdown_timeout = 5.0
+
+
+def _free_port() -> int:
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+    sock.bind(("localhost", 0))
+    return sock.getsockname()[1]
+
+
+class LocalhostThrottle:
+  # Runs localhost-throttle in a separate process, so that benchmark clients do not compete with it for the GIL
+  def __init__(self, server_port: int, protocol: str, *, extra_args=()):
+    self.server_port = server_port
+    self.protocol = protocol
+    self.extra_args = tuple(extra_args)
+    self.port = _free_port()
+    self._process = None
+
+  def _wait_until_listening(self):
+    if self.protocol == "udp":
+      # Nothing to connect to, so the process just gets time to bind its socket
+      time.sleep(0.5)
+      return
+    deadline = time.perf_counter() + startup_timeout
+    while True:
+      try:
+        with socket.create_connection(("localhost", self.port), timeout=startup_timeout):
+          return
+      except OSError:
+        if time.perf_counter() > deadline:
+          raise
+        time.sleep(0.05)
+
+  def __enter__(self):
+    args = [
+      sys.executable,
+      "-m",
+      "localhost_throttle",
+      "--server",
+      f"localhost:{self.server_port}",
+      "--new-server",
+      f"localhost:{self.port}",
+      "--protocols",
+      self.protocol,
+      "--log-level",
+      "warning",
+      *self.extra_args,
+    ]
+    creationflags = subprocess.CREATE_NEW_PROCESS_GROUP if sys.platform == "win32" else 0
+    self._process = subprocess.Popen(args, stdin=subprocess.DEVNULL, creationflags=creationflags)
+    try:
+      self._wait_until_listening()
+    except BaseException:
+      self._process.kill()
+      self._process.wait()
+      raise
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self._process.send_signal(signal.CTRL_BREAK_EVENT if sys.platform == "win32" else signal.SIGINT)
+    try:
+      self._process.wait(timeout=shutdown_timeout)
+    except subprocess.TimeoutExpired:
+      self._process.kill()
+      self._process.wait()
@@ -0,0 +1,144 @@
+import socket
+import statistics
+import threading
+import time
+
+from .proxy import LocalhostThrottle
+from .servers import TCPEchoServer, TCPSinkServer, UDPEchoServer
+
+# Datagrams a UDP client may have in flight, so that the benchmark measures the proxy and not socket buffer overflows
+udp_window = 32
+udp_reply_timeout = 0.5
+max_udp_payload_size = 65507
+
+
+def _run_clients(concurrency: int, client):
+  # Runs client(index) in concurrency threads and returns their results with the wall time they took together
+  results = [None] * concurrency
+  exceptions = []
+  start_barrier = threading.Barrier(concurrency + 1)
+
+  def run(index):
+    start_barrier.wait()
+    try:
+      results[index] = client(index)
+    except BaseException as e:
+      exceptions.append(e)
+
+  threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  start_barrier.wait()
+  start = time.perf_counter()
+  for thread in threads:
+    thread.join()
+  elapsed = time.perf_counter() - start
+  if exceptions:
+    raise exceptions[0]
+  return results, elapsed
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+  return statistics.quantiles(values, n=100, method="inclusive")[percentile - 1]
+
+
+def tcp_throughput(*, payload_size: int, concurrency: int, duration: float, extra_args=()) -> dict:
+  payload = b"x" * payload_size
+  with TCPSinkServer() as sink, LocalhostThrottle(sink.port, "tcp", extra_args=extra_args) as proxy:
+    # Connection that checked that the proxy is listening is not a part of the measurement
+    sink.wait_for_connections(1, timeout=duration + 10)
+    sink.received_bytes = 0
+
+    def client(_):
+      with socket.create_connection(("localhost", proxy.port)) as sock:
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+          sock.sendall(payload)
+
+    start = time.perf_counter()
+    _run_clients(concurrency, client)
+    sink.wait_for_connections(concurrency, timeout=duration + 10)
+    elapsed = time.perf_counter() - start
+  return {"mb_per_second": sink.received_bytes / elapsed / 1e6}
+
+
+def udp_packet_rate(*, payload_size: int, concurrency: int, duration: float, extra_args=()) -> dict:
+  payload = b"x" * payload_size
+  with UDPEchoServer() as echo, LocalhostThrottle(echo.port, "udp", extra_args=extra_args) as proxy:
+
+    def client(_):
+      sent = 0
+      received = 0
+      with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(udp_reply_timeout)
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+          for _ in range(udp_window):
+            sock.sendto(payload, ("localhost", proxy.port))
+          sent += udp_window
+          try:
+            for _ in range(udp_window):
+              sock.recv(payload_size)
+              received += 1
+          except TimeoutError:
+            pass
+      return sent, received
+
+    results, elapsed = _run_clients(concurrency, client)
+  sent = sum(x for x, _ in results)
+  received = sum(x for _, x in results)
+  return {
+    "packets_per_second": received / elapsed,
+    "mb_per_second": received * payload_size / elapsed / 1e6,
+    "loss_ratio": 1 - received / sent if sent > 0 else 0.0,
+  }
+
+
+def _round_trip_time(sock, payload: bytes, buffer) -> float:
+  start = time.perf_counter()
+  sock.sendall(payload)
+  received = 0
+  while received < len(payload):
+    received += sock.recv_into(memoryview(buffer)[received:])
+  return time.perf_counter() - start
+
+
+def tcp_added_latency(*, payload_size: int, samples: int, extra_args=()) -> dict:
+  # Round trips through the proxy are interleaved with round trips straight to the same echo server, so that both
+  # see the same load of the machine
+  payload = b"x" * payload_size
+  buffer = bytearray(payload_size)
+  direct = []
+  proxied = []
+  with TCPEchoServer() as echo, LocalhostThrottle(echo.port, "tcp", extra_args=extra_args) as proxy:
+    with socket.create_connection(("localhost", echo.port)) as direct_socket:
+      with socket.create_connection(("localhost", proxy.port)) as proxied_socket:
+        for sock in (direct_socket, proxied_socket):
+          sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for _ in range(samples):
+          direct.append(_round_trip_time(direct_socket, payload, buffer))
+          proxied.append(_round_trip_time(proxied_socket, payload, buffer))
+  return {
+    "p50_latency_ms": _percentile(proxied, 50) * 1e3,
+    "p99_latency_ms": _percentile(proxied, 99) * 1e3,
+    "p50_added_latency_ms": (_percentile(proxied, 50) - _percentile(direct, 50)) * 1e3,
+    "p99_added_latency_ms": (_percentile(proxied, 99) - _percentile(direct, 99)) * 1e3,
+  }
+
+
+def tcp_connection_rate(*, concurrency: int, duration: float, extra_args=()) -> dict:
+  with TCPEchoServer() as echo, LocalhostThrottle(echo.port, "tcp", extra_args=extra_args) as proxy:
+
+    def client(_):
+      connections = 0
+      deadline = time.perf_counter() + duration
+      while time.perf_counter() < deadline:
+        # A full round trip makes sure that the proxy connected to the server as well
+        with socket.create_connection(("localhost", proxy.port)) as sock:
+          sock.sendall(b"x")
+          sock.recv(1)
+        connections += 1
+      return connections
+
+    results, elapsed = _run_clients(concurrency, client)
+  return {"connections_per_second": sum(results) / elapsed}
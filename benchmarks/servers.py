@@ -0,0 +1,98 @@
+import contextlib
+import socket
+import threading
+
+
+class _Server:
+  def __init__(self, socket_type):
+    self.socket = socket.socket(socket.AF_INET, socket_type)
+    self.socket.bind(("localhost", 0))
+    self.port = self.socket.getsockname()[1]
+    self._threads = []
+
+  def _start_thread(self, target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    self._threads.append(thread)
+
+  def close(self):
+    with contextlib.suppress(OSError):
+      self.socket.shutdown(socket.SHUT_RDWR)
+    self.socket.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+class TCPServer(_Server):
+  # Serves every accepted connection with handle_connection() in a thread of its own
+  def __init__(self):
+    super().__init__(socket.SOCK_STREAM)
+    self.socket.listen(1024)
+    self._start_thread(self._accept_forever)
+
+  def _accept_forever(self):
+    while True:
+      try:
+        connection, _ = self.socket.accept()
+      except OSError:
+        return
+      self._start_thread(self._handle_and_close, connection)
+
+  def _handle_and_close(self, connection):
+    with connection, contextlib.suppress(OSError):
+      self.handle_connection(connection)
+
+  def handle_connection(self, connection):
+    raise NotImplementedError
+
+
+class TCPSinkServer(TCPServer):
+  def __init__(self):
+    self.received_bytes = 0
+    self._lock = threading.Lock()
+    self._finished_connections = threading.Semaphore(0)
+    super().__init__()
+
+  def handle_connection(self, connection):
+    buffer = bytearray(1 << 20)
+    received_bytes = 0
+    try:
+      while (data_length := connection.recv_into(buffer)) > 0:
+        received_bytes += data_length
+    finally:
+      with self._lock:
+        self.received_bytes += received_bytes
+      self._finished_connections.release()
+
+  def wait_for_connections(self, count: int, timeout: float) -> bool:
+    return all(self._finished_connections.acquire(timeout=timeout) for _ in range(count))
+
+
+class TCPEchoServer(TCPServer):
+  def handle_connection(self, connection):
+    buffer = bytearray(1 << 20)
+    while (data_length := connection.recv_into(buffer)) > 0:
+      connection.sendall(memoryview(buffer)[:data_length])
+
+
+class UDPEchoServer(_Server):
+  def __init__(self):
+    super().__init__(socket.SOCK_DGRAM)
+    self._start_thread(self._echo_forever)
+
+  def _echo_forever(self):
+    buffer = bytearray(65536)
+    while True:
+      try:
+        data_length, address = self.socket.recvfrom_into(buffer)
+        if address is None:
+          # Socket was shut down
+          return
+        self.socket.sendto(memoryview(buffer)[:data_length], address)
+      except OSError:
+        if self.socket.fileno() == -1:
+          return
@@ -1,5 +1,6 @@
+from .engine_type import Engine
 from .protocol_type import Protocol, ProtocolSet
 from .main import main
 from . import context_util
 
-__all__ = ["context_util", "main", "Protocol", "ProtocolSet"]
+__all__ = ["context_util", "main", "Engine", "Protocol", "ProtocolSet"]
@@ -0,0 +1,119 @@
+import threading
+import time
+
+from .bandwidth_trace import BandwidthTrace, TraceBucket
+from .direction_type import Direction
+from .hostname_and_port import address_host
+from .token_bucket import TokenBucket, create_token_bucket
+
+
+class LimiterChain:
+  def __init__(self, token_buckets: tuple[TokenBucket, ...]):
+    self.token_buckets = token_buckets
+
+  @property
+  def rate(self) -> float:
+    return min(token_bucket.rate for token_bucket in self.token_buckets)
+
+  def chunk_size(self, buffer_size: int) -> int:
+    for token_bucket in self.token_buckets:
+      buffer_size = token_bucket.chunk_size(buffer_size)
+    return buffer_size
+
+  def consume(self, amount: int) -> float:
+    time_to_wait = 0.0
+    for token_bucket in self.token_buckets:
+      time_to_wait = max(time_to_wait, token_bucket.consume(amount))
+    return time_to_wait
+
+
+class GlobalLimiter:
+  # Buckets of the budget shared by every listener of the process, one per direction. Created once and handed to the
+  # BandwidthLimiter of every listener
+  def __init__(self, bandwidth: float | None = None, burst: float | None = None):
+    self.bandwidth = bandwidth
+    self.burst = burst
+    self.token_buckets = {direction: create_token_bucket(bandwidth, burst) for direction in Direction}
+    self._lock = threading.Lock()
+
+  def set_bandwidth(self, bandwidth: float | None):
+    # Chains that already hold a bucket keep using it, so they follow its new rate right away
+    with self._lock:
+      self.bandwidth = bandwidth
+      for direction, token_bucket in self.token_buckets.items():
+        if bandwidth is None or token_bucket is None:
+          self.token_buckets[direction] = create_token_bucket(bandwidth, self.burst)
+        else:
+          token_bucket.set_rate(bandwidth, self.burst)
+
+
+class BandwidthLimiter:
+  # Every level is optional. Buckets of the shared levels are created once and looked up only when a connection or
+  # UDP session starts, so relays pay for a few TokenBucket.consume calls per chunk and nothing else.
+  def __init__(
+    self,
+    *,
+    bandwidth: float | None = None,
+    client_bandwidth: float | None = None,
+    global_limiter: GlobalLimiter | None = None,
+    burst: float | None = None,
+    bandwidth_trace: BandwidthTrace | None = None,
+  ):
+    if bandwidth is not None and bandwidth_trace is not None:
+      raise ValueError("Bandwidth and bandwidth trace are exclusive")
+    self.bandwidth = bandwidth
+    self.client_bandwidth = client_bandwidth
+    self.global_limiter = global_limiter if global_limiter is not None else GlobalLimiter()
+    self.burst = burst
+    self.bandwidth_trace = bandwidth_trace
+    # Every connection follows the trace from the moment the listener started, like on a shared link
+    self._trace_start = time.perf_counter()
+    self._client_token_buckets = dict()
+    self._lock = threading.Lock()
+
+  def _client_token_bucket(self, client_host: str, direction: Direction) -> TokenBucket | None:
+    if self.client_bandwidth is None:
+      return None
+    key = (client_host, direction)
+    with self._lock:
+      token_bucket = self._client_token_buckets.get(key)
+      if token_bucket is None:
+        token_bucket = TokenBucket(self.client_bandwidth, self.burst)
+        self._client_token_buckets[key] = token_bucket
+    return token_bucket
+
+  def create_token_bucket(self) -> TokenBucket | None:
+    # Bucket of a single connection or UDP session
+    if self.bandwidth_trace is not None:
+      return TraceBucket(self.bandwidth_trace, self.burst, start=self._trace_start)
+    return create_token_bucket(self.bandwidth, self.burst)
+
+  def assemble_chain(
+    self, client_address, direction: Direction, token_bucket: TokenBucket | None
+  ) -> LimiterChain | None:
+    token_buckets = (
+      token_bucket,
+      self._client_token_bucket(address_host(client_address), direction),
+      self.global_limiter.token_buckets[direction],
+    )
+    token_buckets = tuple(token_bucket for token_bucket in token_buckets if token_bucket is not None)
+    if not token_buckets:
+      return None
+    return LimiterChain(token_buckets)
+
+  def create_chain(self, client_address, direction: Direction) -> LimiterChain | None:
+    return self.assemble_chain(client_address, direction, self.create_token_bucket())
+
+  def set_bandwidth(self, bandwidth: float | None):
+    # A constant bandwidth replaces the trace for connections created from now on
+    self.bandwidth = bandwidth
+    self.bandwidth_trace = None
+
+  def set_client_bandwidth(self, client_bandwidth: float | None):
+    # Chains that already hold a client bucket keep using it, so they follow its new rate right away
+    with self._lock:
+      self.client_bandwidth = client_bandwidth
+      if client_bandwidth is None:
+        self._client_token_buckets.clear()
+      for token_bucket in self._client_token_buckets.values():
+        token_bucket.set_rate(client_bandwidth, self.burst)
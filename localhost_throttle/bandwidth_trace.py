@@ -0,0 +1,219 @@
+import array
+import threading
+import time
+
+from .token_bucket import default_burst_duration
+from .trace_end_type import TraceEnd
+
+# Bytes of one delivery opportunity of a mahimahi trace
+default_mtu = 1500
+
+
+class BandwidthTrace:
+  # Delivery curve of a link: bytes the link may have carried by every breakpoint, linear in between and starting at
+  # (0, 0). A step is two breakpoints at the same time. Arrays keep large traces compact and are shared by every
+  # connection that follows the trace
+  def __init__(
+    self, times: array.array, cumulative: array.array, *, end: TraceEnd = TraceEnd.LOOP, final_rate: float = 0.0
+  ):
+    if len(times) != len(cumulative) or len(times) < 2:
+      raise ValueError("Trace should have at least two points")
+    if times[0] != 0 or cumulative[0] != 0:
+      raise ValueError("Trace should start with no bytes at 0 seconds")
+    self.times = times
+    self.cumulative = cumulative
+    self.end = end
+    self.final_rate = final_rate
+    self.duration = times[-1]
+    self.total = cumulative[-1]
+    if self.duration <= 0:
+      raise ValueError(f"Trace should last longer than 0 seconds. Got: {self.duration}")
+    if end == TraceEnd.LOOP and self.total <= 0:
+      raise ValueError("Looped trace should deliver some bytes")
+    if end == TraceEnd.STOP and final_rate <= 0:
+      raise ValueError(f"Trace that stops should end with a positive rate, or the link stalls. Got: {final_rate}")
+
+  @property
+  def average_rate(self) -> float:
+    return self.total / self.duration
+
+  @staticmethod
+  def from_mahimahi(lines, *, end: TraceEnd = TraceEnd.LOOP, mtu: int = default_mtu):
+    # Every line is the millisecond of a delivery opportunity for one packet of mtu bytes, several packets may share a
+    # millisecond. The trace repeats after the last one, or keeps its average rate when it stops
+    times = array.array("d", [0.0])
+    cumulative = array.array("d", [0.0])
+    for line_number, line in enumerate(lines, start=1):
+      line = line.strip()
+      if not line:
+        continue
+      try:
+        timestamp = int(line) / 1000
+      except ValueError:
+        raise ValueError(f"Line {line_number}: expected milliseconds. Got: {line}") from None
+      if timestamp < times[-1]:
+        raise ValueError(f"Line {line_number}: timestamps should not decrease. Got: {line}")
+      if len(times) > 1 and times[-1] == timestamp:
+        cumulative[-1] += mtu
+        continue
+      if timestamp > times[-1]:
+        times.append(timestamp)
+        cumulative.append(cumulative[-1])
+      times.append(timestamp)
+      cumulative.append(cumulative[-1] + mtu)
+    duration = times[-1]
+    return BandwidthTrace(
+      times, cumulative, end=end, final_rate=cumulative[-1] / duration if duration > 0 else 0.0
+    )
+
+  @staticmethod
+  def from_csv(lines, *, end: TraceEnd = TraceEnd.LOOP):
+    # Every row is "seconds,bytes_per_second": the rate from that time until the next row. The last row ends the
+    # trace, its rate stays in effect when the trace stops. A header row is skipped
+    times = array.array("d")
+    cumulative = array.array("d")
+    first_time = None
+    rate = 0.0
+    for line_number, line in enumerate(lines, start=1):
+      line = line.split("#", maxsplit=1)[0].strip()
+      if not line:
+        continue
+      fields = line.split(",")
+      try:
+        if len(fields) != 2:
+          raise ValueError()
+        timestamp, next_rate = float(fields[0]), float(fields[1])
+      except ValueError:
+        if first_time is None:
+          first_time = 0.0
+          continue
+        raise ValueError(f"Line {line_number}: expected 'seconds,bytes_per_second'. Got: {line}") from None
+      if next_rate < 0:
+        raise ValueError(f"Line {line_number}: rate should not be negative. Got: {next_rate}")
+      if not times:
+        first_time = timestamp
+        times.append(0.0)
+        cumulative.append(0.0)
+      else:
+        timestamp -= first_time
+        if timestamp < times[-1]:
+          raise ValueError(f"Line {line_number}: timestamps should not decrease. Got: {line}")
+        times.append(timestamp)
+        cumulative.append(cumulative[-1] + rate * (timestamp - times[-2]))
+      rate = next_rate
+    return BandwidthTrace(times, cumulative, end=end, final_rate=rate)
+
+  @staticmethod
+  def load(path: str, *, end: TraceEnd = TraceEnd.LOOP):
+    with open(path, encoding="utf-8") as f:
+      if path.endswith(".csv"):
+        return BandwidthTrace.from_csv(f, end=end)
+      return BandwidthTrace.from_mahimahi(f, end=end)
+
+
+class _Cursor:
+  # Looks up a curve given by two arrays of breakpoints, keys and values, for keys that never decrease. The cursor
+  # only moves forward, so a lookup costs O(1) amortized. Past the end the curve repeats, growing by period_value per
+  # period_key, or continues with final_slope. Lookups of a key at a breakpoint return the earliest value if exclusive
+  def __init__(self, keys, values, *, period_key: float, period_value: float, loop: bool, final_slope: float, exclusive):
+    self.keys = keys
+    self.values = values
+    self.period_key = period_key
+    self.period_value = period_value
+    self.loop = loop
+    self.final_slope = final_slope
+    self.exclusive = exclusive
+    self._cycle = 0
+    self._index = 0
+
+  def lookup(self, key: float) -> float:
+    keys = self.keys
+    values = self.values
+    last = len(keys) - 1
+    if self.loop:
+      # Whole periods of idle time are skipped at once
+      cycle = int(key // self.period_key)
+      if self.exclusive and cycle > 0 and key == cycle * self.period_key:
+        cycle -= 1
+      if cycle > self._cycle:
+        self._cycle = cycle
+        self._index = 0
+    base_key = self._cycle * self.period_key
+    base_value = self._cycle * self.period_value
+    while True:
+      if self._index == last:
+        if not self.loop:
+          return values[last] + (key - keys[last]) * self.final_slope
+        self._cycle += 1
+        self._index = 0
+        base_key += self.period_key
+        base_value += self.period_value
+        continue
+      next_key = base_key + keys[self._index + 1]
+      if key > next_key or (key == next_key and not self.exclusive):
+        self._index += 1
+        continue
+      break
+    key_0 = base_key + keys[self._index]
+    value_0 = base_value + values[self._index]
+    if key <= key_0 or next_key == key_0:
+      return value_0
+    value_1 = base_value + values[self._index + 1]
+    return value_0 + (value_1 - value_0) * (key - key_0) / (next_key - key_0)
+
+
+class TraceBucket:
+  # Token bucket refilled along a trace instead of at a constant rate. Buckets of one limiter share the start, so all
+  # connections see the same state of the link at the same moment. Position is the number of bytes taken: a chunk
+  # waits until the trace has delivered it, and idle time is credited up to burst
+  def __init__(
+    self,
+    trace: BandwidthTrace,
+    burst: float | None = None,
+    *,
+    start: float | None = None,
+    clock=time.perf_counter,
+  ):
+    self.trace = trace
+    self.burst = burst if burst is not None else self.rate * default_burst_duration
+    self.clock = clock
+    self.start = start if start is not None else clock()
+    loop = trace.end == TraceEnd.LOOP
+    self._delivered = _Cursor(
+      trace.times,
+      trace.cumulative,
+      period_key=trace.duration,
+      period_value=trace.total,
+      loop=loop,
+      final_slope=trace.final_rate,
+      exclusive=False,
+    )
+    self._deadline = _Cursor(
+      trace.cumulative,
+      trace.times,
+      period_key=trace.total,
+      period_value=trace.duration,
+      loop=loop,
+      final_slope=1 / trace.final_rate if trace.final_rate > 0 else 0.0,
+      exclusive=True,
+    )
+    self._position = 0.0
+    self._lock = threading.Lock()
+
+  @property
+  def rate(self) -> float:
+    # Rate the link settles at in the long run
+    if self.trace.end == TraceEnd.STOP:
+      return self.trace.final_rate
+    return self.trace.average_rate
+
+  def chunk_size(self, buffer_size: int) -> int:
+    return max(1, min(buffer_size, int(self.burst)))
+
+  def consume(self, amount: int) -> float:
+    with self._lock:
+      now = max(0.0, self.clock() - self.start)
+      delivered = self._delivered.lookup(now)
+      self._position = max(self._position, delivered - self.burst) + amount
+      deadline = self._deadline.lookup(self._position)
+    return max(0.0, deadline - now)
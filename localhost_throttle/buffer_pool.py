@@ -0,0 +1,30 @@
+import contextlib
+import threading
+
+
+class BufferPool:
+  def __init__(self, buffer_size: int, *, max_idle_buffers: int = 256):
+    self.buffer_size = buffer_size
+    self.max_idle_buffers = max_idle_buffers
+    self._idle_buffers = []
+    self._lock = threading.Lock()
+
+  def acquire(self) -> bytearray:
+    with self._lock:
+      if self._idle_buffers:
+        return self._idle_buffers.pop()
+    return bytearray(self.buffer_size)
+
+  def release(self, buffer: bytearray):
+    with self._lock:
+      if len(self._idle_buffers) < self.max_idle_buffers:
+        self._idle_buffers.append(buffer)
+
+  @contextlib.contextmanager
+  def buffer(self):
+    buffer = self.acquire()
+    try:
+      with memoryview(buffer) as view:
+        yield view
+    finally:
+      self.release(buffer)
@@ -0,0 +1,71 @@
+import contextlib
+import socket
+
+from .bandwidth_limiter import LimiterChain
+
+# Every direction of a TCP connection holds a buffer of this size for its whole life, so a larger default would cost
+# memory per connection. --buffer-size raises it for fast links with few connections
+default_buffer_size = 65536
+# Reads start at this size and do not shrink below it, unless limits let less through at once
+min_chunk_size = 4096
+# Kernel buffers of a throttled relay hold this many seconds of data at its rate, so the peers feel the limit instead
+# of filling large buffers at full speed
+socket_buffer_duration = 0.25
+min_socket_buffer_size = 16384
+# Kernel clamps larger sizes anyway, setsockopt() refuses sizes beyond a C int
+max_socket_buffer_size = 2**24
+
+
+class ChunkSizer:
+  # Size of the next read of one direction of a TCP connection. It follows the observed throughput: a read that fills
+  # the chunk doubles it up to max_size, a read of less than a quarter of it halves it. Limits cut the chunk further
+  # to what they let through at once, so slow relays release data in small, smooth slices
+  def __init__(self, max_size: int, *, min_size: int = min_chunk_size):
+    self.max_size = max_size
+    self.min_size = min(min_size, max_size)
+    self.size = self.min_size
+
+  def next_size(self, limiter_chain: LimiterChain | None) -> int:
+    if limiter_chain is None:
+      return self.size
+    return limiter_chain.chunk_size(self.size)
+
+  def record(self, requested: int, received: int):
+    # A read cut by the limits says nothing about how much data was waiting
+    if received >= self.size:
+      self.size = min(self.max_size, self.size * 2)
+    elif received < requested and received < self.size // 4:
+      self.size = max(self.min_size, self.size // 2)
+
+
+def socket_buffer_size(limiter_chain: LimiterChain | None) -> int | None:
+  if limiter_chain is None:
+    return None
+  return int(min(max_socket_buffer_size, max(min_socket_buffer_size, limiter_chain.rate * socket_buffer_duration)))
+
+
+class SocketBuffers:
+  # Receive buffer of the socket a relay reads from and send buffer of the one it writes to, sized for the rate of its
+  # limits. Sizes from before are restored when the limits are lifted. Linux reports twice the size that was set, so
+  # restored buffers are never smaller than the original ones
+  def __init__(self, in_socket, out_socket):
+    self.in_socket = in_socket
+    self.out_socket = out_socket
+    self._size = None
+    self._original_sizes = None
+
+  def update(self, limiter_chain: LimiterChain | None):
+    size = socket_buffer_size(limiter_chain)
+    if size == self._size:
+      return
+    # Kernel may refuse or clamp the sizes, which only costs smoothness
+    with contextlib.suppress(OSError):
+      if self._original_sizes is None:
+        self._original_sizes = (
+          self.in_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+          self.out_socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+        )
+      receive_size, send_size = (size, size) if size is not None else self._original_sizes
+      self.in_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_size)
+      self.out_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_size)
+    self._size = size
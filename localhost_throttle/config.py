@@ -0,0 +1,62 @@
+import argparse
+import json
+import sys
+
+# Options of the whole process. They may be set on the command line or at the top level of the config, but not for a
+# single listener
+process_options = frozenset(
+  ["config", "metrics-address", "control-socket", "poll-interval", "log-level", "max-workers", "global-bandwidth"]
+)
+
+
+def load_config(path: str) -> dict:
+  if path.endswith(".toml"):
+    if sys.version_info < (3, 11):
+      raise ValueError("TOML config requires Python 3.11 or newer, use JSON instead")
+    import tomllib
+
+    with open(path, "rb") as f:
+      config = tomllib.load(f)
+  else:
+    with open(path, encoding="utf-8") as f:
+      config = json.load(f)
+  if not isinstance(config, dict):
+    raise ValueError(f"Config should be a table of options. Got: {type(config).__name__}")
+  listeners = config.get("listeners")
+  if not isinstance(listeners, list) or not listeners:
+    raise ValueError('Config should declare at least one listener in "listeners"')
+  if not all(isinstance(x, dict) for x in listeners):
+    raise ValueError("Every listener should be a table of options")
+  return config
+
+
+def to_arguments(options: dict) -> list[str]:
+  # Keys are names of command line options, "_" may be used instead of "-". Lists are joined with ",", true adds a flag
+  # and false or null leave the option out
+  arguments = []
+  for key, value in options.items():
+    option = f"--{key.replace('_', '-')}"
+    if value is True:
+      arguments.append(option)
+    elif value is False or value is None:
+      continue
+    elif isinstance(value, list):
+      arguments.extend([option, ",".join(str(x) for x in value)])
+    else:
+      arguments.extend([option, str(value)])
+  return arguments
+
+
+def parse_config(
+  config: dict, parser: argparse.ArgumentParser, argv: list[str]
+) -> tuple[argparse.Namespace, list[argparse.Namespace]]:
+  # Every listener is parsed like a command line made of the top level of the config, argv and its own options, so the
+  # later ones take precedence. Returns the options of the process and of every listener
+  common_arguments = to_arguments({x: y for x, y in config.items() if x != "listeners"}) + argv
+  listeners = []
+  for index, listener in enumerate(config["listeners"]):
+    for key in listener:
+      if key.replace("_", "-") in process_options:
+        raise ValueError(f"Listener {index}: '{key}' applies to the whole process and cannot be set per listener")
+    listeners.append(parser.parse_args(common_arguments + to_arguments(listener)))
+  return parser.parse_args(common_arguments), listeners
@@ -0,0 +1,222 @@
+import contextlib
+import itertools
+import logging
+import threading
+
+from .bandwidth_limiter import BandwidthLimiter, GlobalLimiter
+from .direction_type import Direction
+from .hostname_and_port import HostnameAndPort, format_address
+from .latency import LatencyEmulator
+from .protocol_type import Protocol, ProtocolSet
+from .relay_control import RelayControl
+
+# Options the control API changes for the whole process, for a whole listener and for a single connection
+process_wide_options = ("global-bandwidth",)
+listener_options = ("bandwidth", "client-bandwidth", "latency", "jitter")
+connection_options = ("bandwidth", "latency", "jitter")
+
+_connection_ids = itertools.count(1)
+
+
+class LiveConnection:
+  # A TCP connection or UDP session as the control API sees it. close may be called from any thread
+  def __init__(self, protocol: Protocol, client_address, backend, relays: dict[Direction, RelayControl], *, close):
+    self.id = next(_connection_ids)
+    self.protocol = protocol
+    self.client_address = client_address
+    self.backend = backend
+    self.relays = relays
+    self.close = close
+
+  def set_limits(self, options: dict, *, bandwidth_limiter: BandwidthLimiter, latency_emulator: LatencyEmulator):
+    for relay in self.relays.values():
+      if "bandwidth" in options:
+        relay.set_bandwidth(options["bandwidth"], bandwidth_limiter=bandwidth_limiter)
+      else:
+        relay.refresh_chain(bandwidth_limiter=bandwidth_limiter)
+      if "latency" in options or "jitter" in options:
+        relay.set_delay(
+          latency=options.get("latency", relay.latency),
+          jitter=options.get("jitter", relay.jitter),
+          latency_emulator=latency_emulator,
+        )
+
+  def to_json(self) -> dict:
+    # Both directions are always changed together, so the client to server one stands for the connection
+    relay = self.relays[Direction.CLIENT_TO_SERVER]
+    return {
+      "id": self.id,
+      "protocol": str(self.protocol),
+      "client": format_address(self.client_address),
+      "server": str(self.backend),
+      "bytes": {str(direction): x.bytes for direction, x in self.relays.items()},
+      "bandwidth": relay.bandwidth,
+      "latency": relay.latency,
+      "jitter": relay.jitter,
+    }
+
+
+class ListenerControl:
+  # Live connections and limits of one listener
+  def __init__(
+    self,
+    index: int,
+    new_server_address: HostnameAndPort,
+    protocols: ProtocolSet,
+    *,
+    bandwidth_limiter: BandwidthLimiter,
+    latency_emulator: LatencyEmulator,
+  ):
+    self.index = index
+    self.new_server_address = new_server_address
+    self.protocols = protocols
+    self.bandwidth_limiter = bandwidth_limiter
+    self.latency_emulator = latency_emulator
+    self._connections = dict()
+    self._lock = threading.Lock()
+
+  def create_relays(self, client_address, protocol: Protocol) -> dict[Direction, RelayControl]:
+    return {
+      direction: RelayControl.create(
+        client_address,
+        direction,
+        protocol,
+        bandwidth_limiter=self.bandwidth_limiter,
+        latency_emulator=self.latency_emulator,
+      )
+      for direction in Direction
+    }
+
+  def add(self, connection: LiveConnection):
+    with self._lock:
+      self._connections[connection.id] = connection
+
+  def remove(self, connection: LiveConnection):
+    with self._lock:
+      self._connections.pop(connection.id, None)
+
+  @contextlib.contextmanager
+  def connection(self, protocol: Protocol, client_address, backend, relays: dict[Direction, RelayControl], *, close):
+    connection = LiveConnection(protocol, client_address, backend, relays, close=close)
+    self.add(connection)
+    try:
+      yield connection
+    finally:
+      self.remove(connection)
+
+  def get(self, connection_id: int) -> LiveConnection | None:
+    with self._lock:
+      return self._connections.get(connection_id)
+
+  def connections(self) -> list[LiveConnection]:
+    with self._lock:
+      return list(self._connections.values())
+
+  def set_limits(self, options: dict):
+    # New connections get the new limits and live ones are updated, including those changed one by one
+    if "bandwidth" in options:
+      self.bandwidth_limiter.set_bandwidth(options["bandwidth"])
+    if "client-bandwidth" in options:
+      self.bandwidth_limiter.set_client_bandwidth(options["client-bandwidth"])
+    if "latency" in options:
+      self.latency_emulator.latency = options["latency"]
+    if "jitter" in options:
+      self.latency_emulator.jitter = options["jitter"]
+    for connection in self.connections():
+      self.set_connection_limits(connection, {x: y for x, y in options.items() if x in connection_options})
+
+  def set_connection_limits(self, connection: LiveConnection, options: dict):
+    connection.set_limits(options, bandwidth_limiter=self.bandwidth_limiter, latency_emulator=self.latency_emulator)
+
+  def to_json(self) -> dict:
+    return {
+      "listener": self.index,
+      "new-server": str(self.new_server_address),
+      "protocols": str(self.protocols),
+      "bandwidth": self.bandwidth_limiter.bandwidth,
+      "client-bandwidth": self.bandwidth_limiter.client_bandwidth,
+      "latency": self.latency_emulator.latency,
+      "jitter": self.latency_emulator.jitter,
+      "connections": [x.to_json() for x in self.connections()],
+    }
+
+
+def _parse_options(request: dict, allowed: tuple[str, ...]) -> dict:
+  # Bandwidth of null is unlimited, delay of null is none
+  options = dict()
+  for key, value in request.items():
+    key = key.replace("_", "-")
+    if key in ("command", "listener", "connection"):
+      continue
+    if key not in allowed:
+      raise ValueError(f"Unknown option {key!r}. Supported: {', '.join(allowed)}")
+    if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+      raise ValueError(f"Option {key!r} should be a number or null. Got: {value!r}")
+    if key.endswith("bandwidth"):
+      if value is not None and value <= 0:
+        raise ValueError(f"Option {key!r} should be positive or null. Got: {value}")
+      options[key] = float(value) if value is not None else None
+    else:
+      if value is not None and value < 0:
+        raise ValueError(f"Option {key!r} should not be negative. Got: {value}")
+      options[key] = float(value) if value is not None else 0.0
+  if not options:
+    raise ValueError(f"Nothing to set. Supported options: {', '.join(allowed)}")
+  return options
+
+
+class Control:
+  # Handles requests of the control API. A request is a JSON object with a "command":
+  #   {"command": "list"}
+  #   {"command": "set", "bandwidth": 1000, "latency": 0.1}                   every listener
+  #   {"command": "set", "global-bandwidth": 100000}                          budget of the whole process
+  #   {"command": "set", "listener": 0, "client-bandwidth": null}             one listener
+  #   {"command": "set", "connection": 7, "bandwidth": 1000}                  one TCP connection or UDP session
+  #   {"command": "kill", "connection": 7}
+  def __init__(self, listeners: list[ListenerControl], *, global_limiter: GlobalLimiter):
+    self.listeners = listeners
+    self.global_limiter = global_limiter
+
+  def _find_connection(self, connection_id) -> tuple[ListenerControl, LiveConnection]:
+    for listener in self.listeners:
+      connection = listener.get(connection_id)
+      if connection is not None:
+        return listener, connection
+    raise ValueError(f"No connection with id {connection_id!r}")
+
+  def _find_listener(self, index) -> ListenerControl:
+    if isinstance(index, bool) or not isinstance(index, int) or not 0 <= index < len(self.listeners):
+      raise ValueError(f"No listener with index {index!r}")
+    return self.listeners[index]
+
+  def handle(self, request) -> dict:
+    if not isinstance(request, dict):
+      raise ValueError(f"Request should be a JSON object. Got: {request!r}")
+    command = request.get("command")
+    match command:
+      case "list":
+        return {
+          "ok": True,
+          "global-bandwidth": self.global_limiter.bandwidth,
+          "listeners": [x.to_json() for x in self.listeners],
+        }
+      case "set" if "connection" in request:
+        listener, connection = self._find_connection(request["connection"])
+        listener.set_connection_limits(connection, _parse_options(request, connection_options))
+      case "set" if "listener" in request:
+        listener = self._find_listener(request["listener"])
+        listener.set_limits(_parse_options(request, listener_options))
+      case "set":
+        options = _parse_options(request, process_wide_options + listener_options)
+        if "global-bandwidth" in options:
+          self.global_limiter.set_bandwidth(options.pop("global-bandwidth"))
+        # Live connections pick up global buckets that were created or dropped even when nothing else changes
+        for listener in self.listeners:
+          listener.set_limits(options)
+      case "kill":
+        _, connection = self._find_connection(request.get("connection"))
+        logging.info(f"Closing {connection.protocol} connection of {connection.client_address} on request")
+        connection.close()
+      case _:
+        raise ValueError(f"Unknown command {command!r}. Supported: 'list', 'set', 'kill'")
+    return {"ok": True}
@@ -0,0 +1,59 @@
+import json
+import logging
+import socket
+
+from .context_util import RunFinally, RunIfException
+from .control import Control
+from .global_state import GlobalState
+from .hostname_and_port import remove_socket_file, remove_stale_socket_file
+
+# A client that stops sending requests or reading responses must not block the control API forever
+client_timeout = 5.0
+max_request_size = 65536
+
+
+def _handle_line(line: bytes, *, control: Control) -> dict:
+  try:
+    return control.handle(json.loads(line))
+  except (ValueError, TypeError) as e:
+    return {"ok": False, "error": str(e)}
+
+
+def _serve_client(client_socket, *, control: Control, global_state: GlobalState):
+  # Every line is a JSON request answered with a line of JSON
+  client_socket.settimeout(client_timeout)
+  pending = b""
+  while global_state.wait_readable([client_socket], timeout=client_timeout):
+    data = client_socket.recv(max_request_size)
+    if not data:
+      return
+    *lines, pending = (pending + data).split(b"\n")
+    if len(pending) > max_request_size:
+      raise ValueError(f"Control request is longer than {max_request_size} bytes")
+    for line in lines:
+      if line.strip():
+        client_socket.sendall(json.dumps(_handle_line(line, control=control)).encode("utf-8") + b"\n")
+
+
+def serve_control(path: str, *, control: Control, global_state: GlobalState):
+  # Requests are rare and cheap, so clients are served one at a time by this thread
+  if not hasattr(socket, "AF_UNIX"):
+    raise RuntimeError("Control API needs Unix sockets, which are not available on this platform")
+  remove_stale_socket_file(path)
+  server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  with RunIfException(lambda: server_socket.close()):
+    global_state.add_socket(server_socket)
+  with RunFinally(lambda: global_state.close_socket(server_socket)):
+    server_socket.bind(path)
+    with RunFinally(lambda: remove_socket_file(path)):
+      server_socket.listen()
+      logging.info(f"Serving control API on {path}")
+      while global_state.wait_readable([server_socket]):
+        client_socket, _ = server_socket.accept()
+        with RunIfException(lambda: client_socket.close()):
+          global_state.add_socket(client_socket)
+        with RunFinally(lambda: global_state.close_socket(client_socket)):
+          try:
+            _serve_client(client_socket, control=control, global_state=global_state)
+          except (OSError, ValueError) as e:
+            logging.debug(f"Control client failed:\n{e!r}")
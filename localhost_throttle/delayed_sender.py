@@ -0,0 +1,125 @@
+import collections
+import functools
+import socket
+import threading
+import time
+
+from .global_state import wait_for_sockets
+from .latency import DelayLine, LatencyEmulator
+
+# Bytes of one direction of a TCP connection that were read but not sent yet. The relay stops reading at this many,
+# so a peer that does not read holds at most this much memory. It also caps a delayed direction at
+# max_delayed_bytes / latency bytes per second
+default_max_delayed_bytes = 2**24
+# A socket that took nothing is tried again after this long, twice as long after every further try up to the maximum
+min_retry_interval = 0.001
+max_retry_interval = 0.05
+# Without MSG_DONTWAIT, i.e. on Windows, a writable socket is sent at most this much at once, which it takes right away
+fallback_send_size = 4096
+
+
+def send_without_blocking(sock, data) -> int:
+  # Returns how much the socket took, 0 when its send buffer is full
+  if hasattr(socket, "MSG_DONTWAIT"):
+    try:
+      return sock.send(data, socket.MSG_DONTWAIT)
+    except (BlockingIOError, InterruptedError):
+      return 0
+  _, writable = wait_for_sockets([], [sock], 0)
+  if not writable:
+    return 0
+  return sock.send(data[:fallback_send_size])
+
+
+class DelayedSender:
+  # Sends the delayed chunks of one direction of a TCP connection. Chunks are released by the delay scheduler thread,
+  # which serves every connection and so never blocks on a socket: what the socket does not take stays in the backlog
+  # of this connection and is tried again later. The relay calls wait_for_room() before every read, so at most
+  # max_bytes are in flight. on_finish is called once the stream was shut down or sending failed
+  def __init__(
+    self,
+    out_socket,
+    *,
+    latency_emulator: LatencyEmulator,
+    on_finish,
+    max_bytes: int = default_max_delayed_bytes,
+    clock=time.perf_counter,
+  ):
+    self.out_socket = out_socket
+    self.latency_emulator = latency_emulator
+    self.on_finish = on_finish
+    self.max_bytes = max_bytes
+    self.clock = clock
+    self.bytes_in_flight = 0
+    self._backlog = collections.deque()
+    self._shutdown_pending = False
+    self._is_finished = False
+    self._retry_is_scheduled = False
+    self._retry_interval = min_retry_interval
+    self._condition = threading.Condition()
+
+  def send(self, data: bytes, delay_line: DelayLine):
+    with self._condition:
+      self.bytes_in_flight += len(data)
+    self.latency_emulator.schedule(delay_line, functools.partial(self._release, data))
+
+  def shutdown(self, delay_line: DelayLine):
+    # Data that is still in flight reaches the peer before the end of the stream
+    self.latency_emulator.schedule(delay_line, functools.partial(self._release, None))
+
+  def wait_for_room(self, timeout: float) -> bool:
+    # Returns False if max_bytes are still in flight after timeout
+    with self._condition:
+      return self._condition.wait_for(lambda: self.bytes_in_flight < self.max_bytes or self._is_finished, timeout)
+
+  def _release(self, data: bytes | None):
+    with self._condition:
+      if self._is_finished:
+        return
+      if data is None:
+        self._shutdown_pending = True
+      else:
+        self._backlog.append(memoryview(data))
+      self._flush()
+
+  def _retry(self):
+    with self._condition:
+      self._retry_is_scheduled = False
+      if not self._is_finished:
+        self._flush()
+
+  def _finish(self):
+    self._is_finished = True
+    self._backlog.clear()
+    self.bytes_in_flight = 0
+    self._condition.notify_all()
+    self.on_finish()
+
+  def _flush(self):
+    # Called with the lock held. Chunks leave the backlog in order, whichever thread sends them
+    sent_total = 0
+    try:
+      while self._backlog:
+        sent = send_without_blocking(self.out_socket, self._backlog[0])
+        if sent == 0:
+          break
+        sent_total += sent
+        if sent == len(self._backlog[0]):
+          self._backlog.popleft()
+        else:
+          self._backlog[0] = self._backlog[0][sent:]
+      if not self._backlog and self._shutdown_pending:
+        self.out_socket.shutdown(socket.SHUT_RDWR)
+        self._finish()
+        return
+    except (OSError, ValueError):
+      self._finish()
+      return
+    if sent_total > 0:
+      self.bytes_in_flight -= sent_total
+      self._retry_interval = min_retry_interval
+      self._condition.notify_all()
+    if self._backlog and not self._retry_is_scheduled:
+      self._retry_is_scheduled = True
+      self.latency_emulator.delay_scheduler.schedule(self.clock() + self._retry_interval, self._retry)
+      self._retry_interval = min(max_retry_interval, self._retry_interval * 2)
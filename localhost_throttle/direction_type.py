@@ -0,0 +1,14 @@
+import enum
+
+
+@enum.unique
+class Direction(enum.Enum):
+  CLIENT_TO_SERVER = enum.auto()
+  SERVER_TO_CLIENT = enum.auto()
+
+  def __str__(self):
+    match self:
+      case Direction.CLIENT_TO_SERVER:
+        return "client_to_server"
+      case Direction.SERVER_TO_CLIENT:
+        return "server_to_client"
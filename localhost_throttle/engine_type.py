@@ -0,0 +1,25 @@
+import enum
+
+
+@enum.unique
+class Engine(enum.Enum):
+  THREADS = enum.auto()
+  ASYNCIO = enum.auto()
+
+  @staticmethod
+  def from_string(str):
+    str = str.lower()
+    match str:
+      case "threads":
+        return Engine.THREADS
+      case "asyncio":
+        return Engine.ASYNCIO
+      case _:
+        raise ValueError(f"'{str}' is not a valid Engine. Only 'threads' and 'asyncio' are supported")
+
+  def __str__(self):
+    match self:
+      case Engine.THREADS:
+        return "threads"
+      case Engine.ASYNCIO:
+        return "asyncio"
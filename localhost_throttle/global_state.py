@@ -1,178 +1,273 @@
-import logging
+import collections
+import contextlib
 import functools
+import itertools
+import logging
+import math
+import select
+import socket
+import sys
 import threading
 from concurrent.futures import Future
-from collections import defaultdict
 
 from .context_util import RunIfException
 
+registry_shard_count = 16
 
-class GlobalState:
+
+def wait_for_sockets(readable_sockets, writable_sockets, timeout=None) -> tuple[list, list]:
+  # Returns the readable and the writable sockets. select() cannot watch descriptors from FD_SETSIZE (1024) on, which a
+  # busy proxy reaches, so it is used only where poll() is missing, i.e. on Windows. Errors and hang-ups count as ready,
+  # so a socket that failed to connect is reported as writable. Windows tells about those only among exceptional
+  # conditions
+  if not hasattr(select, "poll"):
+    readable, writable, exceptional = select.select(readable_sockets, writable_sockets, writable_sockets, timeout)
+    return readable, list({*writable, *exceptional})
+  poller = select.poll()
+  events_by_socket = collections.defaultdict(int)
+  for sock in readable_sockets:
+    events_by_socket[sock] |= select.POLLIN
+  for sock in writable_sockets:
+    events_by_socket[sock] |= select.POLLOUT
+  sockets_by_fd = dict()
+  for sock, events in events_by_socket.items():
+    poller.register(sock, events)
+    sockets_by_fd[sock.fileno()] = sock
+  ready_events = poller.poll(None if timeout is None else max(0, math.ceil(timeout * 1000)))
+  readable, writable = [], []
+  for fd, event in ready_events:
+    sock = sockets_by_fd[fd]
+    failed = event & (select.POLLERR | select.POLLHUP | select.POLLNVAL)
+    if events_by_socket[sock] & select.POLLIN and (event & select.POLLIN or failed):
+      readable.append(sock)
+    if events_by_socket[sock] & select.POLLOUT and (event & select.POLLOUT or failed):
+      writable.append(sock)
+  return readable, writable
+
+
+class _RegistryShard:
   def __init__(self):
-    current_thread = threading.current_thread()
-    self.total_threads_spawned = 0
-    self.thread_id_to_thread = {self.total_threads_spawned: (None, current_thread)}
-    self.thread_ident_to_thread_id = {current_thread.ident: self.total_threads_spawned}
-    self.total_threads_spawned += 1
+    self.lock = threading.Lock()
+    self.items = dict()
 
-    self.spawned_threads = []
-    self.finished_threads = []
 
-    self.total_sockets_created = 0
-    self.socket_id_to_socket_and_thread_id = dict()
-    self.socket_to_socket_id = dict()
-    self.thread_id_to_sockets = defaultdict(lambda: set())
+class _Registry:
+  # Map split into independently locked shards, so threads registering different keys rarely wait for each other
+  def __init__(self, shard_count: int = registry_shard_count):
+    self._shards = tuple(_RegistryShard() for _ in range(shard_count))
 
-    self.added_sockets = []
-    self.closed_sockets = []
+  def _shard(self, key) -> _RegistryShard:
+    return self._shards[hash(key) % len(self._shards)]
 
-    self.lock = threading.Lock()
+  def add(self, key, value):
+    shard = self._shard(key)
+    with shard.lock:
+      shard.items[key] = value
+
+  def pop(self, key, default=None):
+    shard = self._shard(key)
+    with shard.lock:
+      return shard.items.pop(key, default)
+
+  def items(self) -> list:
+    result = []
+    for shard in self._shards:
+      with shard.lock:
+        result.extend(shard.items.items())
+    return result
+
+  def __len__(self):
+    return sum(len(shard.items) for shard in self._shards)
+
+
+class GlobalState:
+  # Registration takes only the lock of one shard. Lists of events exist only to be logged by monitor_forever,
+  # so they are collected only when debug logging is enabled
+  def __init__(self, *, collect_events: bool | None = None):
+    if collect_events is None:
+      collect_events = logging.getLogger().isEnabledFor(logging.DEBUG)
+    self.collect_events = collect_events
+    self._thread_ids = itertools.count()
+    self._socket_ids = itertools.count()
+    self._local = threading.local()
+
+    self.threads = _Registry()
+    self.sockets = _Registry()
+    self._local.thread_id = next(self._thread_ids)
+    self.threads.add(self._local.thread_id, (None, threading.current_thread()))
+
+    self.events = collections.deque()
     self.condition = threading.Condition()
     self._is_shutdown = threading.Event()
+    self._shutdown_callbacks = []
+    self._shutdown_lock = threading.Lock()
+    # Byte written on shutdown is never read, so the receiving end stays readable for every waiter
+    self._shutdown_receiver, self._shutdown_sender = socket.socketpair()
+
+  def _add_event(self, *event):
+    if not self.collect_events:
+      return
+    self.events.append(event)
+    self.notify_monitor()
 
   def _wrap_function(self, f, args, kwargs, *, thread_id):
     future = Future()
 
     @functools.wraps(f)
     def wrapped_function():
+      self._local.thread_id = thread_id
       try:
         result = f(*args, **kwargs)
         future.set_result(result)
       except BaseException as e:
         future.set_exception(e)
-
-    future.add_done_callback(lambda _: self._notify_finished_thread(thread_id))
+      finally:
+        self.threads.pop(thread_id)
+        self._add_event("Finished thread", thread_id, future)
 
     return future, wrapped_function
 
   def add_thread(self, *, f, args=(), kwargs=None, daemon=None, group=None, name=None):
-    with self:
-      thread_id = self.total_threads_spawned
-      self.total_threads_spawned += 1
-      extra_kwargs = {"global_state": self}
-      kwargs = kwargs if kwargs is not None else dict()
-      for key in extra_kwargs:
-        if key in kwargs:
-          raise ValueError(
-            f"Passing keys {list(extra_kwargs.keys())} is prohibited to kwargs. They will be passed by ResourceMonitor instead"
-          )
-      kwargs.update(extra_kwargs)
-      future, f = self._wrap_function(f, args, kwargs, thread_id=thread_id)
-      thread = threading.Thread(target=f, daemon=daemon, group=group, name=name)
-      self.thread_id_to_thread[thread_id] = (future, thread)
+    thread_id = next(self._thread_ids)
+    extra_kwargs = {"global_state": self}
+    kwargs = kwargs if kwargs is not None else dict()
+    for key in extra_kwargs:
+      if key in kwargs:
+        raise ValueError(
+          f"Passing keys {list(extra_kwargs.keys())} is prohibited to kwargs. They will be passed by ResourceMonitor instead"
+        )
+    kwargs.update(extra_kwargs)
+    future, f = self._wrap_function(f, args, kwargs, thread_id=thread_id)
+    thread = threading.Thread(target=f, daemon=daemon, group=group, name=name)
+    self.threads.add(thread_id, (future, thread))
+    with RunIfException(lambda: self.threads.pop(thread_id)):
       thread.start()
-      self.thread_ident_to_thread_id[thread.ident] = thread_id
-      self.spawned_threads.append(thread_id)
-      self.notify_monitor()
-      return thread
+    self._add_event("Spawned thread", thread_id)
+    return thread
 
   def add_socket(self, sock):
-    with self:
-      socket_id = self.total_sockets_created
-      self.total_sockets_created += 1
-      thread_id = self.thread_ident_to_thread_id[threading.get_ident()]
-      self.socket_id_to_socket_and_thread_id[socket_id] = sock, thread_id
-      self.socket_to_socket_id[sock] = socket_id
-      self.thread_id_to_sockets[thread_id].add(socket_id)
-      self.added_sockets.append(socket_id)
-      self.notify_monitor()
-
-  def _close_socket(self, socket_id):
-    sock, thread_id = self.socket_id_to_socket_and_thread_id[socket_id]
-    sock.close()
-    del self.socket_id_to_socket_and_thread_id[socket_id]
-    del self.socket_to_socket_id[sock]
-    opened_sockets_by_thread = self.thread_id_to_sockets[thread_id]
-    opened_sockets_by_thread.remove(socket_id)
-    if not opened_sockets_by_thread:
-      del self.thread_id_to_sockets[thread_id]
-    self.closed_sockets.append(socket_id)
-    self.notify_monitor()
+    socket_id = next(self._socket_ids)
+    self.sockets.add(sock, (socket_id, getattr(self._local, "thread_id", None)))
+    self._add_event("Added socket", socket_id)
 
   def close_socket(self, sock):
-    with self:
-      socket_id = self.socket_to_socket_id[sock]
-      self._close_socket(socket_id)
+    sock.close()
+    # Socket may already have been closed by close_all_sockets() during shutdown
+    socket_id_and_thread_id = self.sockets.pop(sock)
+    if socket_id_and_thread_id is not None:
+      self._add_event("Closed socket", socket_id_and_thread_id[0])
 
-  def _join_thread(self, thread_id):
-    _, thread = self.thread_id_to_thread[thread_id]
-    thread_ident = thread.ident
-    thread.join()
-    del self.thread_id_to_thread[thread_id]
-    del self.thread_ident_to_thread_id[thread_ident]
+  def close_all_sockets(self):
+    for sock, _ in self.sockets.items():
+      self.close_socket(sock)
 
   def notify_monitor(self):
     with self.condition:
       self.condition.notify_all()
 
-  def _notify_finished_thread(self, thread_id):
-    with self:
-      self.finished_threads.append(thread_id)
-      self.notify_monitor()
-
   def shutdown(self):
-    self._is_shutdown.set()
+    with self._shutdown_lock:
+      if self._is_shutdown.is_set():
+        return
+      self._is_shutdown.set()
+      callbacks = self._shutdown_callbacks
+      self._shutdown_callbacks = []
+    self._shutdown_sender.send(b"\0")
+    for callback in callbacks:
+      callback()
 
   def is_shutdown(self):
-    return self._is_shutdown.isSet()
+    return self._is_shutdown.is_set()
+
+  def on_shutdown(self, callback):
+    with self._shutdown_lock:
+      if not self._is_shutdown.is_set():
+        self._shutdown_callbacks.append(callback)
+        return
+    callback()
+
+  def wait_for_shutdown(self, timeout=None) -> bool:
+    return self._is_shutdown.wait(timeout)
+
+  def wait_readable(self, sockets, timeout=None) -> list:
+    # Waits until one of the sockets is readable or shutdown begins, in which case nothing is returned
+    readable, _ = wait_for_sockets([*sockets, self._shutdown_receiver], [], timeout)
+    if self._shutdown_receiver in readable:
+      return []
+    return readable
+
+  def wait_writable(self, sockets, timeout=None) -> list:
+    # Same as wait_readable. Sockets that failed to connect are reported as writable as well
+    readable, writable = wait_for_sockets([self._shutdown_receiver], sockets, timeout)
+    if readable:
+      return []
+    return writable
+
+  def close(self):
+    self._shutdown_receiver.close()
+    self._shutdown_sender.close()
 
   def join(self, timeout=None):
-    current_thread_id = self.thread_ident_to_thread_id[threading.get_ident()]
+    current_thread_id = self._local.thread_id
     all_threads_joined = True
-    thread_ids = sorted(self.thread_id_to_thread.keys(), reverse=True)
-    for thread_id in thread_ids:
+    for thread_id, (_, thread) in sorted(self.threads.items(), key=lambda x: x[0], reverse=True):
       if thread_id == current_thread_id:
         continue
-      _, thread = self.thread_id_to_thread[thread_id]
       thread.join(timeout=timeout)
       all_threads_joined &= not thread.is_alive()
     return all_threads_joined
 
   def wait_for_updates(self, timeout=None):
     with self.condition:
-      return self.condition.wait_for(
-        lambda: self.spawned_threads != [] or self.finished_threads != [] or self.added_sockets != [] or self.closed_sockets != [],
-        timeout=timeout,
-      )
+      return self.condition.wait_for(lambda: len(self.events) > 0, timeout=timeout)
 
   def monitor_forever(self, poll_interval=0.01):
+    # Ctrl+C interrupts waiting on a lock everywhere except Windows, so only there the monitor has to wake up
+    timeout = poll_interval if sys.platform == "win32" else None
     first_update = True
     while True:
-      if not first_update and not self.wait_for_updates(timeout=poll_interval):
+      if not first_update and not self.wait_for_updates(timeout=timeout):
         continue
-      with self:
-        if not first_update:
-          logging.debug("")
-
-        for thread_id in self.spawned_threads:
-          logging.debug(f"Spawned thread {thread_id}")
-        self.spawned_threads = []
-
-        for thread_id in self.finished_threads:
-          future, _ = self.thread_id_to_thread[thread_id]
-          self._join_thread(thread_id)
-          exception = future.exception()
-          if exception is not None:
-            logging.debug(f"Finished thread {thread_id} with exception:\n{exception!r}")
-          else:
-            logging.debug(f"Finished thread {thread_id} -> {future.result()}")
-        self.finished_threads = []
-
-        for socket_id in self.added_sockets:
-          logging.debug(f"Added socket {socket_id}")
-        self.added_sockets = []
-
-        for socket_id in self.closed_sockets:
-          logging.debug(f"Closed socket {socket_id}")
-        self.closed_sockets = []
-
-        logging.debug(f"Threads: {len(self.thread_id_to_thread)} | Sockets: {len(self.socket_id_to_socket_and_thread_id)}")
+      if not self.collect_events:
         first_update = False
+        continue
+      if not first_update:
+        logging.debug("")
+
+      while self.events:
+        message, id_, *future = self.events.popleft()
+        if not future:
+          logging.debug(f"{message} {id_}")
+        elif future[0].exception() is not None:
+          logging.debug(f"{message} {id_} with exception:\n{future[0].exception()!r}")
+        else:
+          logging.debug(f"{message} {id_} -> {future[0].result()}")
+
+      logging.debug(f"Threads: {len(self.threads)} | Sockets: {len(self.sockets)}")
+      first_update = False
+
+
+class WakeupSocketPair:
+  # Lets other threads wake up a thread that waits for sockets, which watches receiver among its sockets and drains it
+  # once it is readable
+  def __init__(self, *, global_state: GlobalState):
+    self.global_state = global_state
+    self.receiver, self.sender = socket.socketpair()
+    for sock in (self.receiver, self.sender):
+      with RunIfException(lambda: sock.close()):
+        global_state.add_socket(sock)
+      sock.setblocking(False)
+
+  def wake_up(self):
+    # A full socket pair already has a wakeup pending and a closed one has nobody left to wake up
+    with contextlib.suppress(OSError):
+      self.sender.send(b"\0")
 
-  def __enter__(self):
-    with RunIfException(lambda: self.lock.release()):
-      return self.lock.acquire()
+  def drain(self):
+    with contextlib.suppress(OSError):
+      while self.receiver.recv(4096):
+        pass
 
-  def __exit__(self, exc_type, exc_val, exc_tb):
-    with RunIfException(lambda: self.lock.release()):
-      self.lock.release()
+  def close(self):
+    self.global_state.close_socket(self.receiver)
+    self.global_state.close_socket(self.sender)
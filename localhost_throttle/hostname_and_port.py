@@ -1,19 +1,114 @@
+import contextlib
+import os
+import socket
+import stat
+
+from .context_util import RunFinally
+
+unix_prefix = "unix:"
+
+
+def remove_socket_file(path: str):
+  with contextlib.suppress(FileNotFoundError):
+    if stat.S_ISSOCK(os.stat(path).st_mode):
+      os.unlink(path)
+
+
+def remove_stale_socket_file(path: str):
+  # Socket file of a process that was killed stays behind and would fail the bind. Nobody listens on a stale one, so
+  # connecting to it is refused. A socket that is still in use, also one of another type, is left alone and the bind
+  # fails instead of taking its path away
+  with contextlib.suppress(FileNotFoundError):
+    if not stat.S_ISSOCK(os.stat(path).st_mode):
+      return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+      # Listener with a full backlog does not block the check, it is in use
+      sock.setblocking(False)
+      try:
+        sock.connect(path)
+      except ConnectionRefusedError:
+        os.unlink(path)
+      except OSError:
+        pass
+
+
 class HostnameAndPort:
-  def __init__(self, hostname: str, port: int):
+  # Endpoint given as "host:port", "[ipv6]:port" or "unix:/path". Unix endpoints have a path instead of host and port
+  def __init__(self, hostname: str | None, port: int | None, *, path: str | None = None):
     self.hostname = hostname
     self.port = port
+    self.path = path
+
+  @property
+  def family(self) -> int:
+    # Host names are resolved to IPv4 like before, IPv6 needs a literal address
+    if self.path is not None:
+      return socket.AF_UNIX
+    if ":" in self.hostname:
+      return socket.AF_INET6
+    return socket.AF_INET
 
-  def to_address(self) -> tuple[str, int]:
+  def to_address(self) -> tuple[str, int] | str:
+    if self.path is not None:
+      return self.path
     return (self.hostname, self.port)
 
+  @contextlib.contextmanager
+  def bound(self, sock):
+    # Binds a listening socket. The socket file of a Unix endpoint is removed again on exit
+    if self.path is None:
+      sock.bind(self.to_address())
+      yield
+      return
+    remove_stale_socket_file(self.path)
+    sock.bind(self.path)
+    with RunFinally(lambda: remove_socket_file(self.path)):
+      yield
+
   @staticmethod
   def from_string(str_: str):
-    hostname, port = str_.rsplit(":", maxsplit=1)
+    if str_.startswith(unix_prefix):
+      path = str_[len(unix_prefix) :]
+      if not path:
+        raise ValueError(f"Unix endpoint needs a path, e.g. unix:/tmp/server.sock. Got: {str_}")
+      if not hasattr(socket, "AF_UNIX"):
+        raise ValueError("Unix sockets are not available on this platform")
+      return HostnameAndPort(None, None, path=path)
+    if str_.startswith("["):
+      hostname, separator, port = str_[1:].partition("]:")
+      if not separator:
+        raise ValueError(f"Expected [ipv6]:port. Got: {str_}")
+    else:
+      hostname, port = str_.rsplit(":", maxsplit=1)
+      if ":" in hostname:
+        raise ValueError(f"IPv6 address should be in brackets, e.g. [::1]:8000. Got: {str_}")
     port = int(port)
     return HostnameAndPort(hostname, port)
 
   def to_string(self) -> str:
+    if self.path is not None:
+      return f"{unix_prefix}{self.path}"
+    if ":" in self.hostname:
+      return f"[{self.hostname}]:{self.port}"
     return f"{self.hostname}:{self.port}"
 
   def __str__(self) -> str:
     return self.to_string()
+
+
+def address_host(address) -> str:
+  # Host of a peer address as returned by accept() or recvfrom(). Every Unix socket peer is on this host
+  if isinstance(address, tuple):
+    return address[0]
+  return "localhost"
+
+
+def format_address(address) -> str:
+  if isinstance(address, bytes):
+    # Linux returns names in the abstract namespace, which start with a null byte, as bytes
+    address = address.decode(errors="backslashreplace").replace("\0", "@", 1)
+  if not isinstance(address, tuple):
+    return f"{unix_prefix}{address or ''}"
+  if ":" in address[0]:
+    return f"[{address[0]}]:{address[1]}"
+  return f"{address[0]}:{address[1]}"
@@ -0,0 +1,140 @@
+import itertools
+import random
+
+from .direction_type import Direction
+
+
+class RandomStream:
+  # Uniform numbers in [0, 1) are generated a batch at a time from a single randbytes() call, so the per-datagram
+  # cost is a list lookup instead of a call into the random module
+  def __init__(self, seed=None, *, batch_size: int = 4096):
+    self._random = random.Random(seed)
+    self._batch_size = batch_size
+    self._values = []
+    self._index = 0
+
+  def _refill(self):
+    scale = 1.0 / (1 << 32)
+    random_bytes = self._random.randbytes(4 * self._batch_size)
+    self._values = [value * scale for value in memoryview(random_bytes).cast("I")]
+    self._index = 0
+
+  def next(self) -> float:
+    if self._index == len(self._values):
+      self._refill()
+    value = self._values[self._index]
+    self._index += 1
+    return value
+
+
+class GilbertElliott:
+  # Two-state Markov chain: "good" state loses datagrams with probability good_loss, "bad" one with bad_loss
+  def __init__(self, p: float, r: float, bad_loss: float = 1.0, good_loss: float = 0.0):
+    self.p = p
+    self.r = r
+    self.bad_loss = bad_loss
+    self.good_loss = good_loss
+    self._is_bad = False
+
+  def is_lost(self, random_stream: RandomStream) -> bool:
+    if self._is_bad:
+      self._is_bad = random_stream.next() >= self.r
+    else:
+      self._is_bad = random_stream.next() < self.p
+    loss = self.bad_loss if self._is_bad else self.good_loss
+    return loss > 0 and random_stream.next() < loss
+
+
+class ImpairmentProfile:
+  def __init__(
+    self,
+    *,
+    loss: float = 0.0,
+    duplicate: float = 0.0,
+    reorder: float = 0.0,
+    gilbert_elliott: tuple[float, ...] | None = None,
+  ):
+    self.loss = loss
+    self.duplicate = duplicate
+    self.reorder = reorder
+    self.gilbert_elliott = gilbert_elliott
+
+  def is_enabled(self) -> bool:
+    return self.loss > 0 or self.duplicate > 0 or self.reorder > 0 or self.gilbert_elliott is not None
+
+
+class UDPImpairment:
+  def __init__(self, profile: ImpairmentProfile, *, reorder_delay: float, random_stream: RandomStream):
+    self.profile = profile
+    self.reorder_delay = reorder_delay
+    self.random_stream = random_stream
+    self.gilbert_elliott = GilbertElliott(*profile.gilbert_elliott) if profile.gilbert_elliott is not None else None
+
+  def decide(self) -> tuple[int, float]:
+    # Returns how many copies of the datagram to send (0 means it is lost) and how long to additionally hold them back
+    profile = self.profile
+    random_stream = self.random_stream
+    if self.gilbert_elliott is not None and self.gilbert_elliott.is_lost(random_stream):
+      return 0, 0.0
+    if profile.loss > 0 and random_stream.next() < profile.loss:
+      return 0, 0.0
+    copies = 1
+    if profile.duplicate > 0 and random_stream.next() < profile.duplicate:
+      copies = 2
+    # A held back datagram is overtaken by the ones that are sent after it
+    if profile.reorder > 0 and random_stream.next() < profile.reorder:
+      return copies, self.reorder_delay
+    return copies, 0.0
+
+
+class ImpairmentEmulator:
+  def __init__(
+    self,
+    profiles: dict[Direction, ImpairmentProfile] | None = None,
+    *,
+    reorder_delay: float = 0.01,
+    seed: int | None = None,
+  ):
+    self.profiles = profiles if profiles is not None else dict()
+    self.reorder_delay = reorder_delay
+    self.seed = seed
+    self._session_counter = itertools.count()
+
+  def is_enabled(self) -> bool:
+    return any(profile.is_enabled() for profile in self.profiles.values())
+
+  def needs_delay_scheduler(self) -> bool:
+    return any(profile.reorder > 0 for profile in self.profiles.values())
+
+  def create_session_impairments(self) -> dict[Direction, UDPImpairment | None]:
+    # Streams are seeded by the order in which sessions appear, not by client ports, so runs with the same seed and
+    # the same traffic make the same decisions
+    session_index = next(self._session_counter)
+    impairments = dict()
+    for direction in Direction:
+      profile = self.profiles.get(direction)
+      if profile is None or not profile.is_enabled():
+        impairments[direction] = None
+        continue
+      seed = None if self.seed is None else f"{self.seed}/{session_index}/{direction}"
+      impairments[direction] = UDPImpairment(profile, reorder_delay=self.reorder_delay, random_stream=RandomStream(seed))
+    return impairments
+
+
+def create_profiles(
+  *,
+  loss: tuple[float, float] | None = None,
+  duplicate: tuple[float, float] | None = None,
+  reorder: tuple[float, float] | None = None,
+  gilbert_elliott: tuple[tuple[float, ...], tuple[float, ...]] | None = None,
+) -> dict[Direction, ImpairmentProfile]:
+  # Every per-direction value is a (client -> server, server -> client) pair
+  profiles = dict()
+  for i, direction in enumerate((Direction.CLIENT_TO_SERVER, Direction.SERVER_TO_CLIENT)):
+    profiles[direction] = ImpairmentProfile(
+      loss=loss[i] if loss is not None else 0.0,
+      duplicate=duplicate[i] if duplicate is not None else 0.0,
+      reorder=reorder[i] if reorder is not None else 0.0,
+      gilbert_elliott=gilbert_elliott[i] if gilbert_elliott is not None else None,
+    )
+  return profiles
@@ -0,0 +1,102 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from .global_state import GlobalState
+from .protocol_type import Protocol
+
+
+class DelayScheduler:
+  # One thread releases every delayed chunk of the process from a heap ordered by deadline
+  def __init__(self, *, clock=time.perf_counter):
+    self.clock = clock
+    self._heap = []
+    self._counter = itertools.count()
+    self._condition = threading.Condition()
+
+  def schedule(self, deadline: float, callback):
+    with self._condition:
+      heapq.heappush(self._heap, (deadline, next(self._counter), callback))
+      if self._heap[0][2] is callback:
+        self._condition.notify()
+
+  def notify(self):
+    with self._condition:
+      self._condition.notify()
+
+  def run_forever(self, *, global_state: GlobalState):
+    global_state.on_shutdown(self.notify)
+    while True:
+      with self._condition:
+        # Checked under the lock, so the notification of shutdown cannot slip in before the wait
+        if global_state.is_shutdown():
+          return
+        if not self._heap:
+          self._condition.wait()
+          continue
+        time_to_wait = self._heap[0][0] - self.clock()
+        if time_to_wait > 0:
+          self._condition.wait(time_to_wait)
+          continue
+        _, _, callback = heapq.heappop(self._heap)
+      # This thread serves every listener, so a failing callback must not end delays for all of them
+      try:
+        callback()
+      except Exception as e:
+        logging.debug(f"Delayed callback {getattr(callback, '__name__', callback)} failed:\n{e!r}")
+
+
+class DelayLine:
+  def __init__(self, *, latency: float, jitter: float, preserve_order: bool, clock=time.perf_counter):
+    self.latency = latency
+    self.jitter = jitter
+    self.preserve_order = preserve_order
+    self.clock = clock
+    self._random = random.Random()
+    self._last_deadline = 0.0
+
+  def next_deadline(self) -> float:
+    delay = self.latency
+    if self.jitter > 0:
+      delay = max(0.0, delay + self._random.uniform(-self.jitter, self.jitter))
+    deadline = self.clock() + delay
+    if self.preserve_order:
+      deadline = max(deadline, self._last_deadline)
+      self._last_deadline = deadline
+    return deadline
+
+
+class LatencyEmulator:
+  def __init__(
+    self,
+    *,
+    latency: float | None = None,
+    jitter: float | None = None,
+    preserve_order: bool = False,
+    delay_scheduler: DelayScheduler | None = None,
+  ):
+    self.latency = latency if latency is not None else 0.0
+    self.jitter = jitter if jitter is not None else 0.0
+    self.preserve_order = preserve_order
+    # Emulators of several listeners may share a scheduler and its thread
+    self.delay_scheduler = delay_scheduler if delay_scheduler is not None else DelayScheduler()
+
+  def is_enabled(self) -> bool:
+    return self.latency > 0 or self.jitter > 0
+
+  def create_delay_line(
+    self, protocol: Protocol, *, latency: float | None = None, jitter: float | None = None
+  ) -> DelayLine | None:
+    latency = latency if latency is not None else self.latency
+    jitter = jitter if jitter is not None else self.jitter
+    if latency <= 0 and jitter <= 0:
+      return None
+    # Reordering a TCP stream would corrupt it, so only UDP may have datagrams overtake each other
+    preserve_order = self.preserve_order or protocol == Protocol.TCP
+    return DelayLine(latency=latency, jitter=jitter, preserve_order=preserve_order)
+
+  def schedule(self, delay_line: DelayLine, callback):
+    self.delay_scheduler.schedule(delay_line.next_deadline(), callback)
@@ -0,0 +1,132 @@
+import bisect
+import contextlib
+import hashlib
+import itertools
+import logging
+import threading
+import time
+
+from .hostname_and_port import HostnameAndPort, address_host
+from .load_balancing_type import LoadBalancing
+
+default_ejection_time = 10.0
+default_max_failures = 1
+# Points of every backend on the consistent hash ring. More points spread clients more evenly
+virtual_nodes = 64
+
+
+def _hash(str_: str) -> int:
+  return int.from_bytes(hashlib.blake2b(str_.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class Backend:
+  # Passive health checking: max_failures consecutive failures eject the backend for ejection_time. Success of a
+  # connection or a reply resets the count
+  def __init__(
+    self,
+    address: HostnameAndPort,
+    *,
+    ejection_time: float = default_ejection_time,
+    max_failures: int = default_max_failures,
+    clock=time.monotonic,
+  ):
+    self.address = address
+    self.ejection_time = ejection_time
+    self.max_failures = max_failures
+    self.clock = clock
+    self.active_connections = 0
+    self._failures = 0
+    self._ejected_until = None
+    self._lock = threading.Lock()
+
+  def is_available(self) -> bool:
+    ejected_until = self._ejected_until
+    return ejected_until is None or self.clock() >= ejected_until
+
+  def report_failure(self):
+    with self._lock:
+      self._failures += 1
+      if self._failures < self.max_failures:
+        return
+      self._failures = 0
+      self._ejected_until = self.clock() + self.ejection_time
+    logging.warning(f"Backend {self.address} is ejected for {self.ejection_time} seconds")
+
+  def report_success(self):
+    if self._failures == 0 and self._ejected_until is None:
+      return
+    with self._lock:
+      self._failures = 0
+      self._ejected_until = None
+
+  def open_connection(self):
+    with self._lock:
+      self.active_connections += 1
+
+  def close_connection(self):
+    with self._lock:
+      self.active_connections -= 1
+
+  @contextlib.contextmanager
+  def connection(self):
+    self.open_connection()
+    try:
+      yield self
+    finally:
+      self.close_connection()
+
+  def __str__(self) -> str:
+    return str(self.address)
+
+
+class LoadBalancer:
+  def __init__(self, backends: list[Backend], *, policy: LoadBalancing = LoadBalancing.ROUND_ROBIN):
+    if not backends:
+      raise ValueError("At least one backend is required")
+    self.backends = backends
+    self.policy = policy
+    self._counter = itertools.count()
+    self._ring = sorted(
+      (_hash(f"{backend.address}#{i}"), index) for index, backend in enumerate(backends) for i in range(virtual_nodes)
+    )
+    self._ring_hashes = [x for x, _ in self._ring]
+
+  @staticmethod
+  def create(
+    addresses: list[HostnameAndPort],
+    *,
+    policy: LoadBalancing = LoadBalancing.ROUND_ROBIN,
+    ejection_time: float = default_ejection_time,
+    max_failures: int = default_max_failures,
+  ):
+    backends = [Backend(x, ejection_time=ejection_time, max_failures=max_failures) for x in addresses]
+    return LoadBalancer(backends, policy=policy)
+
+  def _preference_order(self, client_address) -> list[Backend]:
+    match self.policy:
+      case LoadBalancing.ROUND_ROBIN:
+        start = next(self._counter) % len(self.backends)
+        return self.backends[start:] + self.backends[:start]
+      case LoadBalancing.LEAST_CONNECTIONS:
+        # Rotation breaks ties, so idle backends share new connections evenly
+        start = next(self._counter) % len(self.backends)
+        rotated = self.backends[start:] + self.backends[:start]
+        return sorted(rotated, key=lambda x: x.active_connections)
+      case LoadBalancing.CONSISTENT_HASH:
+        # Every client host sticks to one backend. Backends that follow on the ring take over when it is ejected
+        start = bisect.bisect(self._ring_hashes, _hash(address_host(client_address)))
+        order = dict()
+        for _, index in itertools.chain(self._ring[start:], self._ring[:start]):
+          order.setdefault(index, self.backends[index])
+          if len(order) == len(self.backends):
+            break
+        return list(order.values())
+
+  def candidates(self, client_address) -> list[Backend]:
+    # Backends to try in order. Ejected ones come last, so that clients are still served when every backend is ejected
+    backends = self._preference_order(client_address)
+    available = [x.is_available() for x in backends]
+    return [x for x, y in zip(backends, available) if y] + [x for x, y in zip(backends, available) if not y]
+
+  def choose(self, client_address) -> Backend:
+    return self.candidates(client_address)[0]
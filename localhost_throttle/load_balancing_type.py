@@ -0,0 +1,32 @@
+import enum
+
+
+@enum.unique
+class LoadBalancing(enum.Enum):
+  ROUND_ROBIN = enum.auto()
+  LEAST_CONNECTIONS = enum.auto()
+  CONSISTENT_HASH = enum.auto()
+
+  @staticmethod
+  def from_string(str):
+    str = str.lower()
+    match str:
+      case "round-robin":
+        return LoadBalancing.ROUND_ROBIN
+      case "least-connections":
+        return LoadBalancing.LEAST_CONNECTIONS
+      case "consistent-hash":
+        return LoadBalancing.CONSISTENT_HASH
+      case _:
+        raise ValueError(
+          f"'{str}' is not a valid LoadBalancing. Only 'round-robin', 'least-connections' and 'consistent-hash' are supported"
+        )
+
+  def __str__(self):
+    match self:
+      case LoadBalancing.ROUND_ROBIN:
+        return "round-robin"
+      case LoadBalancing.LEAST_CONNECTIONS:
+        return "least-connections"
+      case LoadBalancing.CONSISTENT_HASH:
+        return "consistent-hash"
@@ -1,77 +1,365 @@
 import logging
+import sys
 
+from .bandwidth_limiter import BandwidthLimiter, GlobalLimiter
+from .bandwidth_trace import BandwidthTrace
+from .chunk_sizer import default_buffer_size
+from .config import load_config, parse_config
+from .control import Control, ListenerControl
+from .control_server import serve_control
+from .direction_type import Direction
+from .engine_type import Engine
 from .global_state import GlobalState
 from .hostname_and_port import HostnameAndPort
-from .parser import create_parser
+from .impairment import ImpairmentEmulator, ImpairmentProfile, create_profiles
+from .latency import DelayScheduler, LatencyEmulator
+from .load_balancer import LoadBalancer, default_ejection_time, default_max_failures
+from .load_balancing_type import LoadBalancing
+from .metrics import Metrics
+from .metrics_server import serve_metrics
+from .parser import create_parser, default_poll_interval
 from .protocol_type import Protocol, ProtocolSet
-from .redirect_tcp import redirect_tcp
+from .redirect_tcp import default_backlog, redirect_tcp
+from .redirect_tcp_asyncio import redirect_tcp_asyncio
 from .redirect_udp import redirect_udp
+from .udp_pacing import default_max_queue_size, default_max_total_queue_size
+from .upstream_pool import UpstreamPool, default_refill_rate
+from .worker_pool import WorkerPool, default_max_workers
 
 
 def redirect(
   protocol: Protocol,
-  server_address: HostnameAndPort,
+  server_addresses: list[HostnameAndPort],
   new_server_address: HostnameAndPort,
   *,
-  bandwidth: float | None,
+  listener_control: ListenerControl,
+  impairment_emulator: ImpairmentEmulator,
+  metrics: Metrics,
+  worker_pool: WorkerPool,
+  all_upstream_pools: list[UpstreamPool],
   global_state: GlobalState,
-  request_queue_size: int = 100,
-  poll_interval: float = 0.01,
+  engine: Engine = Engine.THREADS,
+  load_balancing: LoadBalancing = LoadBalancing.ROUND_ROBIN,
+  backend_ejection_time: float = default_ejection_time,
+  backend_max_failures: int = default_max_failures,
+  backlog: int = default_backlog,
+  buffer_size: int = default_buffer_size,
+  udp_session_timeout: float | None = None,
+  udp_max_sessions: int | None = None,
+  udp_queue_size: int = default_max_queue_size,
+  udp_total_queue_size: int = default_max_total_queue_size,
+  upstream_pool_size: int = 0,
+  upstream_pool_refill_rate: float = default_refill_rate,
 ):
+  # Every protocol ejects its backends on its own, a server may listen on one protocol only
+  load_balancer = LoadBalancer.create(
+    server_addresses, policy=load_balancing, ejection_time=backend_ejection_time, max_failures=backend_max_failures
+  )
   match protocol:
     case Protocol.TCP:
-      redirect_tcp(
-        server_address,
+      upstream_pools = dict()
+      if upstream_pool_size > 0:
+        for backend in load_balancer.backends:
+          upstream_pools[backend] = UpstreamPool(
+            backend.address, size=upstream_pool_size, refill_rate=upstream_pool_refill_rate, global_state=global_state
+          )
+          global_state.add_thread(f=upstream_pools[backend].run_forever)
+          all_upstream_pools.append(upstream_pools[backend])
+      redirect_tcp_impl = redirect_tcp
+      engine_kwargs = {"worker_pool": worker_pool}
+      if engine == Engine.ASYNCIO:
+        # Coroutines of the event loop take the place of worker threads
+        redirect_tcp_impl = redirect_tcp_asyncio
+        engine_kwargs = {}
+      redirect_tcp_impl(
+        load_balancer,
         new_server_address,
-        bandwidth=bandwidth,
+        listener_control=listener_control,
+        metrics=metrics,
         global_state=global_state,
-        request_queue_size=request_queue_size,
-        poll_interval=poll_interval,
+        upstream_pools=upstream_pools,
+        backlog=backlog,
+        buffer_size=buffer_size,
+        **engine_kwargs,
       )
     case Protocol.UDP:
       redirect_udp(
-        server_address,
+        load_balancer,
         new_server_address,
-        bandwidth=bandwidth,
+        listener_control=listener_control,
+        impairment_emulator=impairment_emulator,
+        metrics=metrics,
         global_state=global_state,
-        poll_interval=poll_interval,
+        session_timeout=udp_session_timeout,
+        max_sessions=udp_max_sessions,
+        max_queue_size=udp_queue_size,
+        max_total_queue_size=udp_total_queue_size,
       )
 
 
-def localhost_throttle(
-  server_address: HostnameAndPort,
+def start_listener(
+  server_addresses: list[HostnameAndPort],
   new_server_address: HostnameAndPort,
   protocols: ProtocolSet,
   *,
+  index: int,
+  metrics: Metrics,
+  delay_scheduler: DelayScheduler,
+  worker_pool: WorkerPool,
+  all_upstream_pools: list[UpstreamPool],
+  global_limiter: GlobalLimiter,
+  global_state: GlobalState,
   bandwidth: float | None = None,
-  poll_interval: float = 0.01,
+  client_bandwidth: float | None = None,
+  burst: float | None = None,
+  bandwidth_trace: BandwidthTrace | None = None,
+  latency: float | None = None,
+  jitter: float | None = None,
+  preserve_order: bool = False,
+  udp_impairment_profiles: dict[Direction, ImpairmentProfile] | None = None,
+  udp_reorder_delay: float = 0.01,
+  udp_session_timeout: float | None = 120.0,
+  udp_max_sessions: int | None = None,
+  udp_queue_size: int = default_max_queue_size,
+  udp_total_queue_size: int = default_max_total_queue_size,
+  upstream_pool_size: int = 0,
+  upstream_pool_refill_rate: float = default_refill_rate,
+  backlog: int = default_backlog,
+  buffer_size: int = default_buffer_size,
+  seed: int | None = None,
+  engine: Engine = Engine.THREADS,
+  load_balancing: LoadBalancing = LoadBalancing.ROUND_ROBIN,
+  backend_ejection_time: float = default_ejection_time,
+  backend_max_failures: int = default_max_failures,
+) -> tuple[ListenerControl, bool]:
+  # Limits of a listener are its own, only the budget of global_limiter is shared with the other listeners. Returns what
+  # the control API sees of the listener and whether the listener needs the delay scheduler
+  bandwidth_limiter = BandwidthLimiter(
+    bandwidth=bandwidth,
+    client_bandwidth=client_bandwidth,
+    global_limiter=global_limiter,
+    burst=burst,
+    bandwidth_trace=bandwidth_trace,
+  )
+  latency_emulator = LatencyEmulator(
+    latency=latency, jitter=jitter, preserve_order=preserve_order, delay_scheduler=delay_scheduler
+  )
+  impairment_emulator = ImpairmentEmulator(udp_impairment_profiles, reorder_delay=udp_reorder_delay, seed=seed)
+  listener_control = ListenerControl(
+    index, new_server_address, protocols, bandwidth_limiter=bandwidth_limiter, latency_emulator=latency_emulator
+  )
+  for protocol in protocols:
+    global_state.add_thread(
+      f=redirect,
+      args=(protocol, server_addresses, new_server_address),
+      kwargs={
+        "listener_control": listener_control,
+        "impairment_emulator": impairment_emulator,
+        "metrics": metrics,
+        "worker_pool": worker_pool,
+        "all_upstream_pools": all_upstream_pools,
+        "engine": engine,
+        "load_balancing": load_balancing,
+        "backend_ejection_time": backend_ejection_time,
+        "backend_max_failures": backend_max_failures,
+        "udp_session_timeout": udp_session_timeout,
+        "udp_max_sessions": udp_max_sessions,
+        "udp_queue_size": udp_queue_size,
+        "udp_total_queue_size": udp_total_queue_size,
+        "upstream_pool_size": upstream_pool_size,
+        "upstream_pool_refill_rate": upstream_pool_refill_rate,
+        "backlog": backlog,
+        "buffer_size": buffer_size,
+      },
+    )
+  return listener_control, latency_emulator.is_enabled() or impairment_emulator.needs_delay_scheduler()
+
+
+def serve(
+  listeners: list[dict],
+  *,
+  max_workers: int = default_max_workers,
+  global_bandwidth: float | None = None,
+  global_burst: float | None = None,
+  metrics_address: HostnameAndPort | None = None,
+  control_socket: str | None = None,
+  poll_interval: float = default_poll_interval,
   log_level: int = logging.INFO,
 ):
+  # Every listener is a dict of start_listener arguments. They share the threads, sockets, metrics, worker pool, delay
+  # scheduler and global bandwidth budget of one process
   logging.basicConfig(format="%(asctime)s\t%(filename)s:%(lineno)s\t%(levelname)s\t%(message)s", level=log_level)
   global_state = GlobalState()
-  for protocol in protocols:
-    global_state.add_thread(
-      f=redirect,
-      args=(protocol, server_address, new_server_address),
-      kwargs={"bandwidth": bandwidth, "poll_interval": poll_interval},
+  metrics = Metrics()
+  delay_scheduler = DelayScheduler()
+  worker_pool = WorkerPool(max_workers=max_workers, global_state=global_state)
+  global_limiter = GlobalLimiter(global_bandwidth, global_burst)
+  all_upstream_pools = []
+  metrics.add_gauge(
+    "localhost_throttle_tcp_workers", "Threads serving TCP connections, busy or idle.", lambda: worker_pool.workers
+  )
+  metrics.add_gauge(
+    "localhost_throttle_tcp_queued_tasks",
+    "TCP connections waiting for a free worker.",
+    lambda: worker_pool.queued_tasks,
+  )
+  metrics.add_gauge(
+    "localhost_throttle_idle_upstream_connections",
+    "Connections to the servers waiting in the pools for TCP clients.",
+    lambda: sum(len(x) for x in all_upstream_pools),
+  )
+  if metrics_address is not None:
+    metrics.add_gauge(
+      "localhost_throttle_threads", "Threads tracked by localhost-throttle.", lambda: len(global_state.threads)
+    )
+    metrics.add_gauge(
+      "localhost_throttle_sockets", "Sockets tracked by localhost-throttle.", lambda: len(global_state.sockets)
     )
+    global_state.add_thread(f=serve_metrics, args=(metrics_address,), kwargs={"metrics": metrics})
+  listener_controls = []
+  # Delay may be added through the control API later on
+  needs_delay_scheduler = control_socket is not None
+  for index, listener in enumerate(listeners):
+    listener_control, needs_delay = start_listener(
+      **listener,
+      index=index,
+      metrics=metrics,
+      delay_scheduler=delay_scheduler,
+      worker_pool=worker_pool,
+      all_upstream_pools=all_upstream_pools,
+      global_limiter=global_limiter,
+      global_state=global_state,
+    )
+    listener_controls.append(listener_control)
+    needs_delay_scheduler |= needs_delay
+  if needs_delay_scheduler:
+    global_state.add_thread(f=delay_scheduler.run_forever)
+  if control_socket is not None:
+    control = Control(listener_controls, global_limiter=global_limiter)
+    global_state.add_thread(f=serve_control, args=(control_socket,), kwargs={"control": control})
   try:
     global_state.monitor_forever(poll_interval=poll_interval)
   except BaseException:
     global_state.shutdown()
     all_threads_joined = global_state.join(timeout=1)
+    # Sockets of threads that did not finish in time are closed anyway
+    global_state.close_all_sockets()
+    global_state.close()
     if not all_threads_joined:
       raise RuntimeError("Not all threads joined in the end")
 
 
-def main():
+def localhost_throttle(
+  server_addresses: list[HostnameAndPort],
+  new_server_address: HostnameAndPort,
+  protocols: ProtocolSet,
+  *,
+  max_workers: int = default_max_workers,
+  global_bandwidth: float | None = None,
+  metrics_address: HostnameAndPort | None = None,
+  control_socket: str | None = None,
+  poll_interval: float = default_poll_interval,
+  log_level: int = logging.INFO,
+  **listener_kwargs,
+):
+  # Serves a single listener. listener_kwargs are the options of start_listener, its burst applies to the global budget
+  # as well
+  serve(
+    [
+      {
+        "server_addresses": server_addresses,
+        "new_server_address": new_server_address,
+        "protocols": protocols,
+        **listener_kwargs,
+      }
+    ],
+    max_workers=max_workers,
+    global_bandwidth=global_bandwidth,
+    global_burst=listener_kwargs.get("burst"),
+    metrics_address=metrics_address,
+    control_socket=control_socket,
+    poll_interval=poll_interval,
+    log_level=log_level,
+  )
+
+
+def listener_from_args(args) -> dict:
+  return {
+    "server_addresses": args.server,
+    "new_server_address": args.new_server,
+    "protocols": args.protocols,
+    "bandwidth": args.bandwidth,
+    "client_bandwidth": args.client_bandwidth,
+    "burst": args.burst,
+    "bandwidth_trace": (
+      BandwidthTrace.load(args.bandwidth_trace, end=args.bandwidth_trace_end)
+      if args.bandwidth_trace is not None
+      else None
+    ),
+    "latency": args.latency,
+    "jitter": args.jitter,
+    "preserve_order": args.preserve_order,
+    "udp_impairment_profiles": create_profiles(
+      loss=args.udp_loss,
+      duplicate=args.udp_duplicate,
+      reorder=args.udp_reorder,
+      gilbert_elliott=args.udp_gilbert_elliott,
+    ),
+    "udp_reorder_delay": args.udp_reorder_delay,
+    "udp_session_timeout": args.udp_session_timeout or None,
+    "udp_max_sessions": args.udp_max_sessions,
+    "udp_queue_size": args.udp_queue_size,
+    "udp_total_queue_size": args.udp_total_queue_size,
+    "upstream_pool_size": args.upstream_pool_size,
+    "upstream_pool_refill_rate": args.upstream_pool_refill_rate,
+    "backlog": args.backlog,
+    "buffer_size": args.buffer_size,
+    "seed": args.seed,
+    "engine": args.engine,
+    "load_balancing": args.load_balancing,
+    "backend_ejection_time": args.backend_ejection_time,
+    "backend_max_failures": args.backend_max_failures,
+  }
+
+
+def main(argv: list[str] | None = None):
   parser = create_parser()
-  args = parser.parse_args()
-  localhost_throttle(
-    args.server,
-    args.new_server,
-    args.protocols,
-    bandwidth=args.bandwidth,
+  argv = argv if argv is not None else sys.argv[1:]
+  args = parser.parse_args(argv)
+  listener_args = [args]
+  if args.config is not None:
+    try:
+      args, listener_args = parse_config(load_config(args.config), parser, argv)
+    except (OSError, ValueError) as e:
+      parser.error(f"invalid config {args.config}: {e}")
+  if args.metrics_address is not None and args.metrics_address.path is not None:
+    parser.error("--metrics-address should be host:port, Unix sockets are not supported")
+  for index, x in enumerate(listener_args):
+    required = {"--server": x.server, "--new-server": x.new_server, "--protocols": x.protocols}
+    missing = ", ".join(y for y, z in required.items() if z is None)
+    if missing and args.config is None:
+      parser.error(f"the following arguments are required: {missing}")
+    if missing:
+      parser.error(f"listener {index} of {args.config} misses {missing}")
+    if x.bandwidth is not None and x.bandwidth_trace is not None:
+      parser.error("--bandwidth and --bandwidth-trace are exclusive")
+    if x.new_server.path is not None and len(x.protocols) > 1:
+      # Stream and datagram sockets cannot share one socket file
+      parser.error(f"--new-server {x.new_server} is a Unix socket, which serves only one of --protocols {x.protocols}")
+  listeners = []
+  for x in listener_args:
+    try:
+      listeners.append(listener_from_args(x))
+    except (OSError, ValueError) as e:
+      parser.error(f"invalid bandwidth trace {x.bandwidth_trace}: {e}")
+  serve(
+    listeners,
+    max_workers=args.max_workers,
+    # Burst of the top level of the config or the command line applies to the global budget
+    global_bandwidth=args.global_bandwidth,
+    global_burst=args.burst,
+    metrics_address=args.metrics_address,
+    control_socket=args.control_socket,
     poll_interval=args.poll_interval,
     log_level=args.log_level,
   )
@@ -0,0 +1,177 @@
+import bisect
+import threading
+
+from .direction_type import Direction
+from .protocol_type import Protocol
+
+throttle_sleep_buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class _PerThreadCells:
+  # Every thread updates a cell of its own without locking. Readers sum the cells, and cells of finished threads are
+  # folded into a single one, so the number of cells follows the number of live threads
+  def __init__(self, size: int):
+    self._size = size
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._cells = []
+    self._finished_cell = [0] * size
+    self._next_fold = 16
+
+  def _cell(self) -> list:
+    cell = getattr(self._local, "cell", None)
+    if cell is None:
+      cell = self._local.cell = [0] * self._size
+      with self._lock:
+        self._cells.append((threading.current_thread(), cell))
+        if len(self._cells) >= self._next_fold:
+          self._fold_finished_cells()
+          self._next_fold = 2 * len(self._cells) + 16
+    return cell
+
+  def _fold_finished_cells(self):
+    alive_cells = []
+    for thread, cell in self._cells:
+      if thread.is_alive():
+        alive_cells.append((thread, cell))
+      else:
+        self._finished_cell = [x + y for x, y in zip(self._finished_cell, cell)]
+    self._cells = alive_cells
+
+  def _sum(self) -> list:
+    with self._lock:
+      self._fold_finished_cells()
+      values = list(self._finished_cell)
+      for _, cell in self._cells:
+        values = [x + y for x, y in zip(values, cell)]
+    return values
+
+
+class Counter(_PerThreadCells):
+  def __init__(self):
+    super().__init__(1)
+
+  def add(self, amount=1):
+    self._cell()[0] += amount
+
+  def value(self):
+    return self._sum()[0]
+
+
+class Histogram(_PerThreadCells):
+  # Cell keeps a count per bucket, one more for values above the last bound, and the sum of all values
+  def __init__(self, buckets: tuple[float, ...]):
+    super().__init__(len(buckets) + 2)
+    self.buckets = buckets
+
+  def observe(self, value: float):
+    cell = self._cell()
+    cell[bisect.bisect_left(self.buckets, value)] += 1
+    cell[-1] += value
+
+  def value(self) -> tuple[list[int], float]:
+    values = self._sum()
+    return values[:-1], values[-1]
+
+
+class RelayMetrics:
+  # Counters of one protocol and direction, handed to a relay loop once so that it does not look them up per chunk
+  def __init__(self, bytes_: Counter, packets: Counter, throttle_sleep_seconds: Histogram):
+    self.bytes = bytes_
+    self.packets = packets
+    self.throttle_sleep_seconds = throttle_sleep_seconds
+
+  def record(self, data_length: int):
+    self.bytes.add(data_length)
+    self.packets.add()
+
+  def record_throttle(self, time_to_wait: float):
+    if time_to_wait > 0:
+      self.throttle_sleep_seconds.observe(time_to_wait)
+
+
+def _format_labels(labels: dict) -> str:
+  if not labels:
+    return ""
+  return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value) -> str:
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.bytes = {(protocol, direction): Counter() for protocol in Protocol for direction in Direction}
+    self.packets = {(protocol, direction): Counter() for protocol in Protocol for direction in Direction}
+    self.throttle_sleep_seconds = Histogram(throttle_sleep_buckets)
+    self.open_tcp_connections = Counter()
+    self.udp_sessions = Counter()
+    self._gauges = []
+
+  def relay(self, protocol: Protocol, direction: Direction) -> RelayMetrics:
+    return RelayMetrics(
+      self.bytes[(protocol, direction)], self.packets[(protocol, direction)], self.throttle_sleep_seconds
+    )
+
+  def add_gauge(self, name: str, help_: str, callback):
+    with self._lock:
+      self._gauges.append((name, help_, callback))
+
+  def render(self) -> str:
+    # Prometheus text exposition format, version 0.0.4
+    lines = []
+
+    def add_metric(name, type_, help_, samples):
+      lines.append(f"# HELP {name} {help_}")
+      lines.append(f"# TYPE {name} {type_}")
+      for suffix, labels, value in samples:
+        lines.append(f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+
+    def per_relay(counters):
+      return [
+        ("", {"protocol": protocol, "direction": direction}, counter.value())
+        for (protocol, direction), counter in counters.items()
+      ]
+
+    add_metric("localhost_throttle_bytes_total", "counter", "Bytes relayed.", per_relay(self.bytes))
+    add_metric(
+      "localhost_throttle_packets_total",
+      "counter",
+      "Datagrams relayed for UDP, chunks relayed for TCP.",
+      per_relay(self.packets),
+    )
+    add_metric(
+      "localhost_throttle_open_tcp_connections",
+      "gauge",
+      "TCP connections currently relayed.",
+      [("", {}, self.open_tcp_connections.value())],
+    )
+    add_metric(
+      "localhost_throttle_udp_sessions",
+      "gauge",
+      "UDP clients currently relayed.",
+      [("", {}, self.udp_sessions.value())],
+    )
+
+    bucket_counts, sum_ = self.throttle_sleep_seconds.value()
+    samples = []
+    cumulative_count = 0
+    for bound, count in zip((*self.throttle_sleep_seconds.buckets, "+Inf"), bucket_counts):
+      cumulative_count += count
+      samples.append(("_bucket", {"le": bound}, cumulative_count))
+    samples.append(("_sum", {}, sum_))
+    samples.append(("_count", {}, cumulative_count))
+    add_metric(
+      "localhost_throttle_throttle_sleep_seconds",
+      "histogram",
+      "Time chunks and datagrams waited for their bandwidth limit.",
+      samples,
+    )
+
+    with self._lock:
+      gauges = list(self._gauges)
+    for name, help_, callback in gauges:
+      add_metric(name, "gauge", help_, [("", {}, callback())])
+    return "\n".join(lines) + "\n"
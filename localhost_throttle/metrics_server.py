@@ -0,0 +1,48 @@
+import http.server
+import logging
+
+from .context_util import RunFinally, RunIfException
+from .global_state import GlobalState
+from .hostname_and_port import HostnameAndPort
+from .metrics import Metrics
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+  # A scraper that stops sending its request must not block the server forever
+  timeout = 5
+
+  def do_GET(self):
+    if self.path.split("?", maxsplit=1)[0] != "/metrics":
+      self.send_error(404)
+      return
+    body = self.server.metrics.render().encode("utf-8")
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    logging.debug(f"Metrics request from {self.address_string()}: {format % args}")
+
+
+class _MetricsServer(http.server.HTTPServer):
+  def __init__(self, address: HostnameAndPort):
+    # HTTPServer listens on IPv4 unless told otherwise
+    self.address_family = address.family
+    super().__init__(address.to_address(), _MetricsRequestHandler, bind_and_activate=False)
+
+
+def serve_metrics(address: HostnameAndPort, *, metrics: Metrics, global_state: GlobalState):
+  # Scrapes are rare and cheap, so they are served one at a time by this thread
+  server = _MetricsServer(address)
+  server.metrics = metrics
+  server.timeout = 0
+  with RunIfException(lambda: server.socket.close()):
+    global_state.add_socket(server.socket)
+  with RunFinally(lambda: global_state.close_socket(server.socket)):
+    server.server_bind()
+    server.server_activate()
+    logging.info(f"Serving metrics on http://{address}/metrics")
+    while global_state.wait_readable([server.socket]):
+      server.handle_request()
@@ -0,0 +1,23 @@
+import time
+
+from .global_state import GlobalState
+
+# Waits longer than this sleep on the shutdown event first. Waking up from a sleep is late by the scheduler
+# granularity, so the last part of every wait is spent spinning on the clock instead
+spin_threshold = 0.001
+# Accuracy target of sleep_until() on an otherwise idle Linux or macOS machine: it never returns before the deadline
+# and returns at most this much after it. On Windows waking up from the sleep part is bound by the 15.6 ms timer tick
+accuracy_target = 0.0002
+
+
+def sleep_until(deadline: float, *, global_state: GlobalState, clock=time.perf_counter) -> bool:
+  # Deadlines are absolute, so a late wake up is not added to the waits that follow. Returns False on shutdown
+  time_to_sleep = deadline - clock() - spin_threshold
+  if time_to_sleep > 0 and global_state.wait_for_shutdown(time_to_sleep):
+    return False
+  while clock() < deadline:
+    if global_state.is_shutdown():
+      return False
+    # Releases the GIL so relays of other connections keep running while this one spins
+    time.sleep(0)
+  return True
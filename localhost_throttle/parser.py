@@ -1,49 +1,300 @@
 import argparse
 import logging
 
+from .chunk_sizer import default_buffer_size, socket_buffer_duration
+from .engine_type import Engine
 from .protocol_type import ProtocolSet
+from .redirect_tcp import default_backlog
 from .hostname_and_port import HostnameAndPort
+from .load_balancer import default_ejection_time, default_max_failures
+from .load_balancing_type import LoadBalancing
+from .token_bucket import default_burst_duration
+from .trace_end_type import TraceEnd
+from .udp_pacing import default_max_queue_size, default_max_total_queue_size
+from .upstream_pool import default_refill_rate
+from .worker_pool import default_max_workers
 
 default_poll_interval = 0.01
+default_udp_reorder_delay = 0.01
+default_udp_session_timeout = 120.0
 
 
 def parse_log_level(str_: str):
   return logging.getLevelName(str_.upper())
 
 
+def parse_probability(str_: str):
+  probability = float(str_)
+  if not 0 <= probability <= 1:
+    raise ValueError(f"Probability should be in range [0, 1]. Got: {probability}")
+  return probability
+
+
+def parse_gilbert_elliott(str_: str):
+  parameters = tuple(parse_probability(x) for x in str_.split(","))
+  if not 2 <= len(parameters) <= 4:
+    raise ValueError(f"Expected 'p,r[,bad_loss[,good_loss]]'. Got: {str_}")
+  return parameters
+
+
+def parse_buffer_size(str_: str):
+  buffer_size = int(str_)
+  if buffer_size < 1:
+    raise ValueError(f"Buffer size should be positive. Got: {buffer_size}")
+  return buffer_size
+
+
+def parse_backends(str_: str) -> list[HostnameAndPort]:
+  return [HostnameAndPort.from_string(x) for x in str_.split(",")]
+
+
+def per_direction(parse_value):
+  def parse_per_direction(str_: str):
+    values = [parse_value(x) for x in str_.split("/")]
+    if len(values) == 1:
+      values = values * 2
+    if len(values) != 2:
+      raise ValueError(f"Expected 'value' or 'client_to_server/server_to_client'. Got: {str_}")
+    return tuple(values)
+
+  parse_per_direction.__name__ = parse_value.__name__
+  return parse_per_direction
+
+
 def create_parser():
   parser = argparse.ArgumentParser(description="Throttle localhost connection")
   parser.add_argument(
     "--server",
     "--server-addr",
     "--server-address",
-    type=HostnameAndPort.from_string,
-    required=True,
-    help='address on which the original server is located in the format "host:port". "localhost-throttle" subscribes to it',
+    type=parse_backends,
+    required=False,
+    help='address on which the original server is located in the format "host:port", "[ipv6]:port" or "unix:/path". "localhost-throttle" subscribes to it. Several servers are separated with "," and share the clients according to --load-balancing. Required unless --config is given',
   )
   parser.add_argument(
     "--new-server",
     "--new-server-addr",
     "--new-server-address",
     type=HostnameAndPort.from_string,
-    required=True,
-    help='bind new server to this address. Format: "host:port" New server is handled by "localhost-throttle". Clients should connect to new server',
+    required=False,
+    help='bind new server to this address. Format: "host:port", "[ipv6]:port" or "unix:/path", which serves a single protocol. New server is handled by "localhost-throttle". Clients should connect to new server. Required unless --config is given',
   )
   parser.add_argument(
     "--protocols",
     type=ProtocolSet.from_string,
-    required=True,
-    help="protocols to redirect. Supported values: 'tcp', 'udp', 'tcp,udp'",
+    required=False,
+    help="protocols to redirect. Supported values: 'tcp', 'udp', 'tcp,udp'. Required unless --config is given",
+  )
+  parser.add_argument(
+    "--config",
+    type=str,
+    default=None,
+    required=False,
+    help='JSON or TOML (Python 3.11+, by the ".toml" extension) file that declares many listeners served by one process. Its "listeners" list holds tables of options named like the command line ones, e.g. {"server": "localhost:8080", "new-server": "localhost:8081", "protocols": "tcp", "bandwidth": 100000}. Other top-level options and then the command line apply to every listener, options of a listener take precedence over both',
+  )
+  parser.add_argument(
+    "--bandwidth",
+    type=float,
+    required=False,
+    help="Bandwidth in bytes per second of each direction of every TCP connection and UDP client. Can be ommitted for unlimited",
+  )
+  parser.add_argument(
+    "--client-bandwidth",
+    type=float,
+    required=False,
+    help="Bandwidth in bytes per second of each direction shared by all connections from the same client IP. Can be ommitted for unlimited",
+  )
+  parser.add_argument(
+    "--global-bandwidth",
+    type=float,
+    required=False,
+    help="Bandwidth in bytes per second of each direction shared by all TCP and UDP traffic of the process, one budget for all listeners of a config. Can be ommitted for unlimited",
+  )
+  parser.add_argument(
+    "--bandwidth-trace",
+    type=str,
+    default=None,
+    required=False,
+    help='file with the bandwidth over time of each direction of every TCP connection and UDP client, instead of --bandwidth. Rows of a ".csv" file are "seconds,bytes_per_second", each rate lasts until the next row and the last row marks the end. Other files are mahimahi traces: one line per 1500 byte delivery opportunity with its time in milliseconds. Every connection follows the trace in real time from the start of the process',
+  )
+  parser.add_argument(
+    "--bandwidth-trace-end",
+    type=TraceEnd.from_string,
+    default=TraceEnd.LOOP,
+    required=False,
+    help="what happens at the end of --bandwidth-trace. 'loop' replays it, 'stop' keeps the last rate of a CSV trace or the average rate of a mahimahi trace. Supported values: 'loop', 'stop' (default: loop)",
+  )
+  parser.add_argument(
+    "--burst",
+    type=float,
+    required=False,
+    help=f"Maximum number of bytes that can be sent at once after being idle. Also limits the size of a single read. (default: bandwidth * {default_burst_duration})",
+  )
+  parser.add_argument(
+    "--latency",
+    type=float,
+    required=False,
+    help="One-way delay in seconds added to each direction of every TCP connection and UDP client. Can be ommitted for no delay",
+  )
+  parser.add_argument(
+    "--jitter",
+    type=float,
+    required=False,
+    help="Maximum random deviation in seconds from --latency. Can be ommitted for no jitter",
+  )
+  parser.add_argument(
+    "--preserve-order",
+    action="store_true",
+    help="Do not let jitter reorder UDP datagrams. TCP streams are never reordered",
+  )
+  parser.add_argument(
+    "--udp-loss",
+    type=per_direction(parse_probability),
+    required=False,
+    help='Probability to drop a UDP datagram. Format: "p" for both directions or "client_to_server/server_to_client"',
+  )
+  parser.add_argument(
+    "--udp-duplicate",
+    type=per_direction(parse_probability),
+    required=False,
+    help='Probability to send a UDP datagram twice. Format: "p" for both directions or "client_to_server/server_to_client"',
+  )
+  parser.add_argument(
+    "--udp-reorder",
+    type=per_direction(parse_probability),
+    required=False,
+    help='Probability to hold a UDP datagram back for --udp-reorder-delay so that the following ones overtake it. Format: "p" for both directions or "client_to_server/server_to_client"',
+  )
+  parser.add_argument(
+    "--udp-reorder-delay",
+    type=float,
+    default=default_udp_reorder_delay,
+    required=False,
+    help=f"Time in seconds a reordered UDP datagram is held back. (default: {default_udp_reorder_delay})",
+  )
+  parser.add_argument(
+    "--udp-session-timeout",
+    type=float,
+    default=default_udp_session_timeout,
+    required=False,
+    help=f"Time in seconds after which a UDP client that neither sent nor received datagrams is forgotten: its upstream socket is closed and its relay thread ends. 0 keeps idle clients forever. (default: {default_udp_session_timeout})",
+  )
+  parser.add_argument(
+    "--udp-max-sessions",
+    type=int,
+    default=None,
+    required=False,
+    help="Maximum number of UDP clients relayed at the same time. When a new client arrives over the limit, the least recently active one is forgotten. Unlimited by default",
+  )
+  parser.add_argument(
+    "--udp-queue-size",
+    type=parse_buffer_size,
+    default=default_max_queue_size,
+    required=False,
+    help=f"Maximum bytes of throttled datagrams of one UDP client waiting to be sent to the server. Datagrams over the limit are dropped, a single one always fits. (default: {default_max_queue_size})",
+  )
+  parser.add_argument(
+    "--udp-total-queue-size",
+    type=parse_buffer_size,
+    default=default_max_total_queue_size,
+    required=False,
+    help=f"Maximum bytes of throttled datagrams of all UDP clients of a listener waiting to be sent to the server. Datagrams over the limit are dropped. (default: {default_max_total_queue_size})",
+  )
+  parser.add_argument(
+    "--udp-gilbert-elliott",
+    type=per_direction(parse_gilbert_elliott),
+    required=False,
+    help='Gilbert-Elliott burst loss of UDP datagrams. Format: "p,r[,bad_loss[,good_loss]]" where p is the probability to enter the bad state and r to leave it. Use "/" to separate client_to_server and server_to_client parameters',
+  )
+  parser.add_argument(
+    "--seed",
+    type=int,
+    required=False,
+    help="Seed for random decisions (UDP impairments). Runs with the same seed and traffic make the same decisions",
+  )
+  parser.add_argument(
+    "--upstream-pool-size",
+    type=int,
+    default=0,
+    required=False,
+    help="Number of idle TCP connections to the server kept open in advance, so that new clients are relayed without waiting for a connect. Broken idle connections are replaced. 0 disables the pool. (default: 0)",
+  )
+  parser.add_argument(
+    "--upstream-pool-refill-rate",
+    type=float,
+    default=default_refill_rate,
+    required=False,
+    help=f"Maximum number of idle TCP connections to the server opened per second to refill the pool. (default: {default_refill_rate})",
+  )
+  parser.add_argument(
+    "--load-balancing",
+    type=LoadBalancing.from_string,
+    default=LoadBalancing.ROUND_ROBIN,
+    required=False,
+    help="how TCP connections and UDP clients are spread over several servers. 'least-connections' picks the server with the fewest of them, 'consistent-hash' keeps every client IP on the same server. Supported values: 'round-robin', 'least-connections', 'consistent-hash' (default: round-robin)",
+  )
+  parser.add_argument(
+    "--backend-ejection-time",
+    type=float,
+    default=default_ejection_time,
+    required=False,
+    help=f"Time in seconds a server that failed is skipped by the load balancing. It still gets clients when every server is skipped. (default: {default_ejection_time})",
+  )
+  parser.add_argument(
+    "--backend-max-failures",
+    type=int,
+    default=default_max_failures,
+    required=False,
+    help=f"Number of consecutive failures (refused or timed out TCP connects, ICMP port unreachable for UDP) after which a server is skipped. (default: {default_max_failures})",
+  )
+  parser.add_argument(
+    "--backlog",
+    type=int,
+    default=default_backlog,
+    required=False,
+    help=f"Maximum number of TCP connections waiting to be accepted. The system may lower it. The threads engine stops accepting while this many accepted connections wait for a worker. (default: {default_backlog})",
   )
   parser.add_argument(
-    "--bandwidth", type=float, required=False, help="Bandwidth in bytes per second. Can be ommitted for unlimited"
+    "--buffer-size",
+    type=parse_buffer_size,
+    default=default_buffer_size,
+    required=False,
+    help=f"Largest read in bytes of each direction of a TCP connection, which holds a buffer of this size. Reads start small and grow while data keeps coming, limits cut them to what they let through at once, and kernel socket buffers of throttled connections are sized for {socket_buffer_duration} seconds at their rate. (default: {default_buffer_size})",
+  )
+  parser.add_argument(
+    "--max-workers",
+    type=int,
+    default=default_max_workers,
+    required=False,
+    help=f"Maximum number of TCP connections served at once with the 'threads' engine. Every connection takes a thread per direction, connections over the limit wait for a free slot. Idle threads are reused. (default: {default_max_workers})",
+  )
+  parser.add_argument(
+    "--engine",
+    type=Engine.from_string,
+    default=Engine.THREADS,
+    required=False,
+    help="engine that serves TCP connections. 'threads' uses OS threads per connection, 'asyncio' serves every connection on one event loop. Supported values: 'threads', 'asyncio' (default: threads)",
+  )
+  parser.add_argument(
+    "--metrics-address",
+    type=HostnameAndPort.from_string,
+    default=None,
+    required=False,
+    help='address in the format "host:port" or "[ipv6]:port" on which bytes, packets, connections and throttling statistics are served for Prometheus at "/metrics". Disabled by default',
+  )
+  parser.add_argument(
+    "--control-socket",
+    type=str,
+    default=None,
+    required=False,
+    help='path of a Unix socket that accepts JSON requests, one per line, to list live TCP connections and UDP sessions with their byte counts, change bandwidth and delay of every listener, one listener or one connection, and close connections. E.g. {"command": "set", "listener": 0, "bandwidth": 100000}. Not available on Windows. Disabled by default',
   )
   parser.add_argument(
     "--poll-interval",
     type=float,
     default=default_poll_interval,
     required=False,
-    help=f'Polling interval for blocking calls. This value controls how fast "localhost-throttle" responds to user actions like Ctrl+C. (default: {default_poll_interval})',
+    help=f'Polling interval of the main thread on Windows, where Ctrl+C cannot interrupt a blocking wait. This value controls how fast "localhost-throttle" responds to Ctrl+C there. Everywhere else all waits are woken up by events. (default: {default_poll_interval})',
   )
   parser.add_argument("--log-level", type=parse_log_level, required=False, help="Logging level")
   return parser
@@ -1,128 +1,299 @@
+import contextlib
+import errno
 import logging
-import select
+import os
 import socket
 import threading
+import time
 
+from .buffer_pool import BufferPool
+from .chunk_sizer import ChunkSizer, SocketBuffers, default_buffer_size
 from .context_util import RunIfException, RunFinally
+from .control import ListenerControl
+from .delayed_sender import DelayedSender
+from .direction_type import Direction
 from .global_state import GlobalState
 from .hostname_and_port import HostnameAndPort
-from .util import sleep_with_poll
+from .latency import LatencyEmulator
+from .load_balancer import Backend, LoadBalancer
+from .metrics import Metrics, RelayMetrics
+from .pacing import sleep_until
+from .protocol_type import Protocol
+from .relay_control import RelayControl
+from .upstream_pool import UpstreamPool, connect, default_connect_timeout
+from .worker_pool import WorkerPool
+
+default_backlog = socket.SOMAXCONN
+# Relays that wait for the peer to take their delayed data check for shutdown and the end of the connection this often
+room_wait_interval = 0.1
 
 
 class RedirectClientTCP:
-  # TODO: Customize buffer_size
   def __init__(
     self,
     in_socket,
     out_socket,
     *,
-    bandwidth: float | None,
+    client_address,
+    relays: dict[Direction, RelayControl],
+    latency_emulator: LatencyEmulator,
+    buffer_pool: BufferPool,
+    metrics: Metrics,
     global_state: GlobalState,
-    poll_interval: float,
-    buffer_size: int = 65536,
   ):
     self.in_socket = in_socket
     self.out_socket = out_socket
-    self.buffer_size = buffer_size
-    self.poll_interval = poll_interval
+    self.client_address = client_address
+    self.relays = relays
+    self.buffer_pool = buffer_pool
+    self.buffer_size = buffer_pool.buffer_size
     self.global_state = global_state
-    self.bandwidth = bandwidth
-    self._stopped = None
-    self._thread_in_to_out = None
-    self._thread_out_to_in = None
-
-  def _start_redirect_blocking(self, in_socket, out_socket, *, global_state: GlobalState):
-    buffer_size = self.buffer_size
-    bandwidth = self.bandwidth
-    while not global_state.is_shutdown() and not self._stopped.isSet():
-      try:
-        new_data, _, _ = select.select([in_socket], [], [], self.poll_interval)
-        if not new_data:
-          continue
-        data = in_socket.recv(buffer_size)
+    self.latency_emulator = latency_emulator
+    self.metrics = metrics
+    self._stopped = threading.Event()
 
-        data_length = len(data)
-        if data_length == 0:
-          out_socket.shutdown(socket.SHUT_RDWR)
+  def _start_splice_blocking(
+    self, in_socket, out_socket, *, relay: RelayControl, relay_metrics: RelayMetrics, global_state: GlobalState
+  ):
+    # Moves data socket -> pipe -> socket inside the kernel. Returns False if splice() is not supported for these
+    # sockets and nothing was relayed yet or if limits were set on the relay, so the caller continues with the
+    # recv/send loop. The pipe is always empty by then
+    pipe_read, pipe_write = os.pipe()
+    with RunFinally(lambda: os.close(pipe_read)), RunFinally(lambda: os.close(pipe_write)):
+      spliced_anything = False
+      while not global_state.is_shutdown() and not self._stopped.isSet():
+        try:
+          if not global_state.wait_readable([in_socket]):
+            continue
+          if relay.limiter_chain is not None or relay.delay_line is not None:
+            return False
+          data_length = os.splice(
+            in_socket.fileno(), pipe_write, self.buffer_size, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+          )
+          if data_length == 0:
+            out_socket.shutdown(socket.SHUT_RDWR)
+            self._stopped.set()
+            break
+          spliced_anything = True
+          relay.bytes += data_length
+          relay_metrics.record(data_length)
+          while data_length > 0:
+            data_length -= os.splice(pipe_read, out_socket.fileno(), data_length, flags=os.SPLICE_F_MOVE)
+        except BlockingIOError:
+          continue
+        except OSError as e:
+          if not spliced_anything and e.errno in (errno.EINVAL, errno.ENOSYS):
+            return False
           self._stopped.set()
-          break
-        if bandwidth is not None:
-          time_to_wait = data_length / bandwidth
-          sleep_with_poll(time_to_wait, poll_interval=self.poll_interval, global_state=global_state)
+        except ValueError:
+          self._stopped.set()
+    self._stopped.set()
+    return True
+
+  def _start_redirect_blocking(self, in_socket, out_socket, direction: Direction, *, global_state: GlobalState):
+    relay = self.relays[direction]
+    relay_metrics = self.metrics.relay(Protocol.TCP, direction)
+    if relay.limiter_chain is None and relay.delay_line is None and hasattr(os, "splice"):
+      if self._start_splice_blocking(
+        in_socket, out_socket, relay=relay, relay_metrics=relay_metrics, global_state=global_state
+      ):
+        return
+    chunk_sizer = ChunkSizer(self.buffer_size)
+    socket_buffers = SocketBuffers(in_socket, out_socket)
+    delayed_sender = None
+    with self.buffer_pool.buffer() as buffer:
+      while not global_state.is_shutdown() and not self._stopped.isSet():
+        try:
+          # Reading stops while the peer does not take the delayed data. Waits are short, so that shutdown and the end
+          # of the connection are noticed
+          if delayed_sender is not None and not delayed_sender.wait_for_room(room_wait_interval):
+            continue
+          if not global_state.wait_readable([in_socket]):
+            continue
+          # Limits may be changed by the control API at any time, so they are read once per chunk
+          limiter_chain = relay.limiter_chain
+          delay_line = relay.delay_line
+          if delay_line is not None and delayed_sender is None:
+            # A TCP delay line is never removed again, so the sender stays until the end of the stream
+            delayed_sender = DelayedSender(
+              out_socket, latency_emulator=self.latency_emulator, on_finish=self._stopped.set
+            )
+          socket_buffers.update(limiter_chain)
+          buffer_size = chunk_sizer.next_size(limiter_chain)
+          data_length = in_socket.recv_into(buffer, buffer_size)
+          chunk_sizer.record(buffer_size, data_length)
 
-        out_socket.send(data)
-      except (OSError, ValueError):
-        self._stopped.set()
+          if data_length == 0:
+            if delayed_sender is not None:
+              delayed_sender.shutdown(delay_line)
+              return
+            out_socket.shutdown(socket.SHUT_RDWR)
+            self._stopped.set()
+            break
+          relay.bytes += data_length
+          relay_metrics.record(data_length)
+          if limiter_chain is not None:
+            time_to_wait = limiter_chain.consume(data_length)
+            relay_metrics.record_throttle(time_to_wait)
+            sleep_until(time.perf_counter() + time_to_wait, global_state=global_state)
+
+          if delayed_sender is not None:
+            delayed_sender.send(bytes(buffer[:data_length]), delay_line)
+          else:
+            out_socket.sendall(buffer[:data_length])
+        except (OSError, ValueError):
+          self._stopped.set()
     self._stopped.set()
 
-  def start(self):
-    self._stopped = threading.Event()
-    self._thread_in_to_out = self.global_state.add_thread(f=self._start_redirect_blocking, args=(self.in_socket, self.out_socket))
-    self._thread_out_to_in = self.global_state.add_thread(f=self._start_redirect_blocking, args=(self.out_socket, self.in_socket))
+  def run(self, *, worker_pool: WorkerPool):
+    # Calling worker relays one direction itself. The other one gets a worker right away, a queue would let new
+    # connections take the freed workers first and leave this one relaying in one direction only
+    worker_pool.start(
+      self._start_redirect_blocking, args=(self.out_socket, self.in_socket, Direction.CLIENT_TO_SERVER)
+    )
+    self._start_redirect_blocking(
+      self.in_socket, self.out_socket, Direction.SERVER_TO_CLIENT, global_state=self.global_state
+    )
+    # Delayed data may still be on its way to the client. The delay scheduler sends nothing more after shutdown
+    while not self._stopped.wait(room_wait_interval) and not self.global_state.is_shutdown():
+      pass
 
   def stop(self):
+    # Relays blocked in a wait are woken up by the end of their streams
     self._stopped.set()
+    for sock in (self.in_socket, self.out_socket):
+      with contextlib.suppress(OSError, ValueError):
+        sock.shutdown(socket.SHUT_RDWR)
+
+
+def connect_to_backend(
+  client_address,
+  *,
+  load_balancer: LoadBalancer,
+  upstream_pools: dict[Backend, UpstreamPool],
+  global_state: GlobalState,
+):
+  # Backends are tried in the order of the load balancer. The ones that fail to connect are reported, so they get
+  # ejected, and the next one is tried
+  exception = None
+  for backend in load_balancer.candidates(client_address):
+    upstream_pool = upstream_pools.get(backend)
+    sock = upstream_pool.acquire(global_state=global_state) if upstream_pool is not None else None
+    if sock is not None:
+      return backend, sock
+    try:
+      sock = connect(backend.address, timeout=default_connect_timeout, global_state=global_state)
+    except OSError as e:
+      if global_state.is_shutdown():
+        raise
+      logging.debug(f"Failed to connect to backend {backend}: {e!r}")
+      backend.report_failure()
+      exception = e
+      continue
+    backend.report_success()
+    return backend, sock
+  raise exception
 
 
 def redirect_and_close_on_exception_tcp(
   *,
   client_socket,
   client_address,
-  server_address: HostnameAndPort,
-  bandwidth: float | None,
-  poll_interval: float,
+  load_balancer: LoadBalancer,
+  listener_control: ListenerControl,
+  buffer_pool: BufferPool,
+  metrics: Metrics,
+  worker_pool: WorkerPool,
+  upstream_pools: dict[Backend, UpstreamPool],
   global_state: GlobalState,
 ):
   with RunFinally(lambda: global_state.close_socket(client_socket)):
-    in_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    global_state.add_socket(in_socket)
-    with RunFinally(lambda: global_state.close_socket(in_socket)):
-      in_socket.connect(server_address.to_address())
+    backend, in_socket = connect_to_backend(
+      client_address, load_balancer=load_balancer, upstream_pools=upstream_pools, global_state=global_state
+    )
+    with RunFinally(lambda: global_state.close_socket(in_socket)), backend.connection():
+      relays = listener_control.create_relays(client_address, Protocol.TCP)
       redirect_in_to_client = RedirectClientTCP(
-        in_socket, client_socket, bandwidth=bandwidth, poll_interval=poll_interval, global_state=global_state
+        in_socket,
+        client_socket,
+        client_address=client_address,
+        relays=relays,
+        latency_emulator=listener_control.latency_emulator,
+        buffer_pool=buffer_pool,
+        metrics=metrics,
+        global_state=global_state,
       )
-      redirect_in_to_client.start()
-      logging.info(f"Opened TCP connection to {client_address}")
-      redirect_in_to_client._stopped.wait()
+      metrics.open_tcp_connections.add(1)
+      with (
+        RunFinally(lambda: metrics.open_tcp_connections.add(-1)),
+        listener_control.connection(Protocol.TCP, client_address, backend, relays, close=redirect_in_to_client.stop),
+      ):
+        logging.info(f"Opened TCP connection to {client_address} through {backend}")
+        redirect_in_to_client.run(worker_pool=worker_pool)
       in_socket.shutdown(socket.SHUT_RDWR)
     client_socket.shutdown(socket.SHUT_RDWR)
   logging.info(f"Closed TCP connection to {client_address}")
 
 
-# TODO: Make request_queue_size configurable
+def _accept_pending(listening_socket):
+  # Takes every connection that is already waiting, so a single wakeup serves a whole burst of clients
+  while True:
+    try:
+      yield listening_socket.accept()
+    except (BlockingIOError, InterruptedError):
+      return
+
+
 def redirect_tcp(
-  server_address: HostnameAndPort,
+  load_balancer: LoadBalancer,
   new_server_address: HostnameAndPort,
   *,
-  bandwidth: float | None,
+  listener_control: ListenerControl,
+  metrics: Metrics,
+  worker_pool: WorkerPool,
   global_state: GlobalState,
-  poll_interval: float,
-  request_queue_size: int = 100,
+  upstream_pools: dict[Backend, UpstreamPool] | None = None,
+  backlog: int = default_backlog,
+  buffer_size: int = default_buffer_size,
 ):
-  out_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  upstream_pools = upstream_pools if upstream_pools is not None else dict()
+  buffer_pool = BufferPool(buffer_size)
+  out_socket = socket.socket(new_server_address.family, socket.SOCK_STREAM)
   with RunIfException(lambda: out_socket.close()):
     global_state.add_socket(out_socket)
-  with RunFinally(lambda: global_state.close_socket(out_socket)):
-    out_socket.bind(new_server_address.to_address())
-    out_socket.listen(request_queue_size)
+  with RunFinally(lambda: global_state.close_socket(out_socket)), new_server_address.bound(out_socket):
+    out_socket.setblocking(False)
+    out_socket.listen(backlog)
+    max_queued_connections = max(1, backlog)
 
     while not global_state.is_shutdown():
-      new_connections, _, _ = select.select([out_socket], [], [], poll_interval)
-      if not new_connections:
+      # Connections over max_workers wait for a worker in the pool. Once `backlog` connections wait there, the listening
+      # socket is no longer watched, so further clients wait in the kernel and take no descriptors of this process
+      if worker_pool.queued_tasks >= max_queued_connections:
+        worker_pool.wait_for_room(max_queued_connections, room_wait_interval)
         continue
-      (client_socket, client_address) = out_socket.accept()
-      with RunIfException(lambda: client_socket.close()):
-        global_state.add_socket(client_socket)
-      with RunIfException(lambda: global_state.close_socket(client_socket)):
-        global_state.add_thread(
-          f=redirect_and_close_on_exception_tcp,
-          kwargs={
-            "client_socket": client_socket,
-            "client_address": client_address,
-            "server_address": server_address,
-            "bandwidth": bandwidth,
-            "poll_interval": poll_interval,
-          },
-        )
+      if not global_state.wait_readable([out_socket]):
+        continue
+      for client_socket, client_address in _accept_pending(out_socket):
+        with RunIfException(lambda: client_socket.close()):
+          global_state.add_socket(client_socket)
+          # Sockets accepted from a non-blocking one inherit its mode on some platforms
+          client_socket.setblocking(True)
+        with RunIfException(lambda: global_state.close_socket(client_socket)):
+          worker_pool.submit(
+            redirect_and_close_on_exception_tcp,
+            kwargs={
+              "client_socket": client_socket,
+              "client_address": client_address,
+              "load_balancer": load_balancer,
+              "listener_control": listener_control,
+              "buffer_pool": buffer_pool,
+              "metrics": metrics,
+              "worker_pool": worker_pool,
+              "upstream_pools": upstream_pools,
+            },
+          )
+        if worker_pool.queued_tasks >= max_queued_connections:
+          break
 
     out_socket.shutdown(socket.SHUT_RDWR)
@@ -0,0 +1,360 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import socket
+import time
+
+from .buffer_pool import BufferPool
+from .chunk_sizer import ChunkSizer, SocketBuffers, default_buffer_size
+from .context_util import RunIfException, RunFinally
+from .control import ListenerControl
+from .delayed_sender import default_max_delayed_bytes
+from .direction_type import Direction
+from .global_state import GlobalState
+from .hostname_and_port import HostnameAndPort
+from .load_balancer import Backend, LoadBalancer
+from .metrics import Metrics, RelayMetrics
+from .protocol_type import Protocol
+from .relay_control import RelayControl
+from .redirect_tcp import default_backlog
+from .upstream_pool import UpstreamPool, default_connect_timeout
+
+
+class _DelayedChunks:
+  # Chunks of one direction that wait for their deadline or for the peer to take them. The relay awaits room before
+  # every read, so at most max_bytes are in flight
+  def __init__(self, max_bytes: int = default_max_delayed_bytes):
+    self.max_bytes = max_bytes
+    self.bytes_in_flight = 0
+    self._queue = asyncio.Queue()
+    self._room = asyncio.Event()
+    self._room.set()
+
+  def put(self, deadline: float, data: bytes | None):
+    self._queue.put_nowait((deadline, data))
+    if data is not None:
+      self.bytes_in_flight += len(data)
+      if self.bytes_in_flight >= self.max_bytes:
+        self._room.clear()
+
+  async def get(self) -> tuple[float, bytes | None]:
+    return await self._queue.get()
+
+  def sent(self, data: bytes):
+    self.bytes_in_flight -= len(data)
+    if self.bytes_in_flight < self.max_bytes:
+      self._room.set()
+
+  def close(self):
+    # Relay must not wait for room that a finished sender never makes
+    self._room.set()
+
+  async def wait_for_room(self):
+    await self._room.wait()
+
+
+async def _send_delayed(out_socket, delayed_chunks: _DelayedChunks):
+  loop = asyncio.get_running_loop()
+  try:
+    while True:
+      deadline, data = await delayed_chunks.get()
+      time_to_wait = deadline - time.perf_counter()
+      if time_to_wait > 0:
+        await asyncio.sleep(time_to_wait)
+      if data is None:
+        out_socket.shutdown(socket.SHUT_RDWR)
+        return
+      await loop.sock_sendall(out_socket, data)
+      delayed_chunks.sent(data)
+  finally:
+    delayed_chunks.close()
+
+
+async def _start_redirect(
+  in_socket,
+  out_socket,
+  *,
+  relay: RelayControl,
+  buffer_pool: BufferPool,
+  relay_metrics: RelayMetrics,
+):
+  loop = asyncio.get_running_loop()
+  delayed_chunks = None
+  sender = None
+  chunk_sizer = ChunkSizer(buffer_pool.buffer_size)
+  socket_buffers = SocketBuffers(in_socket, out_socket)
+  with buffer_pool.buffer() as buffer:
+    try:
+      while sender is None or not sender.done():
+        if delayed_chunks is not None:
+          # Reading stops while the peer does not take the delayed data
+          await delayed_chunks.wait_for_room()
+          if sender.done():
+            break
+        limiter_chain = relay.limiter_chain
+        socket_buffers.update(limiter_chain)
+        buffer_size = chunk_sizer.next_size(limiter_chain)
+        data_length = await loop.sock_recv_into(in_socket, buffer[:buffer_size])
+        chunk_sizer.record(buffer_size, data_length)
+        # Control API may have changed the limits while the chunk was awaited
+        limiter_chain = relay.limiter_chain
+        delay_line = relay.delay_line
+        if delay_line is not None and sender is None:
+          # A TCP delay line is never removed again, so the sender stays until the end of the stream
+          delayed_chunks = _DelayedChunks()
+          sender = asyncio.create_task(_send_delayed(out_socket, delayed_chunks))
+
+        if data_length == 0:
+          if sender is not None:
+            # Data that is still in flight has to reach the peer before the end of the stream
+            delayed_chunks.put(delay_line.next_deadline(), None)
+            await sender
+          else:
+            out_socket.shutdown(socket.SHUT_RDWR)
+          break
+        relay.bytes += data_length
+        relay_metrics.record(data_length)
+        if limiter_chain is not None:
+          time_to_wait = limiter_chain.consume(data_length)
+          relay_metrics.record_throttle(time_to_wait)
+          await asyncio.sleep(time_to_wait)
+
+        if sender is not None:
+          delayed_chunks.put(delay_line.next_deadline(), bytes(buffer[:data_length]))
+        else:
+          await loop.sock_sendall(out_socket, buffer[:data_length])
+    except (OSError, ValueError):
+      pass
+    finally:
+      if sender is not None:
+        sender.cancel()
+
+
+def _shutdown(*sockets):
+  for sock in sockets:
+    with contextlib.suppress(OSError, ValueError):
+      sock.shutdown(socket.SHUT_RDWR)
+
+
+async def _connect(backend: Backend, *, global_state: GlobalState):
+  loop = asyncio.get_running_loop()
+  sock = socket.socket(backend.address.family, socket.SOCK_STREAM)
+  with RunIfException(lambda: sock.close()):
+    global_state.add_socket(sock)
+  with RunIfException(lambda: global_state.close_socket(sock)):
+    sock.setblocking(False)
+    await asyncio.wait_for(loop.sock_connect(sock, backend.address.to_address()), timeout=default_connect_timeout)
+  return sock
+
+
+async def _connect_to_backend(
+  client_address,
+  *,
+  load_balancer: LoadBalancer,
+  upstream_pools: dict[Backend, UpstreamPool],
+  global_state: GlobalState,
+):
+  # Same as connect_to_backend of the threads engine. Taking a connection from a pool never blocks, its health check
+  # only peeks at the socket
+  exception = None
+  for backend in load_balancer.candidates(client_address):
+    upstream_pool = upstream_pools.get(backend)
+    sock = upstream_pool.acquire(global_state=global_state) if upstream_pool is not None else None
+    if sock is not None:
+      sock.setblocking(False)
+      return backend, sock
+    try:
+      sock = await _connect(backend, global_state=global_state)
+    except (OSError, asyncio.TimeoutError) as e:
+      logging.debug(f"Failed to connect to backend {backend}: {e!r}")
+      backend.report_failure()
+      exception = e
+      continue
+    backend.report_success()
+    return backend, sock
+  raise exception
+
+
+async def _redirect_and_close_on_exception_tcp(
+  *,
+  client_socket,
+  client_address,
+  load_balancer: LoadBalancer,
+  listener_control: ListenerControl,
+  buffer_pool: BufferPool,
+  metrics: Metrics,
+  global_state: GlobalState,
+  upstream_pools: dict[Backend, UpstreamPool],
+):
+  with RunFinally(lambda: global_state.close_socket(client_socket)):
+    backend, in_socket = await _connect_to_backend(
+      client_address, load_balancer=load_balancer, upstream_pools=upstream_pools, global_state=global_state
+    )
+    with RunFinally(lambda: global_state.close_socket(in_socket)), backend.connection():
+      relays = listener_control.create_relays(client_address, Protocol.TCP)
+      directions = [
+        asyncio.create_task(
+          _start_redirect(
+            in_socket,
+            client_socket,
+            relay=relays[Direction.SERVER_TO_CLIENT],
+            buffer_pool=buffer_pool,
+            relay_metrics=metrics.relay(Protocol.TCP, Direction.SERVER_TO_CLIENT),
+          )
+        ),
+        asyncio.create_task(
+          _start_redirect(
+            client_socket,
+            in_socket,
+            relay=relays[Direction.CLIENT_TO_SERVER],
+            buffer_pool=buffer_pool,
+            relay_metrics=metrics.relay(Protocol.TCP, Direction.CLIENT_TO_SERVER),
+          )
+        ),
+      ]
+      logging.info(f"Opened TCP connection to {client_address} through {backend}")
+      metrics.open_tcp_connections.add(1)
+      try:
+        # Ends of the streams wake both directions up when the control API kills the connection
+        with listener_control.connection(
+          Protocol.TCP, client_address, backend, relays, close=functools.partial(_shutdown, in_socket, client_socket)
+        ):
+          await asyncio.wait(directions, return_when=asyncio.FIRST_COMPLETED)
+      finally:
+        metrics.open_tcp_connections.add(-1)
+        for direction in directions:
+          direction.cancel()
+        await asyncio.gather(*directions, return_exceptions=True)
+      with contextlib.suppress(OSError):
+        in_socket.shutdown(socket.SHUT_RDWR)
+    with contextlib.suppress(OSError):
+      client_socket.shutdown(socket.SHUT_RDWR)
+  logging.info(f"Closed TCP connection to {client_address}")
+
+
+def _log_connection_exception(connection):
+  if not connection.cancelled() and connection.exception() is not None:
+    logging.debug(f"TCP connection finished with exception:\n{connection.exception()!r}")
+
+
+async def _accept_forever(
+  out_socket,
+  *,
+  load_balancer: LoadBalancer,
+  listener_control: ListenerControl,
+  buffer_pool: BufferPool,
+  metrics: Metrics,
+  global_state: GlobalState,
+  upstream_pools: dict[Backend, UpstreamPool],
+):
+  loop = asyncio.get_running_loop()
+  connections = set()
+  try:
+    while True:
+      client_socket, client_address = await loop.sock_accept(out_socket)
+      client_socket.setblocking(False)
+      with RunIfException(lambda: client_socket.close()):
+        global_state.add_socket(client_socket)
+      connection = asyncio.create_task(
+        _redirect_and_close_on_exception_tcp(
+          client_socket=client_socket,
+          client_address=client_address,
+          load_balancer=load_balancer,
+          listener_control=listener_control,
+          buffer_pool=buffer_pool,
+          metrics=metrics,
+          global_state=global_state,
+          upstream_pools=upstream_pools,
+        )
+      )
+      connections.add(connection)
+      connection.add_done_callback(connections.discard)
+      connection.add_done_callback(_log_connection_exception)
+  finally:
+    for connection in connections:
+      connection.cancel()
+    await asyncio.gather(*connections, return_exceptions=True)
+
+
+async def _wait_for_shutdown(*, global_state: GlobalState):
+  loop = asyncio.get_running_loop()
+  is_shutdown = asyncio.Event()
+
+  def notify():
+    # Event loop may already be closed if it finished for another reason
+    with contextlib.suppress(RuntimeError):
+      loop.call_soon_threadsafe(is_shutdown.set)
+
+  global_state.on_shutdown(notify)
+  await is_shutdown.wait()
+
+
+async def _redirect_tcp(
+  load_balancer: LoadBalancer,
+  new_server_address: HostnameAndPort,
+  *,
+  listener_control: ListenerControl,
+  metrics: Metrics,
+  global_state: GlobalState,
+  upstream_pools: dict[Backend, UpstreamPool],
+  backlog: int,
+  buffer_size: int,
+):
+  buffer_pool = BufferPool(buffer_size)
+  out_socket = socket.socket(new_server_address.family, socket.SOCK_STREAM)
+  with RunIfException(lambda: out_socket.close()):
+    global_state.add_socket(out_socket)
+  with RunFinally(lambda: global_state.close_socket(out_socket)), new_server_address.bound(out_socket):
+    out_socket.setblocking(False)
+    out_socket.listen(backlog)
+
+    accept_forever = asyncio.create_task(
+      _accept_forever(
+        out_socket,
+        load_balancer=load_balancer,
+        listener_control=listener_control,
+        buffer_pool=buffer_pool,
+        metrics=metrics,
+        global_state=global_state,
+        upstream_pools=upstream_pools,
+      )
+    )
+    wait_for_shutdown = asyncio.create_task(_wait_for_shutdown(global_state=global_state))
+    try:
+      await asyncio.wait([accept_forever, wait_for_shutdown], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+      accept_forever.cancel()
+      wait_for_shutdown.cancel()
+      results = await asyncio.gather(accept_forever, wait_for_shutdown, return_exceptions=True)
+    for result in results:
+      if isinstance(result, BaseException) and not isinstance(result, asyncio.CancelledError):
+        raise result
+
+    with contextlib.suppress(OSError):
+      out_socket.shutdown(socket.SHUT_RDWR)
+
+
+def redirect_tcp_asyncio(
+  load_balancer: LoadBalancer,
+  new_server_address: HostnameAndPort,
+  *,
+  listener_control: ListenerControl,
+  metrics: Metrics,
+  global_state: GlobalState,
+  upstream_pools: dict[Backend, UpstreamPool] | None = None,
+  backlog: int = default_backlog,
+  buffer_size: int = default_buffer_size,
+):
+  asyncio.run(
+    _redirect_tcp(
+      load_balancer,
+      new_server_address,
+      listener_control=listener_control,
+      metrics=metrics,
+      global_state=global_state,
+      upstream_pools=upstream_pools if upstream_pools is not None else dict(),
+      backlog=backlog,
+      buffer_size=buffer_size,
+    )
+  )
@@ -1,82 +1,243 @@
+import collections
+import functools
 import logging
-import select
 import socket
 
+from .buffer_pool import BufferPool
 from .context_util import RunIfException, RunFinally
-from .global_state import GlobalState
+from .control import ListenerControl, LiveConnection
+from .direction_type import Direction
+from .global_state import GlobalState, WakeupSocketPair
 from .hostname_and_port import HostnameAndPort
-from .util import sleep_with_poll
+from .impairment import ImpairmentEmulator
+from .load_balancer import LoadBalancer
+from .metrics import Metrics
+from .protocol_type import Protocol
+from .udp_datagram import (
+  batch_buffer_size,
+  bind_for_replies,
+  no_impairment,
+  receive_batch,
+  remove_reply_socket_file,
+  send_datagram,
+)
+from .udp_pacing import PacedDatagramQueues, default_max_queue_size, default_max_total_queue_size
+from .udp_reply_demultiplexer import UDPReplyDemultiplexer
+from .udp_session import UDPSession, UDPSessionTable
 
 
-def start_redirect_blocking(out_address, in_socket, out_socket, *, bandwidth, global_state, poll_interval, buffer_size=65536):
-  while not global_state.is_shutdown():
-    new_data, _, _ = select.select([in_socket], [], [], poll_interval)
-    if not new_data:
+def close_backend_socket(sock, reply_path: str | None, *, global_state: GlobalState):
+  global_state.close_socket(sock)
+  if reply_path is not None:
+    remove_reply_socket_file(reply_path)
+
+
+def connect_to_backend(client_address, *, load_balancer: LoadBalancer, global_state: GlobalState):
+  # Backends are tried in the order of the load balancer. Connecting to a Unix socket fails right away when the backend
+  # is down, which is reported, so it gets ejected, and the next one is tried
+  exception = None
+  for backend in load_balancer.candidates(client_address):
+    server_client_socket = socket.socket(backend.address.family, socket.SOCK_DGRAM)
+    with RunIfException(lambda: server_client_socket.close()):
+      global_state.add_socket(server_client_socket)
+    reply_path = None
+    try:
+      reply_path = bind_for_replies(server_client_socket, backend.address.family)
+      # Connected socket hears back about a backend that is down, so it can be ejected
+      server_client_socket.connect(backend.address.to_address())
+    except OSError as e:
+      close_backend_socket(server_client_socket, reply_path, global_state=global_state)
+      logging.debug(f"Failed to connect to backend {backend}: {e!r}")
+      backend.report_failure()
+      exception = e
       continue
-    data, _ = in_socket.recvfrom(buffer_size)
-    if bandwidth is not None:
-      time_to_sleep = len(data) / bandwidth
-      sleep_with_poll(time_to_sleep, poll_interval=poll_interval, global_state=global_state)
-    out_socket.sendto(data, out_address)
+    return backend, server_client_socket, reply_path
+  raise exception
 
 
-def redirect_and_close_on_exception_udp(*, client_address, out_socket, in_socket, bandwidth, poll_interval, global_state):
-  logging.info(f"Opened UDP connection to {client_address}")
-  start_redirect_blocking(
-    client_address, in_socket, out_socket, bandwidth=bandwidth, poll_interval=poll_interval, global_state=global_state
+def open_session(
+  client_address,
+  *,
+  load_balancer: LoadBalancer,
+  listener_control: ListenerControl,
+  impairment_emulator: ImpairmentEmulator,
+  global_state: GlobalState,
+) -> UDPSession:
+  backend, server_client_socket, reply_path = connect_to_backend(
+    client_address, load_balancer=load_balancer, global_state=global_state
   )
-  logging.info(f"Closed UDP connection to {client_address}")
+  with RunIfException(lambda: close_backend_socket(server_client_socket, reply_path, global_state=global_state)):
+    server_client_socket.setblocking(False)
+    impairments = impairment_emulator.create_session_impairments()
+    session = UDPSession(
+      client_address,
+      server_client_socket,
+      relays=listener_control.create_relays(client_address, Protocol.UDP),
+      impairment=impairments[Direction.CLIENT_TO_SERVER],
+      reply_impairment=impairments[Direction.SERVER_TO_CLIENT],
+      backend=backend,
+      reply_path=reply_path,
+    )
+  backend.open_connection()
+  logging.info(f"Opened UDP connection to {client_address} through {backend}")
+  return session
+
+
+def close_removed_sessions(
+  sessions: list[UDPSession],
+  *,
+  killed: bool,
+  session_table: UDPSessionTable,
+  paced_queues: PacedDatagramQueues,
+  reply_demultiplexer: UDPReplyDemultiplexer,
+  listener_control: ListenerControl,
+):
+  # Sessions were either killed through the control API or evicted by the table, only the latter count as evicted
+  for session in sessions:
+    if killed:
+      logging.info(f"Killed UDP connection to {session.client_address}")
+    else:
+      logging.info(
+        f"Evicted UDP connection to {session.client_address} (evicted in total: {session_table.evicted_sessions})"
+      )
+    listener_control.remove(session.live_connection)
+    paced_queues.discard(session)
+    reply_demultiplexer.remove_session(session)
 
 
 def redirect_udp(
-  server_address: HostnameAndPort,
+  load_balancer: LoadBalancer,
   new_server_address: HostnameAndPort,
   *,
-  bandwidth: float | None,
+  listener_control: ListenerControl,
+  impairment_emulator: ImpairmentEmulator,
+  metrics: Metrics,
   global_state: GlobalState,
-  poll_interval: float,
+  session_timeout: float | None = None,
+  max_sessions: int | None = None,
+  max_queue_size: int = default_max_queue_size,
+  max_total_queue_size: int = default_max_total_queue_size,
 ):
-  client_address_to_socket_and_thread = dict()
+  session_table = UDPSessionTable(idle_timeout=session_timeout, max_sessions=max_sessions)
+  buffer_pool = BufferPool(batch_buffer_size)
 
-  out_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  relay_metrics = metrics.relay(Protocol.UDP, Direction.CLIENT_TO_SERVER)
+
+  def send_to_server(session: UDPSession, data, *, copies: int, extra_delay: float):
+    # Datagrams released from a queue keep their session from looking idle
+    session.touch()
+    session.relays[Direction.CLIENT_TO_SERVER].bytes += len(data)
+    relay_metrics.record(len(data))
+    try:
+      send_datagram(
+        session.server_client_socket,
+        data,
+        None,
+        copies=copies,
+        extra_delay=extra_delay,
+        delay_line=session.delay_line,
+        latency_emulator=listener_control.latency_emulator,
+      )
+    except (ConnectionRefusedError, ConnectionResetError):
+      # Backend answered an earlier datagram with ICMP port unreachable
+      session.backend.report_failure()
+
+  # Ingress only classifies datagrams, throttled ones wait in the queue of their own session
+  paced_queues = PacedDatagramQueues(
+    send_to_server,
+    max_queue_size=max_queue_size,
+    max_total_queue_size=max_total_queue_size,
+    relay_metrics=relay_metrics,
+  )
+
+  out_socket = socket.socket(new_server_address.family, socket.SOCK_DGRAM)
   with RunIfException(lambda: out_socket.close()):
     global_state.add_socket(out_socket)
-  with RunFinally(lambda: global_state.close_socket(out_socket)):
-    out_socket.bind(new_server_address.to_address())
-    buffer_size = 65537
-
-    while not global_state.is_shutdown():
-      new_connections, _, _ = select.select([out_socket], [], [], poll_interval)
-      if not new_connections:
-        continue
-      (message, client_address) = out_socket.recvfrom(buffer_size)
-      socket_and_thread = client_address_to_socket_and_thread.get(client_address)
-      if socket_and_thread is None:
-        server_client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        with RunIfException(lambda: server_client_socket.close()):
-          global_state.add_socket(server_client_socket)
-        with RunIfException(lambda: global_state.close_socket(server_client_socket)):
-          server_client_socket.bind(("localhost", 0))
-          thread = global_state.add_thread(
-            f=redirect_and_close_on_exception_udp,
-            kwargs={
-              "client_address": client_address,
-              "out_socket": out_socket,
-              "in_socket": server_client_socket,
-              "bandwidth": bandwidth,
-              "poll_interval": poll_interval,
-            },
-          )
-          client_address_to_socket_and_thread[client_address] = (server_client_socket, thread)
-      else:
-        server_client_socket, _ = socket_and_thread
-
-      if bandwidth is not None:
-        time_to_sleep = len(message) / bandwidth
-        sleep_with_poll(time_to_sleep, poll_interval=poll_interval, global_state=global_state)
-      server_client_socket.sendto(message, server_address.to_address())
-
-    out_socket.shutdown(socket.SHUT_RDWR)
-    for sock, _ in client_address_to_socket_and_thread.items():
-      sock.shutdown(socket.SHUT_RDWR)
-      global_state.close_socket(sock)
+  with RunFinally(lambda: global_state.close_socket(out_socket)), new_server_address.bound(out_socket):
+    out_socket.setblocking(False)
+    # Replies of every client are relayed by one thread, so the number of threads does not grow with clients
+    reply_demultiplexer = UDPReplyDemultiplexer(
+      out_socket,
+      latency_emulator=listener_control.latency_emulator,
+      buffer_pool=buffer_pool,
+      metrics=metrics,
+      global_state=global_state,
+    )
+    reply_thread = global_state.add_thread(f=reply_demultiplexer.run_forever)
+    # Sessions killed through the control API are evicted by this thread, the only one that modifies the table
+    killed_sessions = collections.deque()
+    wakeup = WakeupSocketPair(global_state=global_state)
+
+    def kill_session(session: UDPSession):
+      killed_sessions.append(session)
+      wakeup.wake_up()
+
+    def close_sessions(sessions: list[UDPSession], *, killed: bool = False):
+      close_removed_sessions(
+        sessions,
+        killed=killed,
+        session_table=session_table,
+        paced_queues=paced_queues,
+        reply_demultiplexer=reply_demultiplexer,
+        listener_control=listener_control,
+      )
+
+    with (
+      RunFinally(lambda: wakeup.close()),
+      RunFinally(lambda: reply_thread.join()),
+      RunFinally(lambda: reply_demultiplexer.stop()),
+      RunFinally(lambda: session_table.stop_all()),
+      buffer_pool.buffer() as buffer,
+    ):
+      while not global_state.is_shutdown():
+        # Without queued datagrams and sessions to check for idleness the loop sleeps until a datagram or shutdown
+        timeouts = [session_table.time_to_idle_check()]
+        next_deadline = paced_queues.next_deadline()
+        if next_deadline is not None:
+          timeouts.append(max(0.0, next_deadline - paced_queues.clock()))
+        timeouts = [x for x in timeouts if x is not None]
+        readable = global_state.wait_readable([out_socket, wakeup.receiver], min(timeouts, default=None))
+        if wakeup.receiver in readable:
+          wakeup.drain()
+        while killed_sessions:
+          close_sessions(session_table.remove(killed_sessions.popleft()), killed=True)
+        close_sessions(session_table.evict_idle())
+        paced_queues.release()
+        if out_socket not in readable:
+          continue
+        for message, client_address in receive_batch(out_socket, buffer):
+          if not client_address:
+            logging.debug("Dropped UDP datagram of a Unix socket without a name, replies could not reach it")
+            continue
+          session = session_table.get(client_address)
+          if session is None:
+            try:
+              session = open_session(
+                client_address,
+                load_balancer=load_balancer,
+                listener_control=listener_control,
+                impairment_emulator=impairment_emulator,
+                global_state=global_state,
+              )
+            except OSError as e:
+              logging.debug(f"Dropped UDP datagram of {client_address}, no backend could be reached: {e!r}")
+              continue
+            session.live_connection = LiveConnection(
+              Protocol.UDP,
+              client_address,
+              session.backend,
+              session.relays,
+              close=functools.partial(kill_session, session),
+            )
+            listener_control.add(session.live_connection)
+            reply_demultiplexer.add_session(session)
+            close_sessions(session_table.add(session))
+
+          impairment = session.impairment
+          copies, extra_delay = impairment.decide() if impairment is not None else no_impairment
+          if copies == 0:
+            continue
+          if not paced_queues.push(session, message, copies=copies, extra_delay=extra_delay):
+            logging.debug(
+              f"Dropped UDP datagram of {client_address} (dropped in total: {paced_queues.dropped_datagrams})"
+            )
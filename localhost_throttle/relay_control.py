@@ -0,0 +1,88 @@
+from .bandwidth_limiter import BandwidthLimiter, LimiterChain
+from .direction_type import Direction
+from .latency import DelayLine, LatencyEmulator
+from .protocol_type import Protocol
+from .token_bucket import TokenBucket
+
+
+class RelayControl:
+  # Limits and byte count of one direction of a TCP connection or UDP session. The relay reads limiter_chain and
+  # delay_line once per chunk or datagram, while the control API replaces them from its own thread. Replacing an
+  # attribute is atomic, so relays take no extra lock for that
+  def __init__(
+    self,
+    client_address,
+    direction: Direction,
+    protocol: Protocol,
+    *,
+    token_bucket: TokenBucket | None = None,
+    limiter_chain: LimiterChain | None = None,
+    delay_line: DelayLine | None = None,
+  ):
+    self.client_address = client_address
+    self.direction = direction
+    self.protocol = protocol
+    self.token_bucket = token_bucket
+    self.limiter_chain = limiter_chain
+    self.delay_line = delay_line
+    self.bytes = 0
+
+  @staticmethod
+  def create(
+    client_address,
+    direction: Direction,
+    protocol: Protocol,
+    *,
+    bandwidth_limiter: BandwidthLimiter,
+    latency_emulator: LatencyEmulator,
+  ):
+    token_bucket = bandwidth_limiter.create_token_bucket()
+    return RelayControl(
+      client_address,
+      direction,
+      protocol,
+      token_bucket=token_bucket,
+      limiter_chain=bandwidth_limiter.assemble_chain(client_address, direction, token_bucket),
+      delay_line=latency_emulator.create_delay_line(protocol),
+    )
+
+  @property
+  def bandwidth(self) -> float | None:
+    token_bucket = self.token_bucket
+    return token_bucket.rate if token_bucket is not None else None
+
+  @property
+  def latency(self) -> float:
+    delay_line = self.delay_line
+    return delay_line.latency if delay_line is not None else 0.0
+
+  @property
+  def jitter(self) -> float:
+    delay_line = self.delay_line
+    return delay_line.jitter if delay_line is not None else 0.0
+
+  def set_bandwidth(self, bandwidth: float | None, *, bandwidth_limiter: BandwidthLimiter):
+    if bandwidth is None:
+      self.token_bucket = None
+    elif not isinstance(self.token_bucket, TokenBucket):
+      # Also replaces the bucket that follows a bandwidth trace
+      self.token_bucket = TokenBucket(bandwidth, bandwidth_limiter.burst)
+    else:
+      self.token_bucket.set_rate(bandwidth, bandwidth_limiter.burst)
+    self.refresh_chain(bandwidth_limiter=bandwidth_limiter)
+
+  def refresh_chain(self, *, bandwidth_limiter: BandwidthLimiter):
+    # Picks up client and global buckets that were added or removed since the chain was assembled
+    self.limiter_chain = bandwidth_limiter.assemble_chain(self.client_address, self.direction, self.token_bucket)
+
+  def set_delay(self, *, latency: float, jitter: float, latency_emulator: LatencyEmulator):
+    delay_line = self.delay_line
+    if delay_line is None:
+      self.delay_line = latency_emulator.create_delay_line(self.protocol, latency=latency, jitter=jitter)
+    elif self.protocol == Protocol.UDP and latency <= 0 and jitter <= 0:
+      self.delay_line = None
+    else:
+      # A TCP stream keeps its delay line even without delay, otherwise new data would overtake data in flight
+      delay_line.latency = latency
+      delay_line.jitter = jitter
+
@@ -0,0 +1,50 @@
+import threading
+import time
+
+default_burst_duration = 0.05
+
+
+class TokenBucket:
+  # Bucket starts empty so the very first chunk is paced as well. Tokens are allowed to go negative: the caller
+  # waits for the returned delay instead of being refused, which keeps the long-term rate exact.
+  def __init__(self, rate: float, burst: float | None = None, *, clock=time.perf_counter):
+    if rate <= 0:
+      raise ValueError(f"Rate should be positive. Got: {rate}")
+    self.rate = rate
+    self.burst = burst if burst is not None else rate * default_burst_duration
+    self.clock = clock
+    self._tokens = 0.0
+    self._last_refill = clock()
+    self._lock = threading.Lock()
+
+  def set_rate(self, rate: float, burst: float | None = None):
+    # Tokens gathered at the old rate are kept, so changing the rate neither grants a fresh burst nor takes a debt away
+    if rate <= 0:
+      raise ValueError(f"Rate should be positive. Got: {rate}")
+    with self._lock:
+      now = self.clock()
+      self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+      self._last_refill = now
+      self.rate = rate
+      self.burst = burst if burst is not None else rate * default_burst_duration
+      self._tokens = min(self.burst, self._tokens)
+
+  def chunk_size(self, buffer_size: int) -> int:
+    return max(1, min(buffer_size, int(self.burst)))
+
+  def consume(self, amount: int) -> float:
+    with self._lock:
+      now = self.clock()
+      tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+      tokens -= amount
+      self._tokens = tokens
+      self._last_refill = now
+    if tokens >= 0:
+      return 0.0
+    return -tokens / self.rate
+
+
+def create_token_bucket(bandwidth: float | None, burst: float | None = None) -> TokenBucket | None:
+  if bandwidth is None:
+    return None
+  return TokenBucket(bandwidth, burst)
@@ -0,0 +1,25 @@
+import enum
+
+
+@enum.unique
+class TraceEnd(enum.Enum):
+  LOOP = enum.auto()
+  STOP = enum.auto()
+
+  @staticmethod
+  def from_string(str):
+    str = str.lower()
+    match str:
+      case "loop":
+        return TraceEnd.LOOP
+      case "stop":
+        return TraceEnd.STOP
+      case _:
+        raise ValueError(f"'{str}' is not a valid TraceEnd. Only 'loop' and 'stop' are supported")
+
+  def __str__(self):
+    match self:
+      case TraceEnd.LOOP:
+        return "loop"
+      case TraceEnd.STOP:
+        return "stop"
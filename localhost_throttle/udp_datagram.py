@@ -0,0 +1,97 @@
+import contextlib
+import functools
+import os
+import socket
+import sys
+import tempfile
+
+from .context_util import RunIfException
+from .hostname_and_port import remove_socket_file
+from .latency import DelayLine, LatencyEmulator
+
+# Larger than any UDP payload so that a datagram is never truncated
+max_datagram_size = 65537
+# Datagrams of one batch are received back to back into a single buffer of this size
+batch_buffer_size = 4 * max_datagram_size
+max_batch_size = 64
+no_impairment = (1, 0.0)
+reply_directory_prefix = "localhost-throttle-"
+
+
+def bind_for_replies(sock, family: int) -> str | None:
+  # The server replies to the name of the socket, so a Unix one needs a name too. Linux picks a unique one in the
+  # abstract namespace. Elsewhere it is a file in a private directory, whose path is returned to be removed with
+  # remove_reply_socket_file() once the socket is closed
+  match family:
+    case socket.AF_INET:
+      sock.bind(("localhost", 0))
+    case socket.AF_INET6:
+      # Bound by connect()
+      pass
+    case socket.AF_UNIX:
+      if sys.platform.startswith("linux"):
+        sock.bind("")
+        return None
+      directory = tempfile.mkdtemp(prefix=reply_directory_prefix)
+      path = os.path.join(directory, "reply.sock")
+      with RunIfException(lambda: remove_reply_socket_file(path)):
+        sock.bind(path)
+      return path
+  return None
+
+
+def remove_reply_socket_file(path: str):
+  remove_socket_file(path)
+  with contextlib.suppress(OSError):
+    os.rmdir(os.path.dirname(path))
+
+
+def receive_batch(sock, buffer):
+  # Drains every datagram that is already queued on a non-blocking socket, so a single select() serves many of them
+  datagrams = []
+  offset = 0
+  while len(datagrams) < max_batch_size and offset + max_datagram_size <= len(buffer):
+    try:
+      data_length, address = sock.recvfrom_into(buffer[offset:], max_datagram_size)
+    except BlockingIOError:
+      break
+    datagrams.append((buffer[offset : offset + data_length], address))
+    offset += data_length
+  return datagrams
+
+
+def _sender(sock, address):
+  # Connected sockets are sent to without an address, macOS refuses sendto() on them
+  if address is None:
+    return sock.send
+  return functools.partial(_send_to, sock, address=address)
+
+
+def _send_to(sock, data, *, address):
+  return sock.sendto(data, address)
+
+
+def send_datagram(
+  sock,
+  data,
+  address,
+  *,
+  copies: int,
+  extra_delay: float,
+  delay_line: DelayLine | None,
+  latency_emulator: LatencyEmulator,
+):
+  send = _sender(sock, address)
+  if delay_line is None and extra_delay == 0:
+    try:
+      for _ in range(copies):
+        send(data)
+    except BlockingIOError:
+      # Socket buffer is full. The datagram is lost just like it would be on a congested link
+      pass
+    return
+  delay_scheduler = latency_emulator.delay_scheduler
+  deadline = delay_line.next_deadline() if delay_line is not None else delay_scheduler.clock()
+  send = functools.partial(send, bytes(data))
+  for _ in range(copies):
+    delay_scheduler.schedule(deadline + extra_delay, send)
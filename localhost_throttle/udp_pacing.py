@@ -0,0 +1,91 @@
+import collections
+import heapq
+import itertools
+import time
+
+from .metrics import RelayMetrics
+from .udp_session import UDPSession
+
+# Bytes of throttled datagrams that may wait in the queue of one session and in the queues of all sessions of a listener
+default_max_queue_size = 2**18
+default_max_total_queue_size = 2**24
+
+
+class PacedDatagramQueues:
+  # Every session has its own FIFO of datagrams waiting for their tokens. Tokens are taken when a datagram is queued, so
+  # deadlines inside one queue never decrease and a heap of queue heads tells which session is due next. A throttled
+  # session only fills its own queue and never delays datagrams of the others. Queues are bounded by bytes, each one and
+  # all of them together, so neither one client nor many can hold much memory
+  def __init__(
+    self,
+    send,
+    *,
+    max_queue_size: int = default_max_queue_size,
+    max_total_queue_size: int = default_max_total_queue_size,
+    relay_metrics: RelayMetrics | None = None,
+    clock=time.perf_counter,
+  ):
+    self.send = send
+    self.relay_metrics = relay_metrics
+    self.max_queue_size = max_queue_size
+    self.max_total_queue_size = max_total_queue_size
+    self.clock = clock
+    self.dropped_datagrams = 0
+    self.queued_bytes = 0
+    self._queues = dict()
+    self._queue_sizes = dict()
+    self._heap = []
+    self._counter = itertools.count()
+
+  def push(self, session: UDPSession, data, *, copies: int, extra_delay: float) -> bool:
+    queue = self._queues.get(session)
+    if queue is None and session.limiter_chain is None:
+      self.send(session, data, copies=copies, extra_delay=extra_delay)
+      return True
+    queue_size = self._queue_sizes.get(session, 0)
+    # A datagram always fits into an empty queue of its own. Tokens are taken only by datagrams that are queued or sent
+    if (queue is not None and queue_size + len(data) > self.max_queue_size) or (
+      self.queued_bytes + len(data) > self.max_total_queue_size
+    ):
+      # Tail drop, just like a router with a full queue
+      self.dropped_datagrams += 1
+      return False
+    time_to_wait = session.limiter_chain.consume(len(data)) if session.limiter_chain is not None else 0.0
+    if self.relay_metrics is not None:
+      self.relay_metrics.record_throttle(time_to_wait)
+    if queue is None and time_to_wait <= 0:
+      self.send(session, data, copies=copies, extra_delay=extra_delay)
+      return True
+    deadline = self.clock() + time_to_wait
+    if queue is None:
+      queue = self._queues[session] = collections.deque()
+      heapq.heappush(self._heap, (deadline, next(self._counter), session))
+    queue.append((deadline, bytes(data), copies, extra_delay))
+    self._queue_sizes[session] = queue_size + len(data)
+    self.queued_bytes += len(data)
+    return True
+
+  def next_deadline(self) -> float | None:
+    return self._heap[0][0] if self._heap else None
+
+  def release(self):
+    now = self.clock()
+    while self._heap and self._heap[0][0] <= now:
+      _, _, session = heapq.heappop(self._heap)
+      queue = self._queues.get(session)
+      if queue is None:
+        continue
+      while queue and queue[0][0] <= now:
+        _, data, copies, extra_delay = queue.popleft()
+        self._queue_sizes[session] -= len(data)
+        self.queued_bytes -= len(data)
+        self.send(session, data, copies=copies, extra_delay=extra_delay)
+      if queue:
+        heapq.heappush(self._heap, (queue[0][0], next(self._counter), session))
+      else:
+        del self._queues[session]
+        del self._queue_sizes[session]
+
+  def discard(self, session: UDPSession):
+    self._queues.pop(session, None)
+    self.queued_bytes -= self._queue_sizes.pop(session, 0)
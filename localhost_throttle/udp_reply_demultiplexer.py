@@ -0,0 +1,175 @@
+import collections
+import contextlib
+import heapq
+import itertools
+import logging
+import selectors
+import threading
+import time
+
+from .buffer_pool import BufferPool
+from .direction_type import Direction
+from .global_state import GlobalState, WakeupSocketPair
+from .latency import LatencyEmulator
+from .metrics import Metrics
+from .protocol_type import Protocol
+from .udp_datagram import no_impairment, receive_batch, remove_reply_socket_file, send_datagram
+from .udp_session import UDPSession
+
+
+class UDPReplyDemultiplexer:
+  # A single thread waits on the upstream sockets of all UDP sessions and relays replies through the shared listening
+  # socket. Sessions are added and removed by the ingress thread through a queue, only the relaying thread touches
+  # the selector and closes upstream sockets. The ingress thread stops it once it no longer adds sessions
+  def __init__(
+    self,
+    out_socket,
+    *,
+    latency_emulator: LatencyEmulator,
+    buffer_pool: BufferPool,
+    metrics: Metrics,
+    global_state: GlobalState,
+    clock=time.perf_counter,
+  ):
+    self.out_socket = out_socket
+    self.latency_emulator = latency_emulator
+    self.buffer_pool = buffer_pool
+    self.metrics = metrics
+    self.relay_metrics = metrics.relay(Protocol.UDP, Direction.SERVER_TO_CLIENT)
+    self.clock = clock
+    self._selector = selectors.DefaultSelector()
+    self._sessions = set()
+    self._commands = collections.deque()
+    self._held_replies = dict()
+    self._heap = []
+    self._counter = itertools.count()
+    self._is_stopped = threading.Event()
+
+    self._wakeup = WakeupSocketPair(global_state=global_state)
+    self._selector.register(self._wakeup.receiver, selectors.EVENT_READ, None)
+
+  def add_session(self, session: UDPSession):
+    self._commands.append((True, session))
+    self._wakeup.wake_up()
+
+  def remove_session(self, session: UDPSession):
+    self._commands.append((False, session))
+    self._wakeup.wake_up()
+
+  def stop(self):
+    self._is_stopped.set()
+    self._wakeup.wake_up()
+
+  def _run_commands(self, *, global_state: GlobalState):
+    while self._commands:
+      is_added, session = self._commands.popleft()
+      if is_added:
+        self._sessions.add(session)
+        self.metrics.udp_sessions.add(1)
+        self._selector.register(session.server_client_socket, selectors.EVENT_READ, session)
+      else:
+        self._close_session(session, global_state=global_state)
+
+  def _close_session(self, session: UDPSession, *, global_state: GlobalState):
+    if session not in self._sessions:
+      return
+    self._sessions.remove(session)
+    self.metrics.udp_sessions.add(-1)
+    self._held_replies.pop(session, None)
+    with contextlib.suppress(KeyError):
+      self._selector.unregister(session.server_client_socket)
+    global_state.close_socket(session.server_client_socket)
+    if session.reply_path is not None:
+      remove_reply_socket_file(session.reply_path)
+    if session.backend is not None:
+      session.backend.close_connection()
+    logging.info(f"Closed UDP connection to {session.client_address}")
+
+  def _relay_replies(self, session: UDPSession, datagrams) -> bool:
+    # Returns False if throttling holds back the rest of the datagrams
+    for i, data in enumerate(datagrams):
+      impairment = session.reply_impairment
+      copies, extra_delay = impairment.decide() if impairment is not None else no_impairment
+      if copies == 0:
+        continue
+      if session.reply_limiter_chain is not None:
+        time_to_wait = session.reply_limiter_chain.consume(len(data))
+        self.relay_metrics.record_throttle(time_to_wait)
+        if time_to_wait > 0:
+          # Socket of a throttled session is not read until its replies are released, so the excess waits in the
+          # kernel buffer just like it did in front of a sleeping thread
+          remaining = [bytes(x) for x in datagrams[i + 1 :]]
+          self._held_replies[session] = (bytes(data), copies, extra_delay, remaining)
+          heapq.heappush(self._heap, (self.clock() + time_to_wait, next(self._counter), session))
+          return False
+      self._send_reply(session, data, copies=copies, extra_delay=extra_delay)
+    return True
+
+  def _send_reply(self, session: UDPSession, data, *, copies: int, extra_delay: float):
+    session.relays[Direction.SERVER_TO_CLIENT].bytes += len(data)
+    self.relay_metrics.record(len(data))
+    try:
+      send_datagram(
+        self.out_socket,
+        data,
+        session.client_address,
+        copies=copies,
+        extra_delay=extra_delay,
+        delay_line=session.reply_delay_line,
+        latency_emulator=self.latency_emulator,
+      )
+    except OSError as e:
+      # Client is gone, e.g. a Unix socket that was closed and unlinked. Its reply is lost, the other sessions of this
+      # thread are still served
+      logging.debug(f"Dropped UDP reply to {session.client_address}: {e!r}")
+
+  def _release_held_replies(self):
+    now = self.clock()
+    while self._heap and self._heap[0][0] <= now:
+      _, _, session = heapq.heappop(self._heap)
+      held_replies = self._held_replies.pop(session, None)
+      if held_replies is None:
+        continue
+      data, copies, extra_delay, remaining = held_replies
+      self._send_reply(session, data, copies=copies, extra_delay=extra_delay)
+      if self._relay_replies(session, remaining):
+        self._selector.register(session.server_client_socket, selectors.EVENT_READ, session)
+
+  def _receive_replies(self, key, buffer):
+    session = key.data
+    if session is None:
+      self._wakeup.drain()
+      return
+    if session not in self._sessions:
+      return
+    session.touch()
+    try:
+      datagrams = [data for data, _ in receive_batch(session.server_client_socket, buffer)]
+    except (ConnectionRefusedError, ConnectionResetError):
+      # ICMP port unreachable of an earlier datagram is reported on the next receive. Windows calls it a reset
+      if session.backend is not None:
+        session.backend.report_failure()
+      return
+    if datagrams and session.backend is not None:
+      session.backend.report_success()
+    if not self._relay_replies(session, datagrams):
+      self._selector.unregister(session.server_client_socket)
+
+  def run_forever(self, *, global_state: GlobalState):
+    try:
+      with self.buffer_pool.buffer() as buffer:
+        while not self._is_stopped.is_set():
+          timeout = None
+          if self._heap:
+            timeout = max(0.0, self._heap[0][0] - self.clock())
+          events = self._selector.select(timeout)
+          self._run_commands(global_state=global_state)
+          for key, _ in events:
+            self._receive_replies(key, buffer)
+          self._release_held_replies()
+    finally:
+      self._run_commands(global_state=global_state)
+      for session in list(self._sessions):
+        self._close_session(session, global_state=global_state)
+      self._selector.close()
+      self._wakeup.close()
@@ -0,0 +1,132 @@
+import collections
+import threading
+import time
+
+from .bandwidth_limiter import LimiterChain
+from .direction_type import Direction
+from .impairment import UDPImpairment
+from .latency import DelayLine
+from .load_balancer import Backend
+from .protocol_type import Protocol
+from .relay_control import RelayControl
+
+
+class UDPSession:
+  def __init__(
+    self,
+    client_address,
+    server_client_socket,
+    *,
+    relays: dict[Direction, RelayControl] | None = None,
+    impairment: UDPImpairment | None,
+    reply_impairment: UDPImpairment | None = None,
+    backend: Backend | None = None,
+    reply_path: str | None = None,
+    clock=time.monotonic,
+  ):
+    self.client_address = client_address
+    self.server_client_socket = server_client_socket
+    if relays is None:
+      relays = {direction: RelayControl(client_address, direction, Protocol.UDP) for direction in Direction}
+    self.relays = relays
+    self.impairment = impairment
+    self.reply_impairment = reply_impairment
+    self.backend = backend
+    # Socket file that names server_client_socket where Unix sockets cannot be named in the abstract namespace
+    self.reply_path = reply_path
+    # Set once the control API can see the session
+    self.live_connection = None
+    self.clock = clock
+    self.last_active = clock()
+    self._stopped = threading.Event()
+
+  # Limits are looked up for every datagram, so that the control API can change them for a live session
+  @property
+  def limiter_chain(self) -> LimiterChain | None:
+    return self.relays[Direction.CLIENT_TO_SERVER].limiter_chain
+
+  @property
+  def delay_line(self) -> DelayLine | None:
+    return self.relays[Direction.CLIENT_TO_SERVER].delay_line
+
+  @property
+  def reply_limiter_chain(self) -> LimiterChain | None:
+    return self.relays[Direction.SERVER_TO_CLIENT].limiter_chain
+
+  @property
+  def reply_delay_line(self) -> DelayLine | None:
+    return self.relays[Direction.SERVER_TO_CLIENT].delay_line
+
+  def touch(self):
+    self.last_active = self.clock()
+
+  def stop(self):
+    self._stopped.set()
+
+  def is_stopped(self) -> bool:
+    return self._stopped.is_set()
+
+
+class UDPSessionTable:
+  # Sessions are kept in least recently used order. Only the thread that receives client datagrams modifies the
+  # table, the reply demultiplexer just touches their session
+  def __init__(self, *, idle_timeout: float | None = None, max_sessions: int | None = None, clock=time.monotonic):
+    self.idle_timeout = idle_timeout
+    self.max_sessions = max_sessions
+    self.clock = clock
+    self.evicted_sessions = 0
+    self._sessions = collections.OrderedDict()
+    self._next_idle_check = clock()
+
+  def __len__(self):
+    return len(self._sessions)
+
+  def get(self, client_address) -> UDPSession | None:
+    session = self._sessions.get(client_address)
+    if session is not None:
+      self._sessions.move_to_end(client_address)
+      session.touch()
+    return session
+
+  def add(self, session: UDPSession) -> list[UDPSession]:
+    self._sessions[session.client_address] = session
+    evicted = []
+    while self.max_sessions is not None and len(self._sessions) > self.max_sessions:
+      _, oldest = self._sessions.popitem(last=False)
+      evicted.append(self._evict(oldest))
+    return evicted
+
+  def remove(self, session: UDPSession) -> list[UDPSession]:
+    # Session may have been evicted already, while a request to remove it was on its way
+    if self._sessions.get(session.client_address) is not session:
+      return []
+    del self._sessions[session.client_address]
+    session.stop()
+    return [session]
+
+  def time_to_idle_check(self) -> float | None:
+    if self.idle_timeout is None or not self._sessions:
+      return None
+    return max(0.0, self._next_idle_check - self.clock())
+
+  def evict_idle(self) -> list[UDPSession]:
+    # Replies refresh last_active without reordering the table, so idle sessions are found by a periodic scan
+    if self.idle_timeout is None:
+      return []
+    now = self.clock()
+    if now < self._next_idle_check:
+      return []
+    self._next_idle_check = now + min(self.idle_timeout / 2, 1.0)
+    deadline = now - self.idle_timeout
+    idle_client_addresses = [x for x, session in self._sessions.items() if session.last_active <= deadline]
+    return [self._evict(self._sessions.pop(x)) for x in idle_client_addresses]
+
+  def _evict(self, session: UDPSession) -> UDPSession:
+    session.stop()
+    self.evicted_sessions += 1
+    return session
+
+  def stop_all(self):
+    for session in self._sessions.values():
+      session.stop()
+    self._sessions.clear()
@@ -0,0 +1,148 @@
+import errno
+import logging
+import os
+import socket
+import threading
+import time
+
+from .context_util import RunFinally, RunIfException
+from .global_state import GlobalState, WakeupSocketPair, wait_for_sockets
+from .hostname_and_port import HostnameAndPort
+
+default_refill_rate = 10.0
+default_connect_timeout = 5.0
+
+
+def connect(server_address: HostnameAndPort, *, timeout: float, global_state: GlobalState):
+  # Connects without blocking shutdown. The socket is registered in global_state and is blocking once connected
+  sock = socket.socket(server_address.family, socket.SOCK_STREAM)
+  with RunIfException(lambda: sock.close()):
+    global_state.add_socket(sock)
+  with RunIfException(lambda: global_state.close_socket(sock)):
+    sock.setblocking(False)
+    error = sock.connect_ex(server_address.to_address())
+    if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      raise OSError(error, os.strerror(error))
+    if error != 0:
+      if not global_state.wait_writable([sock], timeout=timeout):
+        if global_state.is_shutdown():
+          raise ConnectionAbortedError(f"Shutdown while connecting to {server_address}")
+        raise TimeoutError(f"Timed out connecting to {server_address}")
+      error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if error != 0:
+        raise OSError(error, os.strerror(error))
+    sock.setblocking(True)
+  return sock
+
+
+def is_idle_socket_healthy(sock) -> bool:
+  # Nothing is expected from the server on an idle connection. If there is something to read, it is either the end of
+  # the stream or an error, which make the socket useless, or data of a server that speaks first, which is relayed to
+  # the client as usual
+  try:
+    readable, _ = wait_for_sockets([sock], [], 0)
+    if not readable:
+      return True
+    return len(sock.recv(1, socket.MSG_PEEK)) > 0
+  except (OSError, ValueError):
+    return False
+
+
+class UpstreamPool:
+  # Keeps up to size idle connections to the server, so that accepted clients do not wait for a connect round trip.
+  # A single thread opens new connections at most refill_rate per second and discards idle ones the server closed
+  def __init__(
+    self,
+    server_address: HostnameAndPort,
+    *,
+    size: int,
+    refill_rate: float = default_refill_rate,
+    connect_timeout: float = default_connect_timeout,
+    global_state: GlobalState,
+    clock=time.perf_counter,
+  ):
+    if size <= 0:
+      raise ValueError(f"Size should be positive. Got: {size}")
+    if refill_rate <= 0:
+      raise ValueError(f"Refill rate should be positive. Got: {refill_rate}")
+    self.server_address = server_address
+    self.size = size
+    self.refill_rate = refill_rate
+    self.connect_timeout = connect_timeout
+    self.clock = clock
+    self._idle_sockets = []
+    # Sockets of servers that speak first stay readable, so they are not watched after the first check
+    self._checked_sockets = set()
+    self._lock = threading.Lock()
+    self._wakeup = WakeupSocketPair(global_state=global_state)
+
+  def __len__(self):
+    with self._lock:
+      return len(self._idle_sockets)
+
+  def acquire(self, *, global_state: GlobalState):
+    # Returns the most recently opened healthy connection or None if there is none
+    while True:
+      with self._lock:
+        if not self._idle_sockets:
+          return None
+        sock = self._idle_sockets.pop()
+        self._checked_sockets.discard(sock)
+      self._wakeup.wake_up()
+      if is_idle_socket_healthy(sock):
+        return sock
+      logging.debug(f"Discarded broken idle connection to {self.server_address}")
+      global_state.close_socket(sock)
+
+  def _discard_broken(self, sockets, *, global_state: GlobalState):
+    for sock in sockets:
+      if is_idle_socket_healthy(sock):
+        with self._lock:
+          if sock in self._idle_sockets:
+            self._checked_sockets.add(sock)
+        continue
+      with self._lock:
+        if sock not in self._idle_sockets:
+          # Already handed over to a client
+          continue
+        self._idle_sockets.remove(sock)
+      logging.debug(f"Discarded broken idle connection to {self.server_address}")
+      global_state.close_socket(sock)
+
+  def _close_idle_sockets(self, *, global_state: GlobalState):
+    with self._lock:
+      sockets = self._idle_sockets
+      self._idle_sockets = []
+      self._checked_sockets.clear()
+    for sock in sockets:
+      global_state.close_socket(sock)
+    self._wakeup.close()
+
+  def run_forever(self, *, global_state: GlobalState):
+    with RunFinally(lambda: self._close_idle_sockets(global_state=global_state)):
+      next_connect_time = self.clock()
+      while not global_state.is_shutdown():
+        with self._lock:
+          is_full = len(self._idle_sockets) >= self.size
+          watched_sockets = [x for x in self._idle_sockets if x not in self._checked_sockets]
+        now = self.clock()
+        if not is_full and now >= next_connect_time:
+          next_connect_time = now + 1 / self.refill_rate
+          try:
+            sock = connect(self.server_address, timeout=self.connect_timeout, global_state=global_state)
+          except OSError as e:
+            logging.debug(f"Failed to open idle connection to {self.server_address}: {e!r}")
+            continue
+          with self._lock:
+            self._idle_sockets.append(sock)
+          continue
+        timeout = None if is_full else next_connect_time - now
+        try:
+          readable = global_state.wait_readable([self._wakeup.receiver, *watched_sockets], timeout=timeout)
+        except (OSError, ValueError):
+          # A socket was handed over to a client and closed while being watched
+          continue
+        if self._wakeup.receiver in readable:
+          self._wakeup.drain()
+          readable.remove(self._wakeup.receiver)
+        self._discard_broken(readable, global_state=global_state)
@@ -0,0 +1,139 @@
+import collections
+import logging
+import threading
+import time
+
+from .global_state import GlobalState
+
+default_max_workers = 1024
+default_idle_timeout = 10.0
+
+
+class WorkerPool:
+  # Runs tasks on reused threads of global_state. Workers are started on demand and finish after staying idle for
+  # idle_timeout. At most max_workers submitted tasks run at once, the others wait in a FIFO. Tasks started with start()
+  # run right away and do not count against max_workers, so a running task never waits for work it depends on
+  def __init__(
+    self,
+    *,
+    max_workers: int = default_max_workers,
+    idle_timeout: float = default_idle_timeout,
+    global_state: GlobalState,
+    clock=time.monotonic,
+  ):
+    if max_workers <= 0:
+      raise ValueError(f"Maximum number of workers should be positive. Got: {max_workers}")
+    self.max_workers = max_workers
+    self.idle_timeout = idle_timeout
+    self.global_state = global_state
+    self.clock = clock
+    self._tasks = collections.deque()
+    self._started_tasks = collections.deque()
+    self._running_tasks = 0
+    lock = threading.Lock()
+    self._condition = threading.Condition(lock)
+    # Notified when a worker takes a queued task
+    self._room = threading.Condition(lock)
+    self._workers = 0
+    self._idle_workers = 0
+    # Started workers that did not look for a task yet, they will take the queued ones
+    self._starting_workers = 0
+    global_state.on_shutdown(self._wake_up_all)
+
+  @property
+  def workers(self) -> int:
+    return self._workers
+
+  @property
+  def idle_workers(self) -> int:
+    return self._idle_workers
+
+  @property
+  def queued_tasks(self) -> int:
+    return len(self._tasks)
+
+  def _wake_up_all(self):
+    with self._condition:
+      self._condition.notify_all()
+      self._room.notify_all()
+
+  def wait_for_room(self, max_queued_tasks: int, timeout: float) -> bool:
+    # Returns False if max_queued_tasks still wait for a worker after timeout
+    with self._condition:
+      return self._room.wait_for(
+        lambda: len(self._tasks) < max_queued_tasks or self.global_state.is_shutdown(), timeout
+      )
+
+  def _takeable_tasks(self) -> int:
+    return len(self._started_tasks) + min(len(self._tasks), self.max_workers - self._running_tasks)
+
+  def submit(self, f, *, args=(), kwargs=None):
+    # Like GlobalState.add_thread, f gets global_state as a keyword argument
+    self._add_task(self._tasks, f, args=args, kwargs=kwargs)
+
+  def start(self, f, *, args=(), kwargs=None):
+    # Runs f on an idle or a new worker even when max_workers tasks are running, e.g. the second direction of a
+    # connection whose handler already holds a worker
+    self._add_task(self._started_tasks, f, args=args, kwargs=kwargs)
+
+  def _add_task(self, tasks: collections.deque, f, *, args, kwargs):
+    kwargs = dict(kwargs) if kwargs is not None else dict()
+    kwargs["global_state"] = self.global_state
+    with self._condition:
+      tasks.append((f, args, kwargs))
+      start_worker = self._takeable_tasks() > self._idle_workers + self._starting_workers
+      if start_worker:
+        self._workers += 1
+        self._starting_workers += 1
+      else:
+        self._condition.notify()
+    if start_worker:
+      try:
+        self.global_state.add_thread(f=self._work_forever)
+      except BaseException:
+        with self._condition:
+          self._workers -= 1
+          self._starting_workers -= 1
+        raise
+
+  def _next_task(self, *, first: bool, global_state: GlobalState):
+    # Returns None once the worker should finish
+    with self._condition:
+      if first:
+        self._starting_workers -= 1
+      self._idle_workers += 1
+      deadline = self.clock() + self.idle_timeout
+      while not self._takeable_tasks() and not global_state.is_shutdown():
+        time_to_wait = deadline - self.clock()
+        if time_to_wait <= 0:
+          break
+        self._condition.wait(time_to_wait)
+      self._idle_workers -= 1
+      if not self._takeable_tasks() or global_state.is_shutdown():
+        self._workers -= 1
+        return None
+      if self._started_tasks:
+        return self._started_tasks.popleft(), False
+      self._running_tasks += 1
+      self._room.notify_all()
+      return self._tasks.popleft(), True
+
+  def _finish_task(self):
+    with self._condition:
+      self._running_tasks -= 1
+
+  def _work_forever(self, *, global_state: GlobalState):
+    first = True
+    while True:
+      task = self._next_task(first=first, global_state=global_state)
+      first = False
+      if task is None:
+        return
+      (f, args, kwargs), submitted = task
+      try:
+        f(*args, **kwargs)
+      except Exception as e:
+        logging.debug(f"Task {getattr(f, '__name__', f)} finished with exception:\n{e!r}")
+      finally:
+        if submitted:
+          self._finish_task()
@@ -0,0 +1,150 @@
+import contextlib
+import math
+import socket
+import threading
+import time
+
+from localhost_throttle import Protocol
+
+from .util import running_proxy
+
+# UDP clients offer this much more than the target, so that queues of the proxy never run empty
+UDP_OVERLOAD = 1.5
+UDP_SEND_INTERVAL = 0.01
+RECEIVE_TIMEOUT = 0.1
+
+
+class RateReport:
+  # Achieved rate over the whole measurement and over consecutive windows of it. Arrivals during the warm-up are not
+  # counted, so that connections or clients that started a little later do not skew the first window
+  def __init__(self, target: float, arrivals: list, *, warm_up: float, duration: float, window: float):
+    self.target = target
+    self.window = window
+    window_count = int(duration / window)
+    window_bytes = [0] * window_count
+    start = min(arrival_time for arrival_time, _ in arrivals) + warm_up if arrivals else 0.0
+    for arrival_time, size in arrivals:
+      index = math.floor((arrival_time - start) / window)
+      if 0 <= index < window_count:
+        window_bytes[index] += size
+    self.window_rates = [x / window for x in window_bytes]
+    self.achieved = sum(window_bytes) / (window_count * window)
+
+  @property
+  def error(self) -> float:
+    return self.achieved / self.target - 1
+
+  @property
+  def burstiness(self) -> float:
+    # How much the busiest window went above the target
+    return max(self.window_rates) / self.target - 1
+
+  def __str__(self):
+    window_rates = ", ".join(f"{x:.0f}" for x in self.window_rates)
+    return (
+      f"target={self.target:.0f} B/s achieved={self.achieved:.0f} B/s error={self.error:+.1%} "
+      f"burstiness={self.burstiness:+.1%} windows of {self.window}s=[{window_rates}]"
+    )
+
+
+def _record_arrivals(sock, arrivals: list, size: int, stop_event: threading.Event):
+  sock.settimeout(RECEIVE_TIMEOUT)
+  while not stop_event.is_set():
+    try:
+      data = sock.recv(size)
+    except TimeoutError:
+      continue
+    if not data and sock.type == socket.SOCK_STREAM:
+      return
+    arrivals.append((time.perf_counter(), len(data)))
+
+
+def measure_tcp_rate(
+  *,
+  target: float,
+  chunk_size: int,
+  connections: int,
+  warm_up: float,
+  duration: float,
+  window: float,
+  extra_args=(),
+) -> RateReport:
+  # Clients send as fast as the proxy lets them. Only what reached the server in time counts
+  arrivals = []
+  stop_event = threading.Event()
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+    server_socket.bind(("localhost", 0))
+    server_socket.listen(connections)
+    with running_proxy(Protocol.TCP, server_socket.getsockname()[1], ("--log-level", "warning", *extra_args)) as proxy_port:
+      client_sockets = [socket.create_connection(("localhost", proxy_port)) for _ in range(connections)]
+      with contextlib.ExitStack() as exit_stack:
+        for sock in client_sockets:
+          exit_stack.enter_context(sock)
+        server_connections = [exit_stack.enter_context(server_socket.accept()[0]) for _ in range(connections)]
+
+        def send(sock):
+          payload = b"x" * chunk_size
+          with contextlib.suppress(OSError):
+            while not stop_event.is_set():
+              sock.sendall(payload)
+
+        threads = [threading.Thread(target=send, args=(x,), daemon=True) for x in client_sockets]
+        threads += [
+          threading.Thread(target=_record_arrivals, args=(x, arrivals, chunk_size, stop_event), daemon=True)
+          for x in server_connections
+        ]
+        for thread in threads:
+          thread.start()
+        time.sleep(warm_up + duration + window)
+        stop_event.set()
+        for sock in client_sockets:
+          sock.shutdown(socket.SHUT_RDWR)
+        for thread in threads:
+          thread.join()
+  return RateReport(target, list(arrivals), warm_up=warm_up, duration=duration, window=window)
+
+
+def measure_udp_rate(
+  *,
+  target: float,
+  datagram_size: int,
+  clients: int,
+  warm_up: float,
+  duration: float,
+  window: float,
+  extra_args=(),
+) -> RateReport:
+  # Every client offers more than the target share of it, the proxy is expected to queue or drop the rest
+  arrivals = []
+  stop_event = threading.Event()
+  with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server_socket:
+    server_socket.bind(("localhost", 0))
+    with running_proxy(Protocol.UDP, server_socket.getsockname()[1], ("--log-level", "warning", *extra_args)) as proxy_port:
+      with contextlib.ExitStack() as exit_stack:
+        client_sockets = [
+          exit_stack.enter_context(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) for _ in range(clients)
+        ]
+
+        def send(sock):
+          payload = b"x" * datagram_size
+          datagrams_per_interval = max(1, round(target * UDP_OVERLOAD * UDP_SEND_INTERVAL / datagram_size))
+          deadline = time.perf_counter()
+          while not stop_event.is_set():
+            for _ in range(datagrams_per_interval):
+              sock.sendto(payload, ("localhost", proxy_port))
+            deadline += UDP_SEND_INTERVAL
+            stop_event.wait(max(0.0, deadline - time.perf_counter()))
+
+        threads = [threading.Thread(target=send, args=(x,), daemon=True) for x in client_sockets]
+        threads.append(
+          threading.Thread(
+            target=_record_arrivals, args=(server_socket, arrivals, datagram_size, stop_event), daemon=True
+          )
+        )
+        for thread in threads:
+          thread.start()
+        time.sleep(warm_up + duration + window)
+        stop_event.set()
+        for thread in threads:
+          thread.join()
+  return RateReport(target, list(arrivals), warm_up=warm_up, duration=duration, window=window)
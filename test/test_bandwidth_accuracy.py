@@ -0,0 +1,68 @@
+import itertools
+
+import pytest
+
+from .rate_measurement import measure_tcp_rate, measure_udp_rate
+
+RATES = (200_000, 1_000_000)
+CHUNK_SIZES = (1024, 8192)
+CONNECTIONS = (1, 4)
+WARM_UP = 0.25
+DURATION = 1.0
+WINDOW = 0.25
+ERROR_TOLERANCE = 0.05
+# A window may also hold one more chunk or datagram of every connection than its share of the rate
+BURSTINESS_TOLERANCE = 0.1
+TEST_TIMEOUT = 10
+
+
+def check_report(report, *, chunk_size, rate):
+  assert abs(report.error) <= ERROR_TOLERANCE, f"Achieved rate is off. {report}"
+  burstiness_tolerance = BURSTINESS_TOLERANCE + chunk_size / (rate * WINDOW)
+  assert report.burstiness <= burstiness_tolerance, f"Rate is too bursty. {report}"
+
+
+@pytest.mark.timeout(TEST_TIMEOUT)
+@pytest.mark.parametrize(("rate", "chunk_size", "connections"), itertools.product(RATES, CHUNK_SIZES, CONNECTIONS))
+def test_bandwidth_is_accurate_tcp(rate, chunk_size, connections):
+  report = measure_tcp_rate(
+    target=rate * connections,
+    chunk_size=chunk_size,
+    connections=connections,
+    warm_up=WARM_UP,
+    duration=DURATION,
+    window=WINDOW,
+    extra_args=("--bandwidth", str(rate), "--burst", str(chunk_size)),
+  )
+  check_report(report, chunk_size=chunk_size, rate=rate)
+
+
+@pytest.mark.timeout(TEST_TIMEOUT)
+@pytest.mark.parametrize(("rate", "chunk_size"), itertools.product(RATES, CHUNK_SIZES))
+def test_global_bandwidth_is_accurate_tcp(rate, chunk_size):
+  connections = max(CONNECTIONS)
+  report = measure_tcp_rate(
+    target=rate,
+    chunk_size=chunk_size,
+    connections=connections,
+    warm_up=WARM_UP,
+    duration=DURATION,
+    window=WINDOW,
+    extra_args=("--global-bandwidth", str(rate), "--burst", str(chunk_size)),
+  )
+  check_report(report, chunk_size=chunk_size, rate=rate)
+
+
+@pytest.mark.timeout(TEST_TIMEOUT)
+@pytest.mark.parametrize(("rate", "datagram_size", "clients"), itertools.product(RATES, CHUNK_SIZES, CONNECTIONS))
+def test_bandwidth_is_accurate_udp(rate, datagram_size, clients):
+  report = measure_udp_rate(
+    target=rate * clients,
+    datagram_size=datagram_size,
+    clients=clients,
+    warm_up=WARM_UP,
+    duration=DURATION,
+    window=WINDOW,
+    extra_args=("--bandwidth", str(rate)),
+  )
+  check_report(report, chunk_size=datagram_size, rate=rate)
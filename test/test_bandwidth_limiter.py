@@ -0,0 +1,51 @@
+from localhost_throttle.bandwidth_limiter import BandwidthLimiter, GlobalLimiter
+from localhost_throttle.direction_type import Direction
+
+
+def test_no_limits_create_no_chain():
+  bandwidth_limiter = BandwidthLimiter()
+  assert bandwidth_limiter.create_chain(("127.0.0.1", 1000), Direction.CLIENT_TO_SERVER) is None
+
+
+def test_global_budget_is_shared_between_clients():
+  bandwidth_limiter = BandwidthLimiter(global_limiter=GlobalLimiter(100, burst=0), burst=0)
+  first = bandwidth_limiter.create_chain(("127.0.0.1", 1000), Direction.CLIENT_TO_SERVER)
+  second = bandwidth_limiter.create_chain(("127.0.0.2", 1000), Direction.CLIENT_TO_SERVER)
+  first.consume(100)
+  assert second.consume(100) > 1.5
+
+
+def test_global_budget_is_shared_between_listeners():
+  global_limiter = GlobalLimiter(100, burst=0)
+  first, second = (
+    BandwidthLimiter(global_limiter=global_limiter).create_chain(("127.0.0.1", 1000), Direction.CLIENT_TO_SERVER)
+    for _ in range(2)
+  )
+  first.consume(100)
+  assert second.consume(100) > 1.5
+
+
+def test_client_budget_is_shared_between_connections_of_one_client_only():
+  bandwidth_limiter = BandwidthLimiter(client_bandwidth=100, burst=0)
+  first = bandwidth_limiter.create_chain(("127.0.0.1", 1000), Direction.CLIENT_TO_SERVER)
+  same_client = bandwidth_limiter.create_chain(("127.0.0.1", 1001), Direction.CLIENT_TO_SERVER)
+  other_client = bandwidth_limiter.create_chain(("127.0.0.2", 1000), Direction.CLIENT_TO_SERVER)
+  first.consume(100)
+  assert same_client.consume(100) > 1.5
+  assert other_client.consume(100) < 1.5
+
+
+def test_directions_have_separate_budgets():
+  bandwidth_limiter = BandwidthLimiter(global_limiter=GlobalLimiter(100, burst=0), burst=0)
+  client_to_server = bandwidth_limiter.create_chain(("127.0.0.1", 1000), Direction.CLIENT_TO_SERVER)
+  server_to_client = bandwidth_limiter.create_chain(("127.0.0.1", 1000), Direction.SERVER_TO_CLIENT)
+  client_to_server.consume(100)
+  assert server_to_client.consume(100) < 1.5
+
+
+def test_strictest_level_wins():
+  bandwidth_limiter = BandwidthLimiter(
+    bandwidth=1000, client_bandwidth=10, global_limiter=GlobalLimiter(100, burst=0), burst=0
+  )
+  limiter_chain = bandwidth_limiter.create_chain(("127.0.0.1", 1000), Direction.CLIENT_TO_SERVER)
+  assert 0.9 < limiter_chain.consume(10) < 1.1
@@ -1,3 +1,5 @@
+import socket
+
 import pytest
 
 from .constants import TIME_FOR_PROCESS_TO_FINISH
@@ -17,6 +19,35 @@ def test_slows_down_data_out_to_in():
     assert data_to_send == data_to_receive, f"Data received is not equal to data send. {data_to_send=}, {data_to_receive=}"
 
 
+@pytest.mark.timeout(3)
+def test_slows_down_data_in_to_out():
+  with UDPSingleConnectionTest(bandwidth=5) as (in_socket, out_socket, _, out_port):
+    data_to_send = b"1"
+    out_socket.sendto(data_to_send, ("localhost", out_port))
+    in_socket.settimeout(0.5)
+    _, in_addr = in_socket.recvfrom(len(data_to_send))
+
+    in_socket.sendto(data_to_send, in_addr)
+    out_socket.settimeout(0.1)
+    with pytest.raises(TimeoutError):
+      data_to_receive, _ = out_socket.recvfrom(len(data_to_send))
+    out_socket.settimeout(0.5)
+    data_to_receive, _ = out_socket.recvfrom(len(data_to_send))
+    assert data_to_send == data_to_receive, f"Data received is not equal to data send. {data_to_send=}, {data_to_receive=}"
+
+
+@pytest.mark.timeout(3)
+def test_throttled_client_does_not_delay_other_clients():
+  with UDPSingleConnectionTest(bandwidth=5) as (in_socket, out_socket, _, out_port):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as other_socket:
+      out_socket.sendto(b"1" * 100, ("localhost", out_port))
+      data_to_send = b"2"
+      other_socket.sendto(data_to_send, ("localhost", out_port))
+      in_socket.settimeout(1)
+      data_to_receive, _ = in_socket.recvfrom(100)
+      assert data_to_send == data_to_receive, f"Data received is not equal to data send. {data_to_send=}, {data_to_receive=}"
+
+
 @pytest.mark.timeout(5)
 def test_can_be_interrupted_on_long_transfer():
   with UDPSingleConnectionTest(bandwidth=5) as (in_socket, out_socket, process, out_port):
@@ -0,0 +1,137 @@
+import pytest
+
+from localhost_throttle.bandwidth_limiter import BandwidthLimiter
+from localhost_throttle.bandwidth_trace import BandwidthTrace, TraceBucket
+from localhost_throttle.direction_type import Direction
+from localhost_throttle.latency import LatencyEmulator
+from localhost_throttle.protocol_type import Protocol
+from localhost_throttle.relay_control import RelayControl
+from localhost_throttle.token_bucket import TokenBucket
+from localhost_throttle.trace_end_type import TraceEnd
+
+from .util import FakeClock, TCPSingleConnectionTest
+
+
+def test_follows_rate_changes_of_csv_trace():
+  trace = BandwidthTrace.from_csv(["seconds,bytes_per_second", "10,100", "11,1000", "12,0"])
+  assert list(trace.times) == [0, 1, 2]
+  assert list(trace.cumulative) == [0, 100, 1100]
+  clock = FakeClock()
+  bucket = TraceBucket(trace, burst=0, start=0.0, clock=clock)
+  # 100 bytes at 100 B/s and then 500 bytes at 1000 B/s
+  assert bucket.consume(600) == pytest.approx(1.5)
+
+
+def test_loops_trace():
+  trace = BandwidthTrace.from_csv(["0,100", "1,0", "2,0"])
+  clock = FakeClock()
+  bucket = TraceBucket(trace, burst=0, start=0.0, clock=clock)
+  assert bucket.consume(100) == pytest.approx(1.0)
+  # The link is down for the rest of the period and delivers again in the next one
+  assert bucket.consume(50) == pytest.approx(2.5)
+  clock.now = 1000.25
+  assert bucket.consume(50) == pytest.approx(0.5)
+
+
+def test_keeps_last_rate_after_stopped_trace():
+  trace = BandwidthTrace.from_csv(["0,100", "1,10"], end=TraceEnd.STOP)
+  clock = FakeClock()
+  bucket = TraceBucket(trace, burst=0, start=0.0, clock=clock)
+  assert bucket.consume(110) == pytest.approx(2.0)
+  clock.now = 5.0
+  assert bucket.consume(10) == pytest.approx(1.0)
+
+
+def test_idle_time_is_credited_up_to_burst():
+  trace = BandwidthTrace.from_csv(["0,100", "10,100"])
+  clock = FakeClock()
+  bucket = TraceBucket(trace, burst=20, start=0.0, clock=clock)
+  clock.now = 5.0
+  assert bucket.consume(20) == 0.0
+  assert bucket.consume(10) == pytest.approx(0.1)
+
+
+def test_reads_mahimahi_trace():
+  trace = BandwidthTrace.from_mahimahi(["0", "5", "5", "10"], mtu=1000)
+  assert list(trace.times) == [0, 0, 0.005, 0.005, 0.01, 0.01]
+  assert list(trace.cumulative) == [0, 1000, 1000, 3000, 3000, 4000]
+  assert trace.average_rate == pytest.approx(400000)
+  clock = FakeClock()
+  bucket = TraceBucket(trace, burst=1000, start=0.0, clock=clock)
+  assert bucket.consume(1000) == 0.0
+  assert bucket.consume(1) == pytest.approx(0.005)
+  assert bucket.consume(2000) == pytest.approx(0.01)
+  # Opportunity at the end of a period is followed by the one at the start of the next
+  assert bucket.consume(2000) == pytest.approx(0.015)
+
+
+def test_loads_trace_by_extension(tmp_path):
+  csv_path = tmp_path / "trace.csv"
+  csv_path.write_text("0,100\n2,100\n")
+  mahimahi_path = tmp_path / "trace.up"
+  mahimahi_path.write_text("1\n2\n")
+  assert BandwidthTrace.load(str(csv_path)).average_rate == pytest.approx(100)
+  assert BandwidthTrace.load(str(mahimahi_path)).average_rate == pytest.approx(1500000)
+
+
+@pytest.mark.parametrize(
+  "lines, end",
+  [
+    (["0,100"], TraceEnd.LOOP),
+    (["0,0", "1,0"], TraceEnd.LOOP),
+    (["0,100", "1,0"], TraceEnd.STOP),
+    (["1,100", "0,100"], TraceEnd.LOOP),
+    (["0,-1", "1,100"], TraceEnd.LOOP),
+    (["seconds,bytes_per_second", "0,100", "oops", "1,100"], TraceEnd.LOOP),
+  ],
+)
+def test_rejects_invalid_csv_trace(lines, end):
+  with pytest.raises(ValueError):
+    BandwidthTrace.from_csv(lines, end=end)
+
+
+def test_rejects_invalid_mahimahi_trace():
+  with pytest.raises(ValueError):
+    BandwidthTrace.from_mahimahi(["5", "3"])
+  with pytest.raises(ValueError):
+    BandwidthTrace.from_mahimahi(["0"])
+
+
+@pytest.mark.timeout(5)
+def test_holds_data_while_trace_is_down(tmp_path):
+  trace_path = tmp_path / "trace.csv"
+  trace_path.write_text("0,0\n60,1000000\n61,1000000\n")
+  with TCPSingleConnectionTest(extra_args=["--bandwidth-trace", str(trace_path)]) as (in_socket_out, out_socket, _):
+    in_socket_out.send(b"1")
+    out_socket.settimeout(0.5)
+    with pytest.raises(TimeoutError):
+      out_socket.recv(1)
+
+
+@pytest.mark.timeout(5)
+def test_passes_data_after_trace_stops(tmp_path):
+  trace_path = tmp_path / "trace.csv"
+  trace_path.write_text("0,0\n0.1,100000\n")
+  extra_args = ["--bandwidth-trace", str(trace_path), "--bandwidth-trace-end", "stop"]
+  with TCPSingleConnectionTest(extra_args=extra_args) as (in_socket_out, out_socket, _):
+    in_socket_out.send(b"hello")
+    out_socket.settimeout(1)
+    assert out_socket.recv(5) == b"hello"
+
+
+def test_constant_bandwidth_replaces_trace():
+  trace = BandwidthTrace.from_csv(["0,100", "1,100"])
+  bandwidth_limiter = BandwidthLimiter(bandwidth_trace=trace)
+  relay = RelayControl.create(
+    ("127.0.0.1", 1),
+    Direction.CLIENT_TO_SERVER,
+    Protocol.TCP,
+    bandwidth_limiter=bandwidth_limiter,
+    latency_emulator=LatencyEmulator(),
+  )
+  assert isinstance(relay.token_bucket, TraceBucket)
+  relay.set_bandwidth(1000, bandwidth_limiter=bandwidth_limiter)
+  assert isinstance(relay.token_bucket, TokenBucket)
+  assert relay.bandwidth == 1000
+  bandwidth_limiter.set_bandwidth(2000)
+  assert isinstance(bandwidth_limiter.create_token_bucket(), TokenBucket)
@@ -0,0 +1,60 @@
+import socket
+
+from localhost_throttle.bandwidth_limiter import LimiterChain
+from localhost_throttle.chunk_sizer import (
+  ChunkSizer,
+  SocketBuffers,
+  max_socket_buffer_size,
+  min_socket_buffer_size,
+  socket_buffer_size,
+)
+from localhost_throttle.token_bucket import TokenBucket
+
+
+def test_grows_while_reads_fill_the_chunk():
+  chunk_sizer = ChunkSizer(65536, min_size=4096)
+  sizes = []
+  for _ in range(6):
+    size = chunk_sizer.next_size(None)
+    sizes.append(size)
+    chunk_sizer.record(size, size)
+  assert sizes == [4096, 8192, 16384, 32768, 65536, 65536]
+
+
+def test_shrinks_after_short_reads():
+  chunk_sizer = ChunkSizer(65536, min_size=4096)
+  chunk_sizer.size = 65536
+  chunk_sizer.record(65536, 100)
+  assert chunk_sizer.size == 32768
+  chunk_sizer.record(32768, 20000)
+  assert chunk_sizer.size == 32768
+  for _ in range(10):
+    chunk_sizer.record(chunk_sizer.size, 1)
+  assert chunk_sizer.size == 4096
+
+
+def test_limits_cut_chunks_without_shrinking_them():
+  chunk_sizer = ChunkSizer(65536, min_size=4096)
+  limiter_chain = LimiterChain((TokenBucket(10000, burst=500),))
+  size = chunk_sizer.next_size(limiter_chain)
+  assert size == 500
+  chunk_sizer.record(size, size)
+  assert chunk_sizer.size == 4096
+
+
+def test_sizes_socket_buffers_for_the_rate():
+  assert socket_buffer_size(None) is None
+  assert socket_buffer_size(LimiterChain((TokenBucket(1000),))) == min_socket_buffer_size
+  assert socket_buffer_size(LimiterChain((TokenBucket(10**7), TokenBucket(10**6)))) == 250000
+  assert socket_buffer_size(LimiterChain((TokenBucket(10**12),))) == max_socket_buffer_size
+
+
+def test_restores_socket_buffers_when_limits_are_lifted():
+  in_socket, out_socket = socket.socketpair()
+  with in_socket, out_socket:
+    original_size = in_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    socket_buffers = SocketBuffers(in_socket, out_socket)
+    socket_buffers.update(LimiterChain((TokenBucket(1000),)))
+    assert in_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) < original_size
+    socket_buffers.update(None)
+    assert in_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= original_size
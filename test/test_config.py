@@ -0,0 +1,113 @@
+import contextlib
+import json
+import socket
+import time
+
+import pytest
+
+from localhost_throttle import context_util
+from localhost_throttle.config import load_config, parse_config, to_arguments
+from localhost_throttle.parser import create_parser
+
+from .constants import DELAY_TO_START_UP, TIME_FOR_PROCESS_TO_FINISH
+from .util import interrupt_process, random_ports, spawn_localhost_throttle_with_args
+
+
+def test_converts_options_to_arguments():
+  options = {"server": ["localhost:1", "localhost:2"], "new_server": "localhost:3", "preserve-order": True, "seed": None}
+  arguments = ["--server", "localhost:1,localhost:2", "--new-server", "localhost:3", "--preserve-order"]
+  assert to_arguments(options) == arguments
+
+
+def test_listener_options_take_precedence():
+  config = {
+    "bandwidth": 1000,
+    "listeners": [
+      {"server": "localhost:1", "new-server": "localhost:2", "protocols": "tcp"},
+      {"server": "localhost:3", "new-server": "localhost:4", "protocols": "udp", "bandwidth": 2000},
+    ],
+  }
+  args, listeners = parse_config(config, create_parser(), ["--latency", "0.1", "--bandwidth", "500"])
+  assert args.latency == 0.1
+  assert [x.bandwidth for x in listeners] == [500, 2000]
+  assert [x.latency for x in listeners] == [0.1, 0.1]
+  assert [str(x) for x in listeners[1].server] == ["localhost:3"]
+
+
+@pytest.mark.parametrize("key, value", [("log_level", "debug"), ("global-bandwidth", 1000)])
+def test_rejects_process_options_in_listener(key, value):
+  config = {"listeners": [{"server": "localhost:1", "new-server": "localhost:2", key: value}]}
+  with pytest.raises(ValueError, match=key):
+    parse_config(config, create_parser(), [])
+
+
+def test_loads_json_and_toml(tmp_path):
+  json_path = tmp_path / "config.json"
+  json_path.write_text(json.dumps({"listeners": [{"server": "localhost:1"}]}))
+  toml_path = tmp_path / "config.toml"
+  toml_path.write_text('max-workers = 4\n[[listeners]]\nserver = "localhost:1"\n')
+  assert load_config(str(json_path)) == {"listeners": [{"server": "localhost:1"}]}
+  assert load_config(str(toml_path)) == {"max-workers": 4, "listeners": [{"server": "localhost:1"}]}
+
+
+def test_requires_listeners(tmp_path):
+  path = tmp_path / "config.json"
+  path.write_text(json.dumps({"bandwidth": 1000}))
+  with pytest.raises(ValueError, match="listener"):
+    load_config(str(path))
+
+
+@pytest.mark.timeout(5)
+def test_serves_many_listeners_in_one_process(tmp_path):
+  tcp_ports = random_ports(socket.SOCK_STREAM, size=4)
+  udp_ports = random_ports(socket.SOCK_DGRAM, size=2)
+  config_path = tmp_path / "config.json"
+  config_path.write_text(
+    json.dumps(
+      {
+        "latency": 0.01,
+        "listeners": [
+          {"server": f"localhost:{tcp_ports[0]}", "new-server": f"localhost:{tcp_ports[1]}", "protocols": "tcp"},
+          {
+            "server": f"localhost:{tcp_ports[2]}",
+            "new-server": f"localhost:{tcp_ports[3]}",
+            "protocols": "tcp",
+            "bandwidth": 100000,
+          },
+          {"server": f"localhost:{udp_ports[0]}", "new-server": f"localhost:{udp_ports[1]}", "protocols": "udp"},
+        ],
+      }
+    )
+  )
+  with contextlib.ExitStack() as exit_stack:
+    tcp_servers = []
+    for port in tcp_ports[0::2]:
+      server_socket = exit_stack.enter_context(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+      server_socket.bind(("localhost", port))
+      server_socket.listen(1)
+      server_socket.settimeout(1)
+      tcp_servers.append(server_socket)
+    udp_server = exit_stack.enter_context(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+    udp_server.bind(("localhost", udp_ports[0]))
+    udp_server.settimeout(1)
+
+    process = spawn_localhost_throttle_with_args(["--config", str(config_path)])
+    with context_util.RunIfException(lambda: process.kill()):
+      time.sleep(DELAY_TO_START_UP)
+      for server_socket, proxy_port in zip(tcp_servers, tcp_ports[1::2]):
+        client_socket = exit_stack.enter_context(socket.create_connection(("localhost", proxy_port), timeout=1))
+        client_socket.sendall(b"hello")
+        accepted_socket = exit_stack.enter_context(server_socket.accept()[0])
+        accepted_socket.settimeout(1)
+        assert accepted_socket.recv(5) == b"hello"
+
+      udp_client = exit_stack.enter_context(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+      udp_client.settimeout(1)
+      udp_client.sendto(b"ping", ("localhost", udp_ports[1]))
+      data, address = udp_server.recvfrom(16)
+      assert data == b"ping"
+      udp_server.sendto(b"pong", address)
+      assert udp_client.recvfrom(16)[0] == b"pong"
+
+      interrupt_process(process)
+      process.communicate(timeout=TIME_FOR_PROCESS_TO_FINISH)
@@ -0,0 +1,182 @@
+import json
+import socket
+import time
+
+import pytest
+
+from localhost_throttle import Protocol, ProtocolSet
+from localhost_throttle.bandwidth_limiter import BandwidthLimiter, GlobalLimiter
+from localhost_throttle.control import Control, ListenerControl, LiveConnection
+from localhost_throttle.direction_type import Direction
+from localhost_throttle.hostname_and_port import HostnameAndPort
+from localhost_throttle.latency import LatencyEmulator
+
+from .util import is_windows, running_proxy
+
+
+def create_listener_control(index, global_limiter, **kwargs):
+  return ListenerControl(
+    index,
+    HostnameAndPort("localhost", 1 + index),
+    ProtocolSet.from_iterable([Protocol.TCP]),
+    bandwidth_limiter=BandwidthLimiter(global_limiter=global_limiter, **kwargs),
+    latency_emulator=LatencyEmulator(),
+  )
+
+
+def create_control(**kwargs):
+  global_limiter = GlobalLimiter()
+  listener_control = create_listener_control(0, global_limiter, **kwargs)
+  return Control([listener_control], global_limiter=global_limiter), listener_control
+
+
+def add_connection(listener_control, closed=None):
+  client_address = ("127.0.0.1", 1000)
+  relays = listener_control.create_relays(client_address, Protocol.TCP)
+  connection = LiveConnection(Protocol.TCP, client_address, "localhost:2", relays, close=lambda: closed.append(True))
+  listener_control.add(connection)
+  return connection, relays
+
+
+def test_sets_bandwidth_and_delay_of_one_connection():
+  control, listener_control = create_control()
+  connection, relays = add_connection(listener_control)
+  _, other_relays = add_connection(listener_control)
+  assert control.handle({"command": "set", "connection": connection.id, "bandwidth": 100, "latency": 0.1}) == {
+    "ok": True
+  }
+  for relay in relays.values():
+    assert relay.limiter_chain is not None and relay.bandwidth == 100
+    assert relay.delay_line is not None and relay.latency == 0.1
+  assert all(x.limiter_chain is None and x.delay_line is None for x in other_relays.values())
+
+
+def test_listener_limits_reach_live_connections():
+  control, listener_control = create_control(bandwidth=1000)
+  _, relays = add_connection(listener_control)
+  token_bucket = relays[Direction.CLIENT_TO_SERVER].token_bucket
+  control.handle({"command": "set", "listener": 0, "bandwidth": 10, "client_bandwidth": 20})
+  # Rate of the existing bucket is changed in place, the client level is added to the chain
+  assert relays[Direction.CLIENT_TO_SERVER].token_bucket is token_bucket and token_bucket.rate == 10
+  assert len(relays[Direction.CLIENT_TO_SERVER].limiter_chain.token_buckets) == 2
+  control.handle({"command": "set", "bandwidth": None, "client-bandwidth": None})
+  assert all(x.limiter_chain is None for x in relays.values())
+  assert listener_control.bandwidth_limiter.create_chain(("127.0.0.1", 1), Direction.CLIENT_TO_SERVER) is None
+
+
+def test_global_bandwidth_is_one_budget_of_every_listener():
+  global_limiter = GlobalLimiter()
+  listener_controls = [create_listener_control(x, global_limiter) for x in range(2)]
+  control = Control(listener_controls, global_limiter=global_limiter)
+  relays = [add_connection(x)[1][Direction.CLIENT_TO_SERVER] for x in listener_controls]
+  control.handle({"command": "set", "global-bandwidth": 100})
+  assert relays[0].limiter_chain.token_buckets == relays[1].limiter_chain.token_buckets
+  assert control.handle({"command": "list"})["global-bandwidth"] == 100
+  control.handle({"command": "set", "global-bandwidth": None})
+  assert all(x.limiter_chain is None for x in relays)
+
+
+def test_lists_and_kills_connections():
+  control, listener_control = create_control()
+  closed = []
+  connection, relays = add_connection(listener_control, closed)
+  relays[Direction.SERVER_TO_CLIENT].bytes = 5
+  listed = control.handle({"command": "list"})["listeners"][0]["connections"]
+  assert [(x["id"], x["bytes"]["server_to_client"]) for x in listed] == [(connection.id, 5)]
+  control.handle({"command": "kill", "connection": connection.id})
+  assert closed == [True]
+
+
+@pytest.mark.parametrize(
+  "request_",
+  [
+    {"command": "reboot"},
+    {"command": "set", "listener": 1, "bandwidth": 10},
+    {"command": "set", "bandwidth": 0},
+    {"command": "set", "latency": "1"},
+    {"command": "set", "connection": 1000000, "bandwidth": 10},
+    {"command": "set", "connection": 1, "client-bandwidth": 10},
+    {"command": "set", "listener": 0, "global-bandwidth": 10},
+    {"command": "set"},
+  ],
+)
+def test_rejects_invalid_requests(request_):
+  control, _ = create_control()
+  with pytest.raises(ValueError):
+    control.handle(request_)
+
+
+def send_request(control_path, request):
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as control_socket:
+    control_socket.settimeout(1)
+    control_socket.connect(str(control_path))
+    control_socket.sendall(json.dumps(request).encode("utf-8") + b"\n")
+    with control_socket.makefile("rb") as f:
+      return json.loads(f.readline())
+
+
+def connections(control_path):
+  return send_request(control_path, {"command": "list"})["listeners"][0]["connections"]
+
+
+def receive_exactly(sock, size):
+  received = 0
+  while received < size:
+    data = sock.recv(size - received)
+    assert data, "Connection closed too early"
+    received += len(data)
+
+
+@pytest.mark.timeout(8)
+@pytest.mark.skipif(is_windows(), reason="Control API uses Unix sockets")
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_changes_bandwidth_of_live_tcp_connection_and_kills_it(tmp_path, engine):
+  control_path = tmp_path / "control.sock"
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+    server_socket.bind(("localhost", 0))
+    server_socket.listen(1)
+    server_socket.settimeout(1)
+    extra_args = ["--control-socket", str(control_path), "--engine", engine]
+    with running_proxy(Protocol.TCP, server_socket.getsockname()[1], extra_args) as proxy_port:
+      with socket.create_connection(("localhost", proxy_port), timeout=2) as client_socket:
+        with server_socket.accept()[0] as accepted_socket:
+          accepted_socket.settimeout(2)
+          client_socket.sendall(b"1" * 10000)
+          receive_exactly(accepted_socket, 10000)
+          [connection] = connections(control_path)
+          assert connection["bytes"] == {"client_to_server": 10000, "server_to_client": 0}
+
+          request = {"command": "set", "connection": connection["id"], "bandwidth": 20000}
+          assert send_request(control_path, request)["ok"]
+          start = time.perf_counter()
+          client_socket.sendall(b"1" * 10000)
+          receive_exactly(accepted_socket, 10000)
+          assert 0.4 < time.perf_counter() - start < 0.7
+
+          assert send_request(control_path, {"command": "kill", "connection": connection["id"]})["ok"]
+          assert client_socket.recv(1) == b""
+          assert connections(control_path) == []
+
+
+@pytest.mark.timeout(8)
+@pytest.mark.skipif(is_windows(), reason="Control API uses Unix sockets")
+def test_kills_udp_session(tmp_path):
+  control_path = tmp_path / "control.sock"
+  with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server_socket:
+    server_socket.bind(("localhost", 0))
+    server_socket.settimeout(1)
+    extra_args = ["--control-socket", str(control_path)]
+    with running_proxy(Protocol.UDP, server_socket.getsockname()[1], extra_args) as proxy_port:
+      with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client_socket:
+        client_socket.sendto(b"hello", ("localhost", proxy_port))
+        assert server_socket.recvfrom(16)[0] == b"hello"
+        [connection] = connections(control_path)
+        assert connection["protocol"] == "udp" and connection["bytes"]["client_to_server"] == 5
+
+        assert send_request(control_path, {"command": "kill", "connection": connection["id"]})["ok"]
+        time.sleep(0.1)
+        assert connections(control_path) == []
+        # Next datagram of the client opens a new session
+        client_socket.sendto(b"again", ("localhost", proxy_port))
+        assert server_socket.recvfrom(16)[0] == b"again"
+        assert [x["id"] for x in connections(control_path)] != [connection["id"]]
@@ -0,0 +1,60 @@
+import socket
+import threading
+
+import pytest
+
+from localhost_throttle.delayed_sender import DelayedSender
+from localhost_throttle.global_state import GlobalState
+from localhost_throttle.latency import DelayScheduler, LatencyEmulator
+from localhost_throttle.protocol_type import Protocol
+
+
+@pytest.mark.timeout(5)
+def test_keeps_backlog_without_blocking_scheduler():
+  global_state = GlobalState(collect_events=False)
+  delay_scheduler = DelayScheduler()
+  global_state.add_thread(f=delay_scheduler.run_forever)
+  latency_emulator = LatencyEmulator(latency=0.01, delay_scheduler=delay_scheduler)
+  delay_line = latency_emulator.create_delay_line(Protocol.TCP)
+  out_socket, peer_socket = socket.socketpair()
+  with out_socket, peer_socket:
+    finished = threading.Event()
+    sender = DelayedSender(out_socket, latency_emulator=latency_emulator, on_finish=finished.set, max_bytes=2**20)
+    chunk = b"1" * 65536
+    for _ in range(32):
+      sender.send(chunk, delay_line)
+    # Peer does not read, so the relay has to wait while other callbacks of the scheduler still run
+    assert not sender.wait_for_room(0.2)
+    callback_ran = threading.Event()
+    delay_scheduler.schedule(delay_scheduler.clock(), callback_ran.set)
+    assert callback_ran.wait(timeout=1)
+
+    sender.shutdown(delay_line)
+    peer_socket.settimeout(1)
+    received = 0
+    while data := peer_socket.recv(65536):
+      received += len(data)
+    assert received == 32 * len(chunk)
+    assert finished.wait(timeout=1)
+    assert sender.wait_for_room(0) and sender.bytes_in_flight == 0
+  global_state.shutdown()
+  assert global_state.join(timeout=1)
+  global_state.close()
+
+
+@pytest.mark.timeout(5)
+def test_scheduler_survives_failing_callback():
+  global_state = GlobalState(collect_events=False)
+  delay_scheduler = DelayScheduler()
+  global_state.add_thread(f=delay_scheduler.run_forever)
+
+  def fail():
+    raise RuntimeError("Callback failed")
+
+  delay_scheduler.schedule(delay_scheduler.clock(), fail)
+  callback_ran = threading.Event()
+  delay_scheduler.schedule(delay_scheduler.clock() + 0.01, callback_ran.set)
+  assert callback_ran.wait(timeout=1)
+  global_state.shutdown()
+  assert global_state.join(timeout=1)
+  global_state.close()
@@ -0,0 +1,239 @@
+import contextlib
+import os
+import socket
+import sys
+import time
+
+import pytest
+
+from localhost_throttle import context_util
+from localhost_throttle.hostname_and_port import HostnameAndPort, format_address, remove_stale_socket_file
+from localhost_throttle.main import main
+from localhost_throttle.udp_datagram import bind_for_replies, remove_reply_socket_file
+
+from .constants import DELAY_TO_START_UP, TIME_FOR_PROCESS_TO_FINISH
+from .util import interrupt_process, is_windows, random_ports, spawn_localhost_throttle_with_args
+
+
+def has_ipv6_loopback():
+  if not socket.has_ipv6:
+    return False
+  try:
+    with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as sock:
+      sock.bind(("::1", 0))
+  except OSError:
+    return False
+  return True
+
+
+@pytest.mark.parametrize(
+  "str_, family, address",
+  [
+    ("localhost:8000", socket.AF_INET, ("localhost", 8000)),
+    ("[::1]:8000", socket.AF_INET6, ("::1", 8000)),
+    pytest.param(
+      "unix:/tmp/server.sock",
+      getattr(socket, "AF_UNIX", None),
+      "/tmp/server.sock",
+      marks=pytest.mark.skipif(is_windows(), reason="Unix sockets"),
+    ),
+  ],
+)
+def test_parses_endpoints(str_, family, address):
+  endpoint = HostnameAndPort.from_string(str_)
+  assert endpoint.family == family
+  assert endpoint.to_address() == address
+  assert str(endpoint) == str_
+
+
+@pytest.mark.parametrize("str_", ["::1:8000", "[::1]8000", "unix:"])
+def test_rejects_invalid_endpoints(str_):
+  with pytest.raises(ValueError):
+    HostnameAndPort.from_string(str_)
+
+
+def test_formats_peer_addresses():
+  assert format_address(("127.0.0.1", 5000)) == "127.0.0.1:5000"
+  assert format_address(("::1", 5000, 0, 0)) == "[::1]:5000"
+  assert format_address("/tmp/client.sock") == "unix:/tmp/client.sock"
+  assert format_address(b"\0abc") == "unix:@abc"
+  assert format_address("") == "unix:"
+
+
+@pytest.mark.skipif(is_windows(), reason="Unix sockets")
+def test_rejects_unix_new_server_for_both_protocols(tmp_path, capsys):
+  args = ["--server", "localhost:1", "--new-server", f"unix:{tmp_path / 'proxy.sock'}", "--protocols", "tcp,udp"]
+  with pytest.raises(SystemExit):
+    main(args)
+  assert "serves only one of --protocols" in capsys.readouterr().err
+
+
+@pytest.mark.skipif(is_windows(), reason="Unix sockets")
+def test_removes_only_stale_socket_files(tmp_path):
+  stream_path = str(tmp_path / "stream.sock")
+  datagram_path = str(tmp_path / "datagram.sock")
+  stale_path = str(tmp_path / "stale.sock")
+  with (
+    socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stream_socket,
+    socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as datagram_socket,
+  ):
+    stream_socket.bind(stream_path)
+    stream_socket.listen(1)
+    datagram_socket.bind(datagram_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale_socket:
+      stale_socket.bind(stale_path)
+    for path in [stream_path, datagram_path, stale_path]:
+      remove_stale_socket_file(path)
+    assert os.path.exists(stream_path) and os.path.exists(datagram_path)
+    assert not os.path.exists(stale_path)
+
+
+def _serve_tcp_echo_once(server_socket, exit_stack):
+  accepted_socket = exit_stack.enter_context(server_socket.accept()[0])
+  accepted_socket.settimeout(1)
+  accepted_socket.sendall(accepted_socket.recv(16).upper())
+
+
+def _relay_tcp(family, server_address, proxy_address, args):
+  with contextlib.ExitStack() as exit_stack:
+    server_socket = exit_stack.enter_context(socket.socket(family, socket.SOCK_STREAM))
+    server_socket.bind(server_address)
+    server_socket.listen(1)
+    server_socket.settimeout(1)
+    process = spawn_localhost_throttle_with_args(args)
+    with context_util.RunIfException(lambda: process.kill()):
+      time.sleep(DELAY_TO_START_UP)
+      client_socket = exit_stack.enter_context(socket.socket(family, socket.SOCK_STREAM))
+      client_socket.settimeout(1)
+      client_socket.connect(proxy_address)
+      client_socket.sendall(b"hello")
+      _serve_tcp_echo_once(server_socket, exit_stack)
+      assert client_socket.recv(16) == b"HELLO"
+      interrupt_process(process)
+      process.communicate(timeout=TIME_FOR_PROCESS_TO_FINISH)
+
+
+@pytest.mark.skipif(is_windows(), reason="Unix sockets")
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+@pytest.mark.timeout(5)
+def test_relays_tcp_between_unix_sockets(tmp_path, engine):
+  server_path = str(tmp_path / "server.sock")
+  proxy_path = str(tmp_path / "proxy.sock")
+  args = ["--server", f"unix:{server_path}", "--new-server", f"unix:{proxy_path}", "--protocols", "tcp"]
+  _relay_tcp(socket.AF_UNIX, server_path, proxy_path, [*args, "--engine", engine, "--bandwidth", "100000"])
+  assert not os.path.exists(proxy_path)
+
+
+@pytest.mark.skipif(not has_ipv6_loopback(), reason="No IPv6 loopback")
+@pytest.mark.timeout(5)
+def test_relays_tcp_over_ipv6():
+  server_port, proxy_port = random_ports(socket.SOCK_STREAM, size=2)
+  args = ["--server", f"[::1]:{server_port}", "--new-server", f"[::1]:{proxy_port}", "--protocols", "tcp"]
+  _relay_tcp(socket.AF_INET6, ("::1", server_port), ("::1", proxy_port), args)
+
+
+@pytest.mark.skipif(is_windows(), reason="Unix datagram sockets")
+@pytest.mark.timeout(5)
+def test_relays_udp_between_unix_sockets(tmp_path):
+  server_path = str(tmp_path / "server.sock")
+  proxy_path = str(tmp_path / "proxy.sock")
+  client_path = str(tmp_path / "client.sock")
+  with contextlib.ExitStack() as exit_stack:
+    server_socket = exit_stack.enter_context(socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM))
+    server_socket.bind(server_path)
+    server_socket.settimeout(1)
+    process = spawn_localhost_throttle_with_args(
+      ["--server", f"unix:{server_path}", "--new-server", f"unix:{proxy_path}", "--protocols", "udp"]
+    )
+    with context_util.RunIfException(lambda: process.kill()):
+      time.sleep(DELAY_TO_START_UP)
+      client_socket = exit_stack.enter_context(socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM))
+      client_socket.bind(client_path)
+      client_socket.settimeout(1)
+      client_socket.sendto(b"ping", proxy_path)
+      data, address = server_socket.recvfrom(16)
+      assert data == b"ping"
+      server_socket.sendto(b"pong", address)
+      assert client_socket.recvfrom(16) == (b"pong", proxy_path)
+      interrupt_process(process)
+      process.communicate(timeout=TIME_FOR_PROCESS_TO_FINISH)
+
+
+@pytest.mark.skipif(is_windows(), reason="Unix datagram sockets")
+@pytest.mark.timeout(5)
+def test_skips_missing_unix_udp_backend(tmp_path):
+  missing_path = str(tmp_path / "missing.sock")
+  server_path = str(tmp_path / "server.sock")
+  proxy_path = str(tmp_path / "proxy.sock")
+  with contextlib.ExitStack() as exit_stack:
+    server_socket = exit_stack.enter_context(socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM))
+    server_socket.bind(server_path)
+    server_socket.settimeout(1)
+    servers = f"unix:{missing_path},unix:{server_path}"
+    process = spawn_localhost_throttle_with_args(
+      ["--server", servers, "--new-server", f"unix:{proxy_path}", "--protocols", "udp"]
+    )
+    with context_util.RunIfException(lambda: process.kill()):
+      time.sleep(DELAY_TO_START_UP)
+      # Round robin sends one of the two clients to the missing backend first
+      for index in range(2):
+        client_socket = exit_stack.enter_context(socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM))
+        client_socket.bind(str(tmp_path / f"client{index}.sock"))
+        client_socket.sendto(b"ping", proxy_path)
+        assert server_socket.recvfrom(16)[0] == b"ping"
+      interrupt_process(process)
+      process.communicate(timeout=TIME_FOR_PROCESS_TO_FINISH)
+
+
+@pytest.mark.skipif(is_windows(), reason="Unix datagram sockets")
+@pytest.mark.timeout(5)
+def test_relays_udp_replies_after_client_disappeared(tmp_path):
+  server_path = str(tmp_path / "server.sock")
+  proxy_path = str(tmp_path / "proxy.sock")
+  with contextlib.ExitStack() as exit_stack:
+    server_socket = exit_stack.enter_context(socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM))
+    server_socket.bind(server_path)
+    server_socket.settimeout(1)
+    process = spawn_localhost_throttle_with_args(
+      ["--server", f"unix:{server_path}", "--new-server", f"unix:{proxy_path}", "--protocols", "udp"]
+    )
+    with context_util.RunIfException(lambda: process.kill()):
+      time.sleep(DELAY_TO_START_UP)
+      gone_path = str(tmp_path / "gone.sock")
+      with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as gone_socket:
+        gone_socket.bind(gone_path)
+        gone_socket.sendto(b"ping", proxy_path)
+        data, gone_address = server_socket.recvfrom(16)
+        assert data == b"ping"
+      os.unlink(gone_path)
+      # Reply to the client that is gone fails to be sent, which must not stop replies to other clients
+      server_socket.sendto(b"pong", gone_address)
+
+      client_socket = exit_stack.enter_context(socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM))
+      client_socket.bind(str(tmp_path / "client.sock"))
+      client_socket.settimeout(1)
+      client_socket.sendto(b"ping", proxy_path)
+      data, address = server_socket.recvfrom(16)
+      assert data == b"ping"
+      server_socket.sendto(b"pong", address)
+      assert client_socket.recvfrom(16) == (b"pong", proxy_path)
+      interrupt_process(process)
+      process.communicate(timeout=TIME_FOR_PROCESS_TO_FINISH)
+
+
+@pytest.mark.skipif(is_windows(), reason="Unix datagram sockets")
+def test_names_unix_reply_sockets_with_private_files_off_linux(tmp_path, monkeypatch):
+  monkeypatch.setattr(sys, "platform", "darwin")
+  server_path = str(tmp_path / "server.sock")
+  with (
+    socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as server_socket,
+    socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as reply_socket,
+  ):
+    server_socket.bind(server_path)
+    server_socket.settimeout(1)
+    reply_path = bind_for_replies(reply_socket, socket.AF_UNIX)
+    reply_socket.connect(server_path)
+    reply_socket.sendall(b"ping")
+    assert server_socket.recvfrom(16) == (b"ping", reply_path)
+  remove_reply_socket_file(reply_path)
+  assert not os.path.exists(os.path.dirname(reply_path))
@@ -0,0 +1,61 @@
+import socket
+
+import pytest
+
+from .constants import TIME_FOR_PROCESS_TO_FINISH
+from .util import TCPSingleConnectionTest, interrupt_process
+
+ASYNCIO_ENGINE_ARGS = ("--engine", "asyncio")
+
+
+@pytest.mark.timeout(3)
+def test_redirects_data_in_to_out_to_in():
+  with TCPSingleConnectionTest(extra_args=ASYNCIO_ENGINE_ARGS) as (in_socket_out, out_socket, _):
+    data_to_send = b"1"
+    in_socket_out.send(data_to_send)
+    data_to_receive = out_socket.recv(len(data_to_send))
+    assert data_to_send == data_to_receive, (
+      f"Data received is not equal to data send. (sent: {data_to_send}, got: {data_to_receive})"
+    )
+
+    data_to_send = b"2"
+    out_socket.send(data_to_send)
+    data_to_receive = in_socket_out.recv(len(data_to_send))
+    assert data_to_send == data_to_receive, (
+      f"Data received is not equal to data send. (sent: {data_to_send}, got: {data_to_receive})"
+    )
+
+
+@pytest.mark.timeout(3)
+def test_end_of_connection_from_server_is_propagated():
+  with TCPSingleConnectionTest(extra_args=ASYNCIO_ENGINE_ARGS) as (in_socket_out, out_socket, _):
+    in_socket_out.shutdown(socket.SHUT_RDWR)
+    data_to_receive = out_socket.recv(1)
+    expected = b""
+    assert data_to_receive == expected, f"Shutdown was expected. (expected: {expected}, got: {data_to_receive})"
+
+
+@pytest.mark.timeout(5)
+def test_slows_down_data_transfer_tcp():
+  with TCPSingleConnectionTest(bandwidth=5, extra_args=ASYNCIO_ENGINE_ARGS) as (in_socket_out, out_socket, _):
+    out_socket.settimeout(0.1)
+    data_to_send = b"1"
+    in_socket_out.send(data_to_send)
+    with pytest.raises(TimeoutError):
+      data_to_receive = out_socket.recv(len(data_to_send))
+    out_socket.settimeout(0.5)
+    data_to_receive = out_socket.recv(len(data_to_send))
+    assert data_to_send == data_to_receive, f"Data received is not equal to data send. {data_to_send=}, {data_to_receive=}"
+
+
+@pytest.mark.timeout(5)
+def test_can_be_interrupted_on_long_transfer():
+  with TCPSingleConnectionTest(bandwidth=5, extra_args=ASYNCIO_ENGINE_ARGS) as (in_socket_out, out_socket, process):
+    data_to_send = b"1" * 100
+    in_socket_out.send(data_to_send)
+    out_socket.settimeout(0.1)
+    with pytest.raises(TimeoutError):
+      _ = out_socket.recv(len(data_to_send))
+
+    interrupt_process(process)
+    process.communicate(timeout=TIME_FOR_PROCESS_TO_FINISH)
@@ -0,0 +1,112 @@
+import os
+import socket
+import threading
+
+import pytest
+
+from localhost_throttle.global_state import GlobalState, WakeupSocketPair
+
+from .util import is_windows
+
+
+def test_tracks_sockets_and_threads():
+  global_state = GlobalState(collect_events=False)
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  global_state.add_socket(sock)
+  assert len(global_state.sockets) == 1
+  global_state.close_socket(sock)
+  assert len(global_state.sockets) == 0
+  assert sock.fileno() == -1
+
+  finish = threading.Event()
+  thread = global_state.add_thread(f=lambda *, global_state: finish.wait())
+  assert len(global_state.threads) == 2
+  finish.set()
+  thread.join()
+  assert len(global_state.threads) == 1
+  assert global_state.join(timeout=1)
+
+
+def test_closes_all_sockets_on_shutdown():
+  global_state = GlobalState(collect_events=False)
+  sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(3)]
+  for sock in sockets:
+    global_state.add_socket(sock)
+  global_state.close_all_sockets()
+  assert len(global_state.sockets) == 0
+  assert all(sock.fileno() == -1 for sock in sockets)
+  # Owner of the socket may still close it afterwards
+  global_state.close_socket(sockets[0])
+
+
+def test_collects_events_only_when_asked():
+  global_state = GlobalState(collect_events=False)
+  with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+    global_state.add_socket(sock)
+  assert len(global_state.events) == 0
+
+  global_state = GlobalState(collect_events=True)
+  with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+    global_state.add_socket(sock)
+    global_state.close_socket(sock)
+  assert [event[0] for event in global_state.events] == ["Added socket", "Closed socket"]
+
+
+def test_shutdown_wakes_up_waiters():
+  global_state = GlobalState(collect_events=False)
+  notified = []
+  global_state.on_shutdown(lambda: notified.append(True))
+  with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+    sock.bind(("localhost", 0))
+    timer = threading.Timer(0.1, global_state.shutdown)
+    timer.start()
+    assert global_state.wait_readable([sock], timeout=5) == []
+    timer.join()
+  assert global_state.is_shutdown()
+  assert notified == [True]
+  assert global_state.wait_for_shutdown(timeout=5)
+  global_state.on_shutdown(lambda: notified.append(True))
+  assert notified == [True, True]
+  global_state.close()
+
+
+def socket_with_high_descriptor(fd=1100):
+  # Moves one end of a pair above FD_SETSIZE, where select() fails
+  resource = pytest.importorskip("resource")
+  soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+  if soft_limit <= fd:
+    if hard_limit != resource.RLIM_INFINITY and hard_limit <= fd:
+      pytest.skip("Descriptor limit is too low")
+    resource.setrlimit(resource.RLIMIT_NOFILE, (fd + 1, hard_limit))
+  first, second = socket.socketpair()
+  os.dup2(first.detach(), fd)
+  return socket.socket(fileno=fd), second
+
+
+@pytest.mark.skipif(is_windows(), reason="Windows has no poll()")
+def test_waits_for_sockets_with_high_descriptors():
+  global_state = GlobalState(collect_events=False)
+  high_socket, peer_socket = socket_with_high_descriptor()
+  with high_socket, peer_socket:
+    assert high_socket.fileno() >= 1024
+    assert global_state.wait_writable([high_socket], timeout=1) == [high_socket]
+    assert global_state.wait_readable([high_socket], timeout=0) == []
+    peer_socket.send(b"1")
+    assert global_state.wait_readable([high_socket], timeout=1) == [high_socket]
+  global_state.close()
+
+
+def test_wakeup_socket_pair_wakes_up_waiter_until_drained():
+  global_state = GlobalState(collect_events=False)
+  wakeup = WakeupSocketPair(global_state=global_state)
+  assert global_state.wait_readable([wakeup.receiver], timeout=0) == []
+  for _ in range(3):
+    wakeup.wake_up()
+  assert global_state.wait_readable([wakeup.receiver], timeout=1) == [wakeup.receiver]
+  wakeup.drain()
+  assert global_state.wait_readable([wakeup.receiver], timeout=0) == []
+  wakeup.close()
+  # Waking up a closed pair is a no-op
+  wakeup.wake_up()
+  assert len(global_state.sockets) == 0
+  global_state.close()
@@ -0,0 +1,61 @@
+import pytest
+
+from localhost_throttle.direction_type import Direction
+from localhost_throttle.impairment import ImpairmentEmulator, create_profiles
+
+from .util import UDPSingleConnectionTest
+
+
+def decisions(impairment_emulator, n=1000):
+  impairment = impairment_emulator.create_session_impairments()[Direction.CLIENT_TO_SERVER]
+  return [impairment.decide() for _ in range(n)]
+
+
+def test_same_seed_makes_same_decisions():
+  profiles = create_profiles(loss=(0.2, 0.2), duplicate=(0.1, 0.1), reorder=(0.1, 0.1), gilbert_elliott=None)
+  first = decisions(ImpairmentEmulator(profiles, seed=42))
+  second = decisions(ImpairmentEmulator(profiles, seed=42))
+  other = decisions(ImpairmentEmulator(profiles, seed=43))
+  assert first == second
+  assert first != other
+
+
+def test_loss_rate_is_close_to_configured():
+  profiles = create_profiles(loss=(0.25, 0.25))
+  lost = sum(copies == 0 for copies, _ in decisions(ImpairmentEmulator(profiles, seed=1), n=20000))
+  assert 0.23 < lost / 20000 < 0.27
+
+
+def test_gilbert_elliott_loses_in_bursts():
+  profiles = create_profiles(gilbert_elliott=((0.01, 0.1), (0.01, 0.1)))
+  lost = [copies == 0 for copies, _ in decisions(ImpairmentEmulator(profiles, seed=1), n=20000)]
+  bursts = sum(1 for previous, current in zip([False] + lost, lost) if current and not previous)
+  assert sum(lost) / bursts > 5, "Losses are expected to come in long bursts"
+
+
+def test_disabled_direction_has_no_impairment():
+  profiles = create_profiles(loss=(0.5, 0.0))
+  impairments = ImpairmentEmulator(profiles).create_session_impairments()
+  assert impairments[Direction.CLIENT_TO_SERVER] is not None
+  assert impairments[Direction.SERVER_TO_CLIENT] is None
+
+
+@pytest.mark.timeout(3)
+def test_drops_all_datagrams_in_one_direction():
+  with UDPSingleConnectionTest(extra_args=("--udp-loss", "1/0")) as (in_socket, out_socket, _, out_port):
+    data_to_send = b"1"
+    out_socket.sendto(data_to_send, ("localhost", out_port))
+    in_socket.settimeout(0.3)
+    with pytest.raises(TimeoutError):
+      in_socket.recvfrom(len(data_to_send))
+
+
+@pytest.mark.timeout(3)
+def test_duplicates_datagrams():
+  with UDPSingleConnectionTest(extra_args=("--udp-duplicate", "1")) as (in_socket, out_socket, _, out_port):
+    data_to_send = b"1"
+    out_socket.sendto(data_to_send, ("localhost", out_port))
+    in_socket.settimeout(0.5)
+    for _ in range(2):
+      data_to_receive, _ = in_socket.recvfrom(len(data_to_send))
+      assert data_to_send == data_to_receive, f"Data received is not equal to data send. {data_to_send=}, {data_to_receive=}"
@@ -0,0 +1,99 @@
+import contextlib
+import socket
+
+import pytest
+
+from localhost_throttle import Protocol
+
+from .util import TCPSingleConnectionTest, UDPSingleConnectionTest, running_proxy
+
+LATENCY_ARGS = ("--latency", "0.3")
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_delays_data_tcp(engine):
+  with TCPSingleConnectionTest(extra_args=(*LATENCY_ARGS, "--engine", engine)) as (in_socket_out, out_socket, _):
+    data_to_send = b"1"
+    out_socket.send(data_to_send)
+    in_socket_out.settimeout(0.1)
+    with pytest.raises(TimeoutError):
+      data_to_receive = in_socket_out.recv(len(data_to_send))
+    in_socket_out.settimeout(0.5)
+    data_to_receive = in_socket_out.recv(len(data_to_send))
+    assert data_to_send == data_to_receive, f"Data received is not equal to data send. {data_to_send=}, {data_to_receive=}"
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_jitter_keeps_tcp_stream_in_order(engine):
+  extra_args = ("--latency", "0.05", "--jitter", "0.05", "--engine", engine)
+  with TCPSingleConnectionTest(extra_args=extra_args) as (in_socket_out, out_socket, _):
+    messages = [str(x).encode("utf-8") + b"," for x in range(100)]
+    for data_to_send in messages:
+      out_socket.send(data_to_send)
+    data_to_send = b"".join(messages)
+    data_to_receive = b""
+    in_socket_out.settimeout(2)
+    while len(data_to_receive) < len(data_to_send):
+      data_to_receive += in_socket_out.recv(len(data_to_send))
+    assert data_to_send == data_to_receive, f"Data received is not equal to data send. {data_to_send=}, {data_to_receive=}"
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_end_of_connection_arrives_after_delayed_data(engine):
+  with TCPSingleConnectionTest(extra_args=(*LATENCY_ARGS, "--engine", engine)) as (in_socket_out, out_socket, _):
+    data_to_send = b"1"
+    in_socket_out.send(data_to_send)
+    in_socket_out.shutdown(socket.SHUT_RDWR)
+    out_socket.settimeout(1)
+    data_to_receive = out_socket.recv(len(data_to_send))
+    assert data_to_send == data_to_receive, f"Data received is not equal to data send. {data_to_send=}, {data_to_receive=}"
+    assert out_socket.recv(1) == b"", "Shutdown was expected"
+
+
+@pytest.mark.timeout(5)
+def test_delays_data_udp():
+  with UDPSingleConnectionTest(extra_args=LATENCY_ARGS) as (in_socket, out_socket, _, out_port):
+    data_to_send = b"1"
+    out_socket.sendto(data_to_send, ("localhost", out_port))
+    in_socket.settimeout(0.1)
+    with pytest.raises(TimeoutError):
+      data_to_receive, _ = in_socket.recvfrom(len(data_to_send))
+    in_socket.settimeout(0.5)
+    data_to_receive, _ = in_socket.recvfrom(len(data_to_send))
+    assert data_to_send == data_to_receive, f"Data received is not equal to data send. {data_to_send=}, {data_to_receive=}"
+
+
+def send_until_blocked(sock, limit):
+  # Returns how much the socket took before it stopped taking data for a while
+  sock.settimeout(0.5)
+  data = b"1" * 65536
+  sent = 0
+  with contextlib.suppress(TimeoutError):
+    while sent < limit:
+      sent += sock.send(data)
+  return sent
+
+
+@pytest.mark.timeout(15)
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_client_that_does_not_read_holds_up_nothing_else(engine):
+  limit = 2**28
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+    server_socket.bind(("localhost", 0))
+    server_socket.listen(2)
+    server_socket.settimeout(1)
+    extra_args = ("--latency", "0.05", "--engine", engine)
+    with running_proxy(Protocol.TCP, server_socket.getsockname()[1], extra_args) as proxy_port:
+      with contextlib.ExitStack() as exit_stack:
+        exit_stack.enter_context(socket.create_connection(("localhost", proxy_port), timeout=1))
+        stalled_socket = exit_stack.enter_context(server_socket.accept()[0])
+        # Proxy stops reading once its delayed data and the socket buffers are full
+        assert send_until_blocked(stalled_socket, limit) < limit // 4
+        client_socket = exit_stack.enter_context(socket.create_connection(("localhost", proxy_port), timeout=1))
+        accepted_socket = exit_stack.enter_context(server_socket.accept()[0])
+        accepted_socket.settimeout(1)
+        accepted_socket.sendall(b"hello")
+        assert client_socket.recv(5) == b"hello"
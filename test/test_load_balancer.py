@@ -0,0 +1,92 @@
+import collections
+
+from localhost_throttle.hostname_and_port import HostnameAndPort
+from localhost_throttle.load_balancer import Backend, LoadBalancer
+from localhost_throttle.load_balancing_type import LoadBalancing
+
+from .util import FakeClock
+
+
+def create_backends(count, *, clock=None, max_failures=1):
+  clock = clock if clock is not None else FakeClock()
+  return [
+    Backend(HostnameAndPort("localhost", 1000 + i), ejection_time=10, max_failures=max_failures, clock=clock)
+    for i in range(count)
+  ]
+
+
+def test_round_robin_cycles_over_backends():
+  backends = create_backends(3)
+  load_balancer = LoadBalancer(backends, policy=LoadBalancing.ROUND_ROBIN)
+  chosen = [load_balancer.choose(("127.0.0.1", 5000)) for _ in range(6)]
+  assert chosen == backends + backends
+
+
+def test_least_connections_picks_least_loaded_backend():
+  backends = create_backends(3)
+  load_balancer = LoadBalancer(backends, policy=LoadBalancing.LEAST_CONNECTIONS)
+  backends[0].open_connection()
+  backends[2].open_connection()
+  backends[2].open_connection()
+  assert load_balancer.choose(("127.0.0.1", 5000)) is backends[1]
+  with backends[1].connection(), backends[1].connection():
+    assert load_balancer.choose(("127.0.0.1", 5000)) is backends[0]
+  assert backends[1].active_connections == 0
+
+
+def test_consistent_hash_keeps_client_on_one_backend():
+  backends = create_backends(4)
+  load_balancer = LoadBalancer(backends, policy=LoadBalancing.CONSISTENT_HASH)
+  for i in range(20):
+    host = f"127.0.0.{i}"
+    chosen = {load_balancer.choose((host, port)) for port in range(5000, 5010)}
+    assert len(chosen) == 1
+  counts = collections.Counter(load_balancer.choose((f"10.0.{i // 256}.{i % 256}", 5000)) for i in range(1000))
+  assert len(counts) == 4
+  assert min(counts.values()) > 100
+
+
+def test_consistent_hash_moves_only_clients_of_ejected_backend():
+  backends = create_backends(4)
+  load_balancer = LoadBalancer(backends, policy=LoadBalancing.CONSISTENT_HASH)
+  clients = [(f"10.0.0.{i}", 5000) for i in range(200)]
+  before = {client: load_balancer.choose(client) for client in clients}
+  backends[0].report_failure()
+  after = {client: load_balancer.choose(client) for client in clients}
+  for client in clients:
+    if before[client] is not backends[0]:
+      assert after[client] is before[client]
+    else:
+      assert after[client] is not backends[0]
+
+
+def test_ejects_failed_backend_for_a_while():
+  clock = FakeClock()
+  backends = create_backends(2, clock=clock, max_failures=2)
+  load_balancer = LoadBalancer(backends, policy=LoadBalancing.ROUND_ROBIN)
+  backends[0].report_failure()
+  assert backends[0].is_available()
+  backends[0].report_failure()
+  assert not backends[0].is_available()
+  assert [load_balancer.choose(("127.0.0.1", 5000)) for _ in range(4)] == [backends[1]] * 4
+  clock.now = 10.0
+  assert backends[0].is_available()
+  assert backends[0] in {load_balancer.choose(("127.0.0.1", 5000)) for _ in range(2)}
+
+
+def test_success_resets_failures():
+  backends = create_backends(1, max_failures=2)
+  backends[0].report_failure()
+  backends[0].report_success()
+  backends[0].report_failure()
+  assert backends[0].is_available()
+
+
+def test_ejected_backends_are_tried_last():
+  backends = create_backends(3)
+  load_balancer = LoadBalancer(backends, policy=LoadBalancing.ROUND_ROBIN)
+  for backend in backends:
+    backend.report_failure()
+  assert len(load_balancer.candidates(("127.0.0.1", 5000))) == 3
+  backends[2].report_success()
+  assert load_balancer.candidates(("127.0.0.1", 5000))[0] is backends[2]
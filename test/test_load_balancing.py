@@ -0,0 +1,79 @@
+import contextlib
+import socket
+
+import pytest
+
+from localhost_throttle import Protocol
+
+from .util import random_ports, running_proxy
+
+
+@contextlib.contextmanager
+def listening_sockets(count):
+  with contextlib.ExitStack() as exit_stack:
+    sockets = []
+    for _ in range(count):
+      sock = exit_stack.enter_context(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+      sock.bind(("localhost", 0))
+      sock.listen(16)
+      sock.settimeout(1)
+      sockets.append(sock)
+    yield sockets
+
+
+def accepted_count(sock, exit_stack) -> int:
+  sock.settimeout(0.2)
+  count = 0
+  with contextlib.suppress(TimeoutError):
+    while True:
+      exit_stack.enter_context(sock.accept()[0])
+      count += 1
+  return count
+
+
+@pytest.mark.timeout(5)
+def test_round_robin_spreads_tcp_connections():
+  with listening_sockets(2) as servers, contextlib.ExitStack() as exit_stack:
+    server_ports = [x.getsockname()[1] for x in servers]
+    with running_proxy(Protocol.TCP, server_ports) as proxy_port:
+      for _ in range(4):
+        exit_stack.enter_context(socket.create_connection(("localhost", proxy_port)))
+      assert [accepted_count(x, exit_stack) for x in servers] == [2, 2]
+
+
+@pytest.mark.timeout(5)
+def test_failed_tcp_backend_is_ejected():
+  with listening_sockets(1) as servers, contextlib.ExitStack() as exit_stack:
+    dead_port = random_ports(socket.SOCK_STREAM)
+    server_ports = [dead_port, servers[0].getsockname()[1]]
+    with running_proxy(Protocol.TCP, server_ports) as proxy_port:
+      for _ in range(4):
+        client_socket = exit_stack.enter_context(socket.create_connection(("localhost", proxy_port)))
+        client_socket.sendall(b"1")
+      assert accepted_count(servers[0], exit_stack) == 4
+
+
+@pytest.mark.timeout(5)
+def test_consistent_hash_keeps_tcp_client_on_one_backend():
+  with listening_sockets(3) as servers, contextlib.ExitStack() as exit_stack:
+    server_ports = [x.getsockname()[1] for x in servers]
+    with running_proxy(Protocol.TCP, server_ports, ("--load-balancing", "consistent-hash")) as proxy_port:
+      for _ in range(6):
+        exit_stack.enter_context(socket.create_connection(("localhost", proxy_port)))
+      assert sorted(accepted_count(x, exit_stack) for x in servers) == [0, 0, 6]
+
+
+@pytest.mark.timeout(5)
+def test_round_robin_spreads_udp_clients():
+  with contextlib.ExitStack() as exit_stack:
+    servers = [exit_stack.enter_context(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) for _ in range(2)]
+    for server in servers:
+      server.bind(("localhost", 0))
+      server.settimeout(1)
+    with running_proxy(Protocol.UDP, [x.getsockname()[1] for x in servers]) as proxy_port:
+      clients = [exit_stack.enter_context(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) for _ in range(2)]
+      for i, client in enumerate(clients):
+        for _ in range(2):
+          client.sendto(str(i).encode(), ("localhost", proxy_port))
+      received = [{server.recvfrom(1)[0] for _ in range(2)} for server in servers]
+      assert sorted(received) == [{b"0"}, {b"1"}]
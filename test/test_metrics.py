@@ -0,0 +1,69 @@
+import socket
+import threading
+import time
+import urllib.request
+
+import pytest
+
+from localhost_throttle.direction_type import Direction
+from localhost_throttle.metrics import Counter, Histogram, Metrics
+from localhost_throttle.protocol_type import Protocol
+
+from .util import TCPSingleConnectionTest, random_ports
+
+
+def test_counter_sums_updates_of_all_threads():
+  counter = Counter()
+
+  def add_many():
+    for _ in range(1000):
+      counter.add()
+
+  threads = [threading.Thread(target=add_many) for _ in range(40)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  counter.add(-5)
+  assert counter.value() == 40 * 1000 - 5
+
+
+def test_histogram_counts_values_per_bucket():
+  histogram = Histogram((0.1, 1.0))
+  for value in (0.05, 0.1, 0.5, 2.0):
+    histogram.observe(value)
+  bucket_counts, sum_ = histogram.value()
+  assert bucket_counts == [2, 1, 1]
+  assert sum_ == pytest.approx(2.65)
+
+
+def test_renders_prometheus_text_format():
+  metrics = Metrics()
+  metrics.relay(Protocol.TCP, Direction.CLIENT_TO_SERVER).record(100)
+  metrics.relay(Protocol.TCP, Direction.CLIENT_TO_SERVER).record_throttle(0.2)
+  metrics.add_gauge("localhost_throttle_threads", "Threads.", lambda: 3)
+  lines = metrics.render().splitlines()
+  assert 'localhost_throttle_bytes_total{protocol="tcp",direction="client_to_server"} 100' in lines
+  assert 'localhost_throttle_packets_total{protocol="tcp",direction="client_to_server"} 1' in lines
+  assert 'localhost_throttle_bytes_total{protocol="udp",direction="server_to_client"} 0' in lines
+  assert 'localhost_throttle_throttle_sleep_seconds_bucket{le="0.1"} 0' in lines
+  assert 'localhost_throttle_throttle_sleep_seconds_bucket{le="0.5"} 1' in lines
+  assert 'localhost_throttle_throttle_sleep_seconds_bucket{le="+Inf"} 1' in lines
+  assert "localhost_throttle_throttle_sleep_seconds_count 1" in lines
+  assert "# TYPE localhost_throttle_threads gauge" in lines
+  assert "localhost_throttle_threads 3" in lines
+
+
+@pytest.mark.timeout(5)
+def test_serves_metrics_endpoint():
+  metrics_port = random_ports(socket.SOCK_STREAM)
+  extra_args = ("--metrics-address", f"localhost:{metrics_port}")
+  with TCPSingleConnectionTest(extra_args=extra_args) as (in_socket_out, out_socket, _):
+    data_to_send = b"1" * 10
+    out_socket.sendall(data_to_send)
+    in_socket_out.recv(len(data_to_send))
+    time.sleep(0.1)
+    with urllib.request.urlopen(f"http://localhost:{metrics_port}/metrics", timeout=2) as response:
+      lines = response.read().decode("utf-8").splitlines()
+  assert 'localhost_throttle_bytes_total{protocol="tcp",direction="client_to_server"} 10' in lines
+  assert "localhost_throttle_open_tcp_connections 1" in lines
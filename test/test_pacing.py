@@ -0,0 +1,30 @@
+import statistics
+import threading
+import time
+
+from localhost_throttle.global_state import GlobalState
+from localhost_throttle.pacing import accuracy_target, sleep_until
+
+
+def test_wakes_up_within_accuracy_target():
+  global_state = GlobalState(collect_events=False)
+  lateness = []
+  for _ in range(50):
+    deadline = time.perf_counter() + 0.002
+    assert sleep_until(deadline, global_state=global_state)
+    lateness.append(time.perf_counter() - deadline)
+  global_state.close()
+  assert min(lateness) >= 0, "Woke up before the deadline"
+  # Median is asserted so that a single preemption by the OS does not fail the test
+  assert statistics.median(lateness) <= accuracy_target, f"Median lateness is {statistics.median(lateness)}"
+
+
+def test_returns_on_shutdown():
+  global_state = GlobalState(collect_events=False)
+  timer = threading.Timer(0.05, global_state.shutdown)
+  timer.start()
+  start = time.perf_counter()
+  assert not sleep_until(start + 5, global_state=global_state)
+  assert time.perf_counter() - start < 1
+  timer.join()
+  global_state.close()
@@ -1,8 +1,14 @@
+import contextlib
 import socket
+import threading
+import time
+import urllib.request
 
 import pytest
 
-from .util import TCPSingleConnectionTest
+from localhost_throttle import Protocol
+
+from .util import TCPSingleConnectionTest, random_ports, running_proxy
 
 
 @pytest.mark.timeout(5)
@@ -105,3 +111,100 @@ def test_end_of_connection_from_client_is_propagated_after_n_messages(n):
     data_to_receive = in_socket_out.recv(1)
     expected = b""
     assert data_to_receive == expected, f"Shutdown was expected. (expected: {expected}, got: {data_to_receive})"
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize("reverse", [False, True])
+@pytest.mark.parametrize(
+  "extra_args",
+  [
+    (),
+    ("--bandwidth", "1e12"),
+    ("--engine", "asyncio"),
+    ("--upstream-pool-size", "1"),
+    ("--upstream-pool-size", "1", "--engine", "asyncio"),
+    ("--max-workers", "2", "--backlog", "1"),
+  ],
+)
+def test_redirects_large_data_without_corruption(reverse, extra_args):
+  with TCPSingleConnectionTest(extra_args=extra_args) as (in_socket_out, out_socket, _):
+    if reverse:
+      in_socket_out, out_socket = out_socket, in_socket_out
+    data_to_send = bytes(range(256)) * 4096 + b"end"
+    sender = threading.Thread(target=in_socket_out.sendall, args=(data_to_send,))
+    sender.start()
+    try:
+      data_to_receive = bytearray()
+      while len(data_to_receive) < len(data_to_send):
+        chunk = out_socket.recv(65536)
+        assert chunk != b"", "Connection was closed before all data was received"
+        data_to_receive.extend(chunk)
+    finally:
+      sender.join()
+    assert data_to_send == data_to_receive, "Data received is not equal to data send"
+
+
+def _echo_every_connection(server_socket, count):
+  def echo(accepted_socket):
+    with accepted_socket:
+      while data := accepted_socket.recv(1024):
+        accepted_socket.sendall(data)
+
+  for _ in range(count):
+    accepted_socket = server_socket.accept()[0]
+    threading.Thread(target=echo, args=(accepted_socket,), daemon=True).start()
+
+
+@pytest.mark.timeout(8)
+def test_serves_both_directions_of_max_workers_connections():
+  max_workers = 4
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+    server_socket.bind(("localhost", 0))
+    server_socket.listen(max_workers)
+    server_socket.settimeout(2)
+    threading.Thread(target=_echo_every_connection, args=(server_socket, max_workers), daemon=True).start()
+    extra_args = ("--max-workers", str(max_workers))
+    with running_proxy(Protocol.TCP, server_socket.getsockname()[1], extra_args) as proxy_port:
+      with contextlib.ExitStack() as exit_stack:
+        client_sockets = [
+          exit_stack.enter_context(socket.create_connection(("localhost", proxy_port), timeout=2))
+          for _ in range(max_workers)
+        ]
+        for index, client_socket in enumerate(client_sockets):
+          client_socket.sendall(f"hello {index}".encode())
+        for index, client_socket in enumerate(client_sockets):
+          assert client_socket.recv(16) == f"hello {index}".encode()
+
+
+def _queued_connections(metrics_port):
+  with urllib.request.urlopen(f"http://localhost:{metrics_port}/metrics", timeout=2) as response:
+    lines = response.read().decode("utf-8").splitlines()
+  return next(int(x.split()[-1]) for x in lines if x.startswith("localhost_throttle_tcp_queued_tasks "))
+
+
+@pytest.mark.timeout(10)
+def test_leaves_clients_over_backlog_waiting_in_kernel():
+  max_workers, backlog, client_count = 1, 2, 16
+  metrics_port = random_ports(socket.SOCK_STREAM)
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+    server_socket.bind(("localhost", 0))
+    server_socket.listen(client_count)
+    threading.Thread(target=_echo_every_connection, args=(server_socket, client_count), daemon=True).start()
+    extra_args = (
+      *("--max-workers", str(max_workers), "--backlog", str(backlog)),
+      *("--metrics-address", f"localhost:{metrics_port}"),
+    )
+    with running_proxy(Protocol.TCP, server_socket.getsockname()[1], extra_args) as proxy_port:
+      with contextlib.ExitStack() as exit_stack:
+        # Clients connect without waiting, those the kernel does not take yet retry on their own
+        for _ in range(client_count):
+          client_socket = exit_stack.enter_context(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+          client_socket.setblocking(False)
+          client_socket.connect_ex(("localhost", proxy_port))
+        # Retransmitted handshakes of clients that did not fit into the kernel queue arrive after a second
+        deadline = time.perf_counter() + 2.5
+        queued_connections = []
+        while time.perf_counter() < deadline:
+          queued_connections.append(_queued_connections(metrics_port))
+          time.sleep(0.05)
+        assert max(queued_connections) == backlog
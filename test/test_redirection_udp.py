@@ -1,3 +1,6 @@
+import socket
+import time
+
 import pytest
 
 
@@ -65,3 +68,58 @@ def test_redirects_data_multiple_hops():
       )
       in_socket, out_socket = out_socket, in_socket
       in_addr, out_addr = out_addr, in_addr
+
+
+@pytest.mark.timeout(3)
+def test_redirects_burst_of_datagrams():
+  with UDPSingleConnectionTest() as (in_socket, out_socket, _, out_port):
+    messages = [str(x).encode("utf-8") for x in range(200)]
+    for data_to_send in messages:
+      out_socket.sendto(data_to_send, ("localhost", out_port))
+    in_socket.settimeout(1)
+    received = []
+    for _ in messages:
+      data_to_receive, _ = in_socket.recvfrom(16)
+      received.append(data_to_receive)
+    assert received == messages, f"Datagrams were lost or reordered. (sent: {messages}, got: {received})"
+
+
+@pytest.mark.timeout(3)
+def test_idle_client_gets_new_upstream_socket():
+  with UDPSingleConnectionTest(extra_args=("--udp-session-timeout", "0.2")) as (in_socket, out_socket, _, out_port):
+    out_addr = ("localhost", out_port)
+    out_socket.sendto(b"1", out_addr)
+    _, first_addr = in_socket.recvfrom(1)
+    time.sleep(0.6)
+    out_socket.sendto(b"2", out_addr)
+    data_to_receive, second_addr = in_socket.recvfrom(1)
+    assert data_to_receive == b"2", f"Data received is not equal to data send. (sent: {b'2'}, got: {data_to_receive})"
+    assert first_addr != second_addr, f"Idle session was not evicted. (upstream address: {first_addr})"
+
+    in_socket.sendto(b"3", second_addr)
+    data_to_receive, _ = out_socket.recvfrom(1)
+    assert data_to_receive == b"3", f"Data received is not equal to data send. (sent: {b'3'}, got: {data_to_receive})"
+
+
+@pytest.mark.timeout(3)
+def test_redirects_replies_to_many_clients():
+  with UDPSingleConnectionTest() as (in_socket, out_socket, _, out_port):
+    out_addr = ("localhost", out_port)
+    clients = [out_socket] + [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(49)]
+    try:
+      for i, client in enumerate(clients):
+        client.sendto(str(i).encode("utf-8"), out_addr)
+      in_socket.settimeout(1)
+      for _ in clients:
+        data, addr = in_socket.recvfrom(16)
+        in_socket.sendto(data, addr)
+      for i, client in enumerate(clients):
+        client.settimeout(1)
+        data_to_receive, _ = client.recvfrom(16)
+        data_to_send = str(i).encode("utf-8")
+        assert data_to_send == data_to_receive, (
+          f"Reply reached the wrong client. (sent: {data_to_send}, got: {data_to_receive})"
+        )
+    finally:
+      for client in clients[1:]:
+        client.close()
@@ -0,0 +1,43 @@
+import pytest
+
+from localhost_throttle.token_bucket import TokenBucket
+
+from .util import FakeClock
+
+
+def test_first_chunk_is_paced():
+  clock = FakeClock()
+  token_bucket = TokenBucket(100, burst=10, clock=clock)
+  assert token_bucket.consume(50) == pytest.approx(0.5)
+
+
+def test_idle_time_is_credited_up_to_burst():
+  clock = FakeClock()
+  token_bucket = TokenBucket(100, burst=10, clock=clock)
+  clock.now = 5.0
+  assert token_bucket.consume(10) == 0.0
+  assert token_bucket.consume(10) == pytest.approx(0.1)
+
+
+def test_delays_do_not_accumulate_error():
+  clock = FakeClock()
+  token_bucket = TokenBucket(100, burst=0, clock=clock)
+  for _ in range(10):
+    clock.now += token_bucket.consume(10)
+  assert clock.now == pytest.approx(1.0)
+
+
+def test_chunk_size_is_limited_by_burst():
+  assert TokenBucket(100, burst=10).chunk_size(65536) == 10
+  assert TokenBucket(1, burst=0.5).chunk_size(65536) == 1
+  assert TokenBucket(10**9).chunk_size(65536) == 65536
+
+
+def test_new_rate_keeps_debt():
+  clock = FakeClock()
+  token_bucket = TokenBucket(100, burst=0, clock=clock)
+  assert token_bucket.consume(100) == pytest.approx(1.0)
+  clock.now = 0.5
+  token_bucket.set_rate(10, burst=0)
+  # Half of the debt is paid at the old rate, the rest at the new one
+  assert token_bucket.consume(0) == pytest.approx(5.0)
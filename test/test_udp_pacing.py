@@ -0,0 +1,129 @@
+import pytest
+
+from localhost_throttle.bandwidth_limiter import LimiterChain
+from localhost_throttle.direction_type import Direction
+from localhost_throttle.token_bucket import TokenBucket
+from localhost_throttle.udp_pacing import PacedDatagramQueues
+from localhost_throttle.udp_session import UDPSession
+
+from .util import FakeClock
+
+
+def create_session(client_address, limiter_chain):
+  session = UDPSession(client_address, None, impairment=None)
+  session.relays[Direction.CLIENT_TO_SERVER].limiter_chain = limiter_chain
+  return session
+
+
+def create_paced_queues(clock, max_queue_size=1024, max_total_queue_size=4096):
+  sent = []
+  paced_queues = PacedDatagramQueues(
+    lambda session, data, *, copies, extra_delay: sent.append((session.client_address, bytes(data))),
+    max_queue_size=max_queue_size,
+    max_total_queue_size=max_total_queue_size,
+    clock=clock,
+  )
+  return paced_queues, sent
+
+
+def test_unthrottled_datagrams_are_sent_immediately():
+  clock = FakeClock()
+  paced_queues, sent = create_paced_queues(clock)
+  session = create_session(("localhost", 1), None)
+  assert paced_queues.push(session, b"1", copies=1, extra_delay=0.0)
+  assert sent == [(("localhost", 1), b"1")]
+  assert paced_queues.next_deadline() is None
+
+
+def test_throttled_session_does_not_delay_others():
+  clock = FakeClock()
+  paced_queues, sent = create_paced_queues(clock)
+  heavy = create_session(("localhost", 1), LimiterChain((TokenBucket(10, burst=0, clock=clock),)))
+  light = create_session(("localhost", 2), LimiterChain((TokenBucket(10, burst=0, clock=clock),)))
+  paced_queues.push(heavy, b"1" * 100, copies=1, extra_delay=0.0)
+  paced_queues.push(light, b"2", copies=1, extra_delay=0.0)
+  assert paced_queues.next_deadline() == pytest.approx(0.1)
+  clock.now = 0.1
+  paced_queues.release()
+  assert sent == [(("localhost", 2), b"2")]
+  clock.now = 10.0
+  paced_queues.release()
+  assert sent == [(("localhost", 2), b"2"), (("localhost", 1), b"1" * 100)]
+  assert paced_queues.next_deadline() is None
+
+
+def test_queue_keeps_order_of_one_session():
+  clock = FakeClock()
+  paced_queues, sent = create_paced_queues(clock)
+  session = create_session(("localhost", 1), LimiterChain((TokenBucket(10, burst=0, clock=clock),)))
+  for x in range(3):
+    paced_queues.push(session, str(x).encode("utf-8"), copies=1, extra_delay=0.0)
+  clock.now = 0.2
+  paced_queues.release()
+  assert [data for _, data in sent] == [b"0", b"1"]
+  clock.now = 0.3
+  paced_queues.release()
+  assert [data for _, data in sent] == [b"0", b"1", b"2"]
+
+
+def test_full_queue_drops_datagrams():
+  clock = FakeClock()
+  paced_queues, sent = create_paced_queues(clock, max_queue_size=2)
+  token_bucket = TokenBucket(10, burst=0, clock=clock)
+  session = create_session(("localhost", 1), LimiterChain((token_bucket,)))
+  assert paced_queues.push(session, b"0", copies=1, extra_delay=0.0)
+  assert paced_queues.push(session, b"1", copies=1, extra_delay=0.0)
+  assert not paced_queues.push(session, b"2", copies=1, extra_delay=0.0)
+  assert paced_queues.dropped_datagrams == 1
+  # Dropped datagram does not take tokens of the ones that are queued later
+  clock.now = 0.2
+  paced_queues.release()
+  assert paced_queues.push(session, b"3", copies=1, extra_delay=0.0)
+  assert paced_queues.next_deadline() == pytest.approx(0.3)
+
+
+def test_queue_is_bounded_by_bytes():
+  clock = FakeClock()
+  paced_queues, sent = create_paced_queues(clock, max_queue_size=150)
+  session = create_session(("localhost", 1), LimiterChain((TokenBucket(100, burst=0, clock=clock),)))
+  # Datagram larger than the bound fits into the empty queue
+  assert paced_queues.push(session, b"0" * 200, copies=1, extra_delay=0.0)
+  assert not paced_queues.push(session, b"1", copies=1, extra_delay=0.0)
+  clock.now = 2.0
+  paced_queues.release()
+  assert paced_queues.queued_bytes == 0
+  assert paced_queues.push(session, b"2" * 100, copies=1, extra_delay=0.0)
+  assert paced_queues.push(session, b"3" * 50, copies=1, extra_delay=0.0)
+  assert not paced_queues.push(session, b"4", copies=1, extra_delay=0.0)
+  assert paced_queues.queued_bytes == 150
+
+
+def test_queues_of_all_sessions_are_bounded_together():
+  clock = FakeClock()
+  paced_queues, sent = create_paced_queues(clock, max_queue_size=1000, max_total_queue_size=150)
+  heavy = create_session(("localhost", 1), LimiterChain((TokenBucket(10, burst=0, clock=clock),)))
+  light_token_bucket = TokenBucket(10, burst=10, clock=clock)
+  light = create_session(("localhost", 2), LimiterChain((light_token_bucket,)))
+  unthrottled = create_session(("localhost", 3), None)
+  assert paced_queues.push(heavy, b"1" * 100, copies=1, extra_delay=0.0)
+  assert paced_queues.push(heavy, b"1" * 50, copies=1, extra_delay=0.0)
+  assert not paced_queues.push(light, b"2", copies=1, extra_delay=0.0)
+  # Dropped datagram took no tokens
+  clock.now = 1.0
+  assert light_token_bucket.consume(10) == 0.0
+  # Datagrams of a session that is not throttled are never queued
+  assert paced_queues.push(unthrottled, b"3", copies=1, extra_delay=0.0)
+  assert sent == [(("localhost", 3), b"3")]
+  paced_queues.discard(heavy)
+  assert paced_queues.queued_bytes == 0
+
+
+def test_discarded_session_sends_nothing():
+  clock = FakeClock()
+  paced_queues, sent = create_paced_queues(clock)
+  session = create_session(("localhost", 1), LimiterChain((TokenBucket(10, burst=0, clock=clock),)))
+  paced_queues.push(session, b"1", copies=1, extra_delay=0.0)
+  paced_queues.discard(session)
+  clock.now = 1.0
+  paced_queues.release()
+  assert sent == []
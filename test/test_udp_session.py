@@ -0,0 +1,60 @@
+from localhost_throttle.udp_session import UDPSession, UDPSessionTable
+
+from .util import FakeClock
+
+
+def create_session(client_address, clock):
+  return UDPSession(client_address, None, impairment=None, clock=clock)
+
+
+def test_evicts_idle_sessions():
+  clock = FakeClock()
+  session_table = UDPSessionTable(idle_timeout=10, clock=clock)
+  first = create_session(("localhost", 1), clock)
+  session_table.add(first)
+  clock.now = 6.0
+  second = create_session(("localhost", 2), clock)
+  session_table.add(second)
+  clock.now = 11.0
+  assert session_table.evict_idle() == [first]
+  assert first.is_stopped() and not second.is_stopped()
+  assert len(session_table) == 1
+  assert session_table.evicted_sessions == 1
+
+
+def test_activity_keeps_session():
+  clock = FakeClock()
+  session_table = UDPSessionTable(idle_timeout=10, clock=clock)
+  session = create_session(("localhost", 1), clock)
+  session_table.add(session)
+  clock.now = 8.0
+  assert session_table.get(("localhost", 1)) is session
+  clock.now = 12.0
+  session.touch()
+  clock.now = 20.0
+  assert session_table.evict_idle() == []
+  assert not session.is_stopped()
+
+
+def test_evicts_least_recently_used_over_limit():
+  clock = FakeClock()
+  session_table = UDPSessionTable(max_sessions=2, clock=clock)
+  sessions = [create_session(("localhost", x), clock) for x in range(3)]
+  session_table.add(sessions[0])
+  session_table.add(sessions[1])
+  session_table.get(("localhost", 0))
+  assert session_table.add(sessions[2]) == [sessions[1]]
+  assert session_table.get(("localhost", 1)) is None
+  assert len(session_table) == 2
+  assert session_table.evicted_sessions == 1
+
+
+def test_stop_all_stops_every_session():
+  clock = FakeClock()
+  session_table = UDPSessionTable(clock=clock)
+  sessions = [create_session(("localhost", x), clock) for x in range(3)]
+  for session in sessions:
+    session_table.add(session)
+  session_table.stop_all()
+  assert all(session.is_stopped() for session in sessions)
+  assert len(session_table) == 0
@@ -0,0 +1,96 @@
+import contextlib
+import socket
+import time
+
+import pytest
+
+from localhost_throttle.global_state import GlobalState
+from localhost_throttle.hostname_and_port import HostnameAndPort
+from localhost_throttle.upstream_pool import UpstreamPool
+
+from .util import wait_until
+
+
+@contextlib.contextmanager
+def running_pool(server_port, **kwargs):
+  global_state = GlobalState(collect_events=False)
+  server_address = HostnameAndPort("localhost", server_port)
+  pool = UpstreamPool(server_address, global_state=global_state, **kwargs)
+  global_state.add_thread(f=pool.run_forever)
+  try:
+    yield pool, global_state
+  finally:
+    global_state.shutdown()
+    assert global_state.join(timeout=2)
+    global_state.close_all_sockets()
+    global_state.close()
+
+
+@contextlib.contextmanager
+def listening_socket():
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+    server_socket.bind(("localhost", 0))
+    server_socket.listen(16)
+    yield server_socket, server_socket.getsockname()[1]
+
+
+@pytest.mark.timeout(5)
+def test_hands_out_connected_sockets():
+  with listening_socket() as (server_socket, port), running_pool(port, size=2, refill_rate=100) as (pool, state):
+    wait_until(lambda: len(pool) == 2)
+    accepted = [server_socket.accept()[0] for _ in range(2)]
+    with accepted[0], accepted[1]:
+      upstream_socket = pool.acquire(global_state=state)
+      upstream_socket.sendall(b"hello")
+      # The most recently opened connection is handed out first
+      accepted[1].settimeout(1)
+      assert accepted[1].recv(5) == b"hello"
+      # Pool refills the connection taken from it
+      server_socket.settimeout(1)
+      with server_socket.accept()[0]:
+        wait_until(lambda: len(pool) == 2)
+      state.close_socket(upstream_socket)
+
+
+@pytest.mark.timeout(5)
+def test_replaces_connections_closed_by_server():
+  with listening_socket() as (server_socket, port), running_pool(port, size=2, refill_rate=100) as (pool, state):
+    wait_until(lambda: len(pool) == 2)
+    for _ in range(2):
+      server_socket.accept()[0].close()
+    server_socket.settimeout(1)
+    replacements = [server_socket.accept()[0] for _ in range(2)]
+    with replacements[0], replacements[1]:
+      wait_until(lambda: len(pool) == 2)
+      upstream_socket = pool.acquire(global_state=state)
+      upstream_socket.sendall(b"hello")
+      state.close_socket(upstream_socket)
+
+
+@pytest.mark.timeout(5)
+def test_keeps_connections_of_servers_that_speak_first():
+  with listening_socket() as (server_socket, port), running_pool(port, size=1, refill_rate=100) as (pool, state):
+    wait_until(lambda: len(pool) == 1)
+    with server_socket.accept()[0] as accepted:
+      accepted.sendall(b"greeting")
+      time.sleep(0.1)
+      upstream_socket = pool.acquire(global_state=state)
+      assert upstream_socket is not None
+      assert upstream_socket.recv(8) == b"greeting"
+      state.close_socket(upstream_socket)
+
+
+@pytest.mark.timeout(5)
+def test_does_not_refill_faster_than_refill_rate():
+  with listening_socket() as (_, port), running_pool(port, size=10, refill_rate=10) as (pool, _):
+    time.sleep(0.25)
+    assert 1 <= len(pool) <= 3
+
+
+@pytest.mark.timeout(5)
+def test_returns_nothing_when_server_is_down():
+  with listening_socket() as (_, port):
+    pass
+  with running_pool(port, size=1, refill_rate=100) as (pool, state):
+    time.sleep(0.1)
+    assert pool.acquire(global_state=state) is None
@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+from localhost_throttle.global_state import GlobalState
+from localhost_throttle.worker_pool import WorkerPool
+
+from .util import wait_until
+
+
+def shut_down(global_state):
+  global_state.shutdown()
+  assert global_state.join(timeout=2)
+  global_state.close()
+
+
+@pytest.mark.timeout(5)
+def test_reuses_idle_workers():
+  global_state = GlobalState(collect_events=False)
+  worker_pool = WorkerPool(max_workers=4, global_state=global_state)
+  thread_names = []
+  for _ in range(5):
+    done = threading.Event()
+
+    def task(*, global_state):
+      thread_names.append(threading.current_thread().name)
+      done.set()
+
+    worker_pool.submit(task)
+    assert done.wait(timeout=1)
+    wait_until(lambda: worker_pool.idle_workers == 1)
+  assert len(set(thread_names)) == 1
+  assert worker_pool.workers == 1
+  shut_down(global_state)
+
+
+@pytest.mark.timeout(5)
+def test_queues_tasks_over_max_workers():
+  global_state = GlobalState(collect_events=False)
+  worker_pool = WorkerPool(max_workers=2, global_state=global_state)
+  release = threading.Event()
+  finished = []
+
+  def task(index, *, global_state):
+    release.wait()
+    finished.append(index)
+
+  for index in range(5):
+    worker_pool.submit(task, args=(index,))
+  assert worker_pool.workers == 2
+  assert worker_pool.queued_tasks >= 3
+  release.set()
+  wait_until(lambda: len(finished) == 5)
+  assert sorted(finished) == list(range(5))
+  assert worker_pool.workers == 2
+  shut_down(global_state)
+
+
+@pytest.mark.timeout(5)
+def test_idle_workers_finish():
+  global_state = GlobalState(collect_events=False)
+  worker_pool = WorkerPool(max_workers=4, idle_timeout=0.05, global_state=global_state)
+  for _ in range(3):
+    worker_pool.submit(lambda *, global_state: time.sleep(0.05))
+  wait_until(lambda: worker_pool.workers == 0)
+  assert len(global_state.threads) == 1
+  shut_down(global_state)
+
+
+@pytest.mark.timeout(5)
+def test_worker_survives_exception():
+  global_state = GlobalState(collect_events=False)
+  worker_pool = WorkerPool(max_workers=1, global_state=global_state)
+  done = threading.Event()
+
+  def failing_task(*, global_state):
+    raise RuntimeError("Expected")
+
+  worker_pool.submit(failing_task)
+  worker_pool.submit(lambda *, global_state: done.set())
+  assert done.wait(timeout=1)
+  assert worker_pool.workers == 1
+  shut_down(global_state)
+
+
+@pytest.mark.timeout(5)
+def test_started_tasks_run_over_max_workers():
+  global_state = GlobalState(collect_events=False)
+  worker_pool = WorkerPool(max_workers=1, global_state=global_state)
+  finished = []
+
+  def task(index, *, global_state):
+    done = threading.Event()
+    worker_pool.start(lambda *, global_state: done.set())
+    assert done.wait(timeout=1)
+    finished.append(index)
+
+  for index in range(3):
+    worker_pool.submit(task, args=(index,))
+  wait_until(lambda: len(finished) == 3)
+  assert finished == [0, 1, 2]
+  assert worker_pool.workers == 2
+  shut_down(global_state)
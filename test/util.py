@@ -14,25 +14,24 @@ def is_windows():
   return sys.platform == "win32"
 
 
-def spawn_localhost_throttle(*, in_port, out_port, protocols, bandwidth=None):
-  creationflags = subprocess.CREATE_NEW_PROCESS_GROUP if is_windows() else 0
+def spawn_localhost_throttle(*, in_port, out_port, protocols, bandwidth=None, extra_args=()):
   args = [
-    sys.executable,
-    "-m",
-    "test.run_localhost_throttle_with_ctrl_handler",
     "--server",
-    f"localhost:{in_port}",
+    ",".join(f"localhost:{x}" for x in (in_port if isinstance(in_port, (list, tuple)) else [in_port])),
     "--new-server",
     f"localhost:{out_port}",
     "--protocols",
     str(protocols),
-    "--log-level",
-    "debug",
   ]
   if bandwidth is not None:
     args.extend(["--bandwidth", str(bandwidth)])
+  return spawn_localhost_throttle_with_args([*args, *extra_args])
+
+
+def spawn_localhost_throttle_with_args(args):
+  creationflags = subprocess.CREATE_NEW_PROCESS_GROUP if is_windows() else 0
   return subprocess.Popen(
-    args,
+    [sys.executable, "-m", "test.run_localhost_throttle_with_ctrl_handler", "--log-level", "debug", *args],
     stdin=subprocess.PIPE,
     stdout=subprocess.PIPE,
     stderr=subprocess.PIPE,
@@ -66,13 +65,45 @@ def random_ports(socket_type, size=None):
       sock.close()
 
 
+class FakeClock:
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+
+def wait_until(condition, timeout=2):
+  deadline = time.perf_counter() + timeout
+  while not condition():
+    assert time.perf_counter() < deadline, "Condition was not met in time"
+    time.sleep(0.01)
+
+
+@contextlib.contextmanager
+def running_proxy(protocol, server_ports, extra_args=()):
+  proxy_port = random_ports(protocol.socket_type())
+  process = spawn_localhost_throttle(
+    in_port=server_ports,
+    out_port=proxy_port,
+    protocols=ProtocolSet.from_iterable([protocol]),
+    extra_args=extra_args,
+  )
+  with context_util.RunIfException(lambda: process.kill()):
+    time.sleep(DELAY_TO_START_UP)
+    yield proxy_port
+    interrupt_process(process)
+    process.communicate(timeout=TIME_FOR_PROCESS_TO_FINISH)
+
+
 class TCPSingleConnectionTest:
-  def __init__(self, bandwidth=None):
+  def __init__(self, bandwidth=None, extra_args=()):
     self._in_socket = None
     self._out_socket = None
     self._in_socket_out = None
     self._process = None
     self.bandwidth = bandwidth
+    self.extra_args = extra_args
 
   def __enter__(self):
     protocol = Protocol.TCP
@@ -89,7 +120,11 @@ class TCPSingleConnectionTest:
         self._in_socket = in_socket
         self._out_socket = out_socket
         self._process = spawn_localhost_throttle(
-          in_port=in_port, out_port=out_port, protocols=ProtocolSet.from_iterable([protocol]), bandwidth=self.bandwidth
+          in_port=in_port,
+          out_port=out_port,
+          protocols=ProtocolSet.from_iterable([protocol]),
+          bandwidth=self.bandwidth,
+          extra_args=self.extra_args,
         )
         with context_util.RunIfException(lambda: self._process.kill()):
           time.sleep(DELAY_TO_START_UP)
@@ -110,12 +145,13 @@ class TCPSingleConnectionTest:
 
 
 class UDPSingleConnectionTest:
-  def __init__(self, bandwidth=None):
+  def __init__(self, bandwidth=None, extra_args=()):
     self._in_socket = None
     self._out_socket = None
     self._process = None
     self._out_port = None
     self.bandwidth = bandwidth
+    self.extra_args = extra_args
 
   def __enter__(self):
     protocol = Protocol.UDP
@@ -129,7 +165,11 @@ class UDPSingleConnectionTest:
       self._out_socket = socket.socket(socket.AF_INET, socket_type)
       with context_util.RunIfException(lambda: self._out_socket.close()):
         self._process = spawn_localhost_throttle(
-          in_port=in_port, out_port=out_port, protocols=ProtocolSet.from_iterable([protocol]), bandwidth=self.bandwidth
+          in_port=in_port,
+          out_port=out_port,
+          protocols=ProtocolSet.from_iterable([protocol]),
+          bandwidth=self.bandwidth,
+          extra_args=self.extra_args,
         )
         with context_util.RunIfException(lambda: self._process.kill()):
           self._out_port = out_port